@@ -6,13 +6,43 @@
 #
 # NB: INM Studies need to be in the same directory as where the code is run.
 
+import argparse
+import concurrent.futures
+import fnmatch
 import glob
+import hashlib
+import json
 import os
 import shutil
-from distutils.dir_util import copy_tree
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no reflink support
+    fcntl = None
 
 __author__ = 'Thomas Vandenhede'
 
+# Ways of cloning the Reference study into a flight study:
+# - 'copy': full copy of every file (original behaviour)
+# - 'link': hard-link every file INM only reads, copy the others
+# - 'reflink': copy-on-write clone where the filesystem supports it, falling
+#   back to 'link' otherwise
+CLONE_MODES = ('copy', 'link', 'reflink')
+
+# Files of the Reference study INM writes to. They are always materialised
+# as real files so that a linked clone can never write through to Reference.
+INM_WRITABLE_FILES = ['*.inm', 'grid.dbf', 'case.dbf', 'scenario.dbf',
+                      'run_opt.dbf']
+INM_OUTPUT_DIRS = ['output*']
+
+# ioctl request number of FICLONE (see linux/fs.h)
+FICLONE = 0x40049409
+
+# Name of the file recording the inputs a study directory was built from
+MANIFEST_NAME = 'study_manifest.json'
+MANIFEST_VERSION = 1
+
 
 def get_immediate_subdirectories(a_dir):
     """
@@ -26,45 +56,568 @@ def get_immediate_subdirectories(a_dir):
     return result
 
 
-def create_inm_study_directories(data_path, studies_path, dir_list):
+def is_inm_writable(rel_path):
+    """
+    Returns True if INM may write to the file at rel_path (relative to the
+    study directory) during a run.
+
+    :param rel_path: path of the file relative to the study directory
+    :return:
+    """
+    parts = rel_path.lower().replace('\\', '/').split('/')
+    for d in parts[:-1]:
+        if any(fnmatch.fnmatch(d, p) for p in INM_OUTPUT_DIRS):
+            return True
+    return any(fnmatch.fnmatch(parts[-1], p) for p in INM_WRITABLE_FILES)
+
+
+def reflink_file(src, dst):
+    """
+    Creates dst as a copy-on-write clone of src. Raises OSError if the
+    filesystem (or platform) does not support it.
+
+    :param src: source file
+    :param dst: destination file (must not exist)
+    :return:
+    """
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, 'rb') as f_src:
+        with open(dst, 'wb') as f_dst:
+            try:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            except OSError:
+                f_dst.close()
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+
+def clone_file(src, dst, mode, writable):
+    """
+    Clones a single file of the Reference study and returns the method that
+    was actually used ('reflink', 'link' or 'copy').
+
+    :param src: source file
+    :param dst: destination file (replaced if it exists)
+    :param mode: one of CLONE_MODES
+    :param writable: True if INM writes to the file
+    :return:
+    """
+    # never write through an existing link to the Reference study
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if mode == 'reflink':
+        try:
+            reflink_file(src, dst)
+            return 'reflink'
+        except OSError:
+            pass
+    if mode in ('link', 'reflink') and not writable:
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def clone_reference_study(source_dir, dest_dir, mode='link', skip=()):
+    """
+    Clones the Reference study into dest_dir. Files INM only reads are
+    linked (or reflinked) and only the files INM writes to are copied, so
+    the cost of a clone does not depend on the size of the Reference study.
+
+    :param source_dir: the Reference study directory
+    :param dest_dir: the study directory to create
+    :param mode: one of CLONE_MODES
+    :param skip: lower case names of top level files not to clone (e.g.
+    the .dbf files replaced by the flight files)
+    :return: number of files cloned with each method
+    """
+    if mode not in CLONE_MODES:
+        raise ValueError("Unknown clone mode '%s'" % mode)
+
+    stats = {'reflink': 0, 'link': 0, 'copy': 0}
+    for root, dirs, files in os.walk(source_dir):
+        rel_root = os.path.relpath(root, source_dir)
+        target_root = os.path.join(dest_dir, rel_root)
+        if not os.path.exists(target_root):
+            os.makedirs(target_root)
+        for name in files:
+            if rel_root == os.curdir and name.lower() in skip:
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            method = clone_file(os.path.join(root, name),
+                                os.path.join(target_root, name),
+                                mode, is_inm_writable(rel_path))
+            stats[method] += 1
+    return stats
+
+
+def create_inm_study_directory(data_path, studies_path, d,
+                               clone_mode='copy', replace=False):
+    """
+    Creates a single INM study directory named d from the Reference study
+    and the .dbf files of the flight folder of the same name.
+
+    :param data_path: the folder containing one folder of .dbf files per
+    flight
+    :param studies_path: the folder where all study directories will be created
+    :param d: name of the flight folder and of the study directory
+    :param clone_mode: how the Reference study is cloned (see CLONE_MODES)
+    :param replace: build the study in a temporary directory and swap it
+    with the existing study directory once the build succeeded, instead of
+    copying over the existing files; the output directories (results of
+    earlier runs) of the existing study are kept
+    :return:
+    """
+    if replace:
+        final_dir = os.path.join(studies_path, d)
+        build_dir = os.path.join(studies_path, '.%s.tmp' % d)
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+        try:
+            _build_inm_study_directory(data_path, studies_path, d, build_dir,
+                                       clone_mode)
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        if os.path.exists(final_dir):
+            old_dir = os.path.join(studies_path, '.%s.old' % d)
+            if os.path.exists(old_dir):
+                shutil.rmtree(old_dir)
+            os.rename(final_dir, old_dir)
+            try:
+                _move_output_dirs(old_dir, build_dir)
+                os.rename(build_dir, final_dir)
+            except BaseException:
+                _move_output_dirs(build_dir, old_dir)
+                os.rename(old_dir, final_dir)
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(build_dir, final_dir)
+    else:
+        _build_inm_study_directory(data_path, studies_path, d,
+                                   os.path.join(studies_path, d), clone_mode)
+
+
+def _move_output_dirs(source_dir, dest_dir):
+    # move the output directories of a study (INM_OUTPUT_DIRS) into another
+    # study directory, replacing those cloned from Reference
+    for name in get_immediate_subdirectories(source_dir):
+        if any(fnmatch.fnmatch(name.lower(), p) for p in INM_OUTPUT_DIRS):
+            dest = os.path.join(dest_dir, name)
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            os.rename(os.path.join(source_dir, name), dest)
+
+
+def _build_inm_study_directory(data_path, studies_path, d, dest_dir,
+                               clone_mode):
+    # clone Reference into dest_dir and add the .dbf files of flight d
+    source_dir = os.path.join(studies_path, 'Reference')
+    data_dir = os.path.join(data_path, d)
+
+    # create study directory if doesn't already exists
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    # flight .dbf files replace those of the Reference study
+    pattern = os.path.join(data_dir, '*.[dD][bB][fF]')
+    files = [f for f in glob.glob(pattern) if os.path.isfile(f)]
+    replaced = set(os.path.basename(f).lower() for f in files)
+
+    # copy Reference study to new study
+    clone_reference_study(source_dir, dest_dir, clone_mode, replaced)
+
+    # copy .dbf files to new study
+    for f in files:
+        dest_file = os.path.join(dest_dir, os.path.basename(f))
+        if os.path.lexists(dest_file):
+            os.remove(dest_file)
+        shutil.copy2(f, dest_file)
+
+
+def create_inm_study_directories(data_path, studies_path, dir_list,
+                                 clone_mode='copy'):
     """
     Creates INM study directories with all the required files to perform a
     complete INM study.
 
+    :param data_path: the folder containing one folder of .dbf files per
+    flight
     :param studies_path: the folder where all study directories will be created
     :param dir_list: list of names of all directories to be created
+    :param clone_mode: how the Reference study is cloned (see CLONE_MODES)
     :return:
     """
     print("Creating study directories...")
     for d in dir_list:
-        source_dir = os.path.join(studies_path, 'Reference')
-        dest_dir = os.path.join(studies_path, d)
-        data_dir = os.path.join(data_path, d)
+        create_inm_study_directory(data_path, studies_path, d, clone_mode)
+        print("Study directory created for %s" % d)
 
-        # create study directory if doesn't already exists
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
 
-        # copy Reference study to new study
-        copy_tree(source_dir, dest_dir)
+def _timed_create_inm_study_directory(data_path, studies_path, d,
+                                      clone_mode, replace=False):
+    """
+    Worker function of the pool: creates one study directory and returns
+    (name, duration, error message or None) instead of raising.
+
+    """
+    start = time.time()
+    try:
+        create_inm_study_directory(data_path, studies_path, d, clone_mode,
+                                   replace)
+        error = None
+    except (OSError, shutil.Error) as err:
+        error = '%s: %s' % (type(err).__name__, err)
+    return d, time.time() - start, error
 
-        # copy .dbf files to new study
-        files = glob.iglob(os.path.join(data_dir, '*.dbf'))
-        for f in files:
-            if os.path.isfile(f):
-                shutil.copy2(f, dest_dir)
 
-        print("Study directory created for %s" % d)
+def create_inm_study_directories_parallel(data_path, studies_path, dir_list,
+                                          clone_mode='copy', jobs=None,
+                                          pool='thread', replace=False):
+    """
+    Creates INM study directories concurrently with a pool of workers. A
+    failing study is reported and does not abort the batch.
+
+    :param data_path: the folder containing one folder of .dbf files per
+    flight
+    :param studies_path: the folder where all study directories will be created
+    :param dir_list: list of names of all directories to be created
+    :param clone_mode: how the Reference study is cloned (see CLONE_MODES)
+    :param jobs: number of workers (defaults to the number of CPUs)
+    :param pool: 'thread' or 'process'
+    :param replace: swap each study directory with a freshly built one (see
+    create_inm_study_directory)
+    :return: dictionary with the succeeded and failed studies and timings
+    """
+    if pool == 'thread':
+        executor_class = concurrent.futures.ThreadPoolExecutor
+    elif pool == 'process':
+        executor_class = concurrent.futures.ProcessPoolExecutor
+    else:
+        raise ValueError("Unknown pool type '%s'" % pool)
+    jobs = jobs or os.cpu_count() or 1
+
+    print("Creating study directories with %d %s workers..." % (jobs, pool))
+    start = time.time()
+    succeeded = []
+    failed = {}
+    durations = []
+    with executor_class(max_workers=jobs) as executor:
+        futures = [executor.submit(_timed_create_inm_study_directory,
+                                   data_path, studies_path, d, clone_mode,
+                                   replace)
+                   for d in dir_list]
+        for future in concurrent.futures.as_completed(futures):
+            d, duration, error = future.result()
+            durations.append(duration)
+            if error is None:
+                succeeded.append(d)
+                print("Study directory created for %s" % d)
+            else:
+                failed[d] = error
+                print("Study directory FAILED for %s (%s)" % (d, error))
+
+    total_time = time.time() - start
+    stats = {
+        'jobs': jobs,
+        'pool': pool,
+        'succeeded': sorted(succeeded),
+        'failed': failed,
+        'total_time': total_time,
+        'mean_study_time': sum(durations) / len(durations) if durations
+        else 0.0,
+        'max_study_time': max(durations) if durations else 0.0,
+        'studies_per_second': len(durations) / total_time if total_time
+        else 0.0,
+    }
+    print("%d study directories created, %d failed in %.2f s"
+          % (len(succeeded), len(failed), total_time))
+    return stats
+
+
+def hash_file(path, block_size=1 << 20):
+    """
+    Returns the SHA-1 hex digest of a file.
+
+    :param path: path to the file
+    :param block_size: size of the blocks read at once
+    :return:
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def fingerprint_files(paths, known=None):
+    """
+    Returns the size, mtime and SHA-1 of each file. A file whose size and
+    mtime match its entry in known is not hashed again.
+
+    :param paths: dictionary {key: path to the file}
+    :param known: previous fingerprints {key: {'size', 'mtime', 'sha1'}}
+    :return: dictionary {key: {'size', 'mtime', 'sha1'}}
+    """
+    known = known or {}
+    result = {}
+    for key, path in paths.items():
+        st = os.stat(path)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime}
+        previous = known.get(key)
+        if (previous and previous['size'] == entry['size'] and
+                previous['mtime'] == entry['mtime']):
+            entry['sha1'] = previous['sha1']
+        else:
+            entry['sha1'] = hash_file(path)
+        result[key] = entry
+    return result
+
+
+def get_reference_files(source_dir):
+    """
+    Returns {relative path: path} for every file of the Reference study.
+
+    :param source_dir: the Reference study directory
+    :return:
+    """
+    result = {}
+    for root, dirs, files in os.walk(source_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, source_dir).replace('\\', '/')
+            result[rel_path] = path
+    return result
+
+
+def get_flight_files(data_dir):
+    """
+    Returns {file name: path} for every .dbf file of a flight folder.
+
+    :param data_dir: the flight folder
+    :return:
+    """
+    pattern = os.path.join(data_dir, '*.[dD][bB][fF]')
+    return dict((os.path.basename(f), f) for f in glob.glob(pattern)
+                if os.path.isfile(f))
+
+
+def read_manifest(study_dir):
+    """
+    Returns the manifest of a study directory or None if it has none (or an
+    unreadable one).
+
+    :param study_dir: the study directory
+    :return:
+    """
+    try:
+        with open(os.path.join(study_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(study_dir, manifest):
+    """
+    Atomically writes the manifest of a study directory.
+
+    :param study_dir: the study directory
+    :param manifest: the manifest dictionary
+    :return:
+    """
+    path = os.path.join(study_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _same_inputs(manifest, reference, flight):
+    """
+    Returns True if the manifest records the same Reference and flight
+    file contents.
+
+    """
+    def hashes(fingerprints):
+        return dict((k, v['sha1']) for k, v in fingerprints.items())
+
+    return (hashes(manifest['reference']) == hashes(reference) and
+            hashes(manifest['flight']) == hashes(flight))
+
+
+def _study_matches(study_dir, reference, flight):
+    """
+    Returns True if a study directory holds the given Reference and flight
+    file contents (the files INM writes to are not compared).
+
+    """
+    replaced = set(name.lower() for name in flight)
+    expected = dict((rel_path, entry['sha1'])
+                    for rel_path, entry in reference.items()
+                    if rel_path.lower() not in replaced and
+                    not is_inm_writable(rel_path))
+    expected.update((name, entry['sha1']) for name, entry in flight.items())
+    for rel_path, sha1 in expected.items():
+        path = os.path.join(study_dir, rel_path)
+        if not os.path.isfile(path) or hash_file(path) != sha1:
+            return False
+    return True
+
+
+def sync_inm_study_directories(data_path, studies_path, dir_list,
+                               clone_mode='copy', jobs=1, pool='thread'):
+    """
+    Brings the study directories up to date with the Reference study and
+    the flight folders. Only studies that are new or whose inputs changed
+    are (re)built, and managed studies whose flight folder disappeared are
+    deleted. Inputs are tracked through a manifest in each study directory.
+    A study directory without a manifest (e.g. made before manifests
+    existed) is adopted as it is if it holds the current inputs, and
+    rebuilt otherwise. Rebuilt studies keep their output directories.
+
+    :param data_path: the folder containing one folder of .dbf files per
+    flight
+    :param studies_path: the folder where all study directories are created
+    :param dir_list: list of names of the flight folders
+    :param clone_mode: how the Reference study is cloned (see CLONE_MODES)
+    :param jobs: number of workers used to build the studies
+    :param pool: 'thread' or 'process'
+    :return: dictionary listing the created, adopted, updated, deleted,
+    unchanged and failed studies
+    """
+    print("Synchronising study directories...")
+    source_dir = os.path.join(studies_path, 'Reference')
+    dir_list = [d for d in dir_list if d != 'Reference']
+
+    manifests = {}
+    for d in get_immediate_subdirectories(studies_path):
+        manifest = read_manifest(os.path.join(studies_path, d))
+        if manifest is not None:
+            manifests[d] = manifest
+
+    # fingerprint Reference once, reusing hashes recorded by any study
+    known = {}
+    for manifest in manifests.values():
+        known.update(manifest['reference'])
+    reference = fingerprint_files(get_reference_files(source_dir), known)
+
+    result = {'created': [], 'adopted': [], 'updated': [], 'deleted': [],
+              'unchanged': [], 'failed': {}}
+    to_build = {}
+    for d in dir_list:
+        study_dir = os.path.join(studies_path, d)
+        manifest = manifests.get(d)
+        flight = fingerprint_files(
+            get_flight_files(os.path.join(data_path, d)),
+            manifest['flight'] if manifest else None)
+        new_manifest = {'version': MANIFEST_VERSION, 'study': d,
+                        'clone_mode': clone_mode, 'reference': reference,
+                        'flight': flight}
+        if manifest is None and os.path.isdir(study_dir):
+            if _study_matches(study_dir, reference, flight):
+                write_manifest(study_dir, new_manifest)
+                result['adopted'].append(d)
+                print("Study directory adopted for %s" % d)
+                continue
+            result['updated'].append(d)
+        elif manifest is None:
+            result['created'].append(d)
+        elif (not _same_inputs(manifest, reference, flight) or
+              manifest.get('clone_mode') != clone_mode):
+            result['updated'].append(d)
+        else:
+            result['unchanged'].append(d)
+            continue
+        to_build[d] = new_manifest
+
+    # remove managed studies whose flight folder no longer exists
+    for d in sorted(set(manifests) - set(dir_list)):
+        shutil.rmtree(os.path.join(studies_path, d))
+        result['deleted'].append(d)
+        print("Study directory deleted for %s" % d)
+
+    # studies are built aside and swapped in once complete, so that stale
+    # files do not survive a rebuild and a failed rebuild leaves the
+    # previous study in place
+    if jobs == 1:
+        built = []
+        for d in sorted(to_build):
+            _, _, error = _timed_create_inm_study_directory(
+                data_path, studies_path, d, clone_mode, True)
+            if error is None:
+                built.append(d)
+                print("Study directory created for %s" % d)
+            else:
+                result['failed'][d] = error
+                print("Study directory FAILED for %s (%s)" % (d, error))
+    else:
+        stats = create_inm_study_directories_parallel(
+            data_path, studies_path, sorted(to_build), clone_mode, jobs,
+            pool, True)
+        built = stats['succeeded']
+        result['failed'].update(stats['failed'])
+
+    for d in built:
+        write_manifest(os.path.join(studies_path, d), to_build[d])
+    for key in ('created', 'updated'):
+        result[key] = [d for d in result[key] if d not in result['failed']]
+
+    print("%d created, %d adopted, %d updated, %d deleted, %d unchanged, "
+          "%d failed"
+          % (len(result['created']), len(result['adopted']),
+             len(result['updated']),
+             len(result['deleted']), len(result['unchanged']),
+             len(result['failed'])))
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Create one INM study per flight folder.')
+    parser.add_argument('--clone-mode', choices=CLONE_MODES, default='copy',
+                        help='how the Reference study is cloned')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of study directories built '
+                             'concurrently (0: one per CPU)')
+    parser.add_argument('--pool', choices=('thread', 'process'),
+                        default='thread',
+                        help='type of worker pool used when jobs != 1')
+    parser.add_argument('--full', action='store_true',
+                        help='rebuild every study instead of only the '
+                             'studies whose inputs changed')
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
+
     # Set path to input data and INM study folders (.dbf files)
     data_path = os.path.join('INM Files', 'MCDP Flight Trials')
     studies_path = 'INM Studies'
 
     # Get
     dir_list = get_immediate_subdirectories(data_path)
-    create_inm_study_directories(data_path, studies_path, dir_list)
+    if not args.full:
+        sync_inm_study_directories(data_path, studies_path, dir_list,
+                                   args.clone_mode, args.jobs or None,
+                                   args.pool)
+    elif args.jobs == 1:
+        create_inm_study_directories(data_path, studies_path, dir_list,
+                                     args.clone_mode)
+    else:
+        create_inm_study_directories_parallel(
+            data_path, studies_path, dir_list, args.clone_mode,
+            args.jobs or None, args.pool)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,395 @@
+# Benchmark of the INMStudy pipeline.
+#
+# Drives INMStudy.run_scenario many times against the simulated INM
+# (inmsim) and records, for every INMAuto method, the wall-clock time and
+# the number of GUI calls of each invocation. Latency percentiles and
+# histograms are written to a JSON report; --compare flags the methods that
+# got slower than in a previous report.
+#
+# Example:
+#   python benchmark_inmstudy.py -n 50 --scenario full -o bench.json
+#   python benchmark_inmstudy.py -n 50 --compare bench.json
+
+import argparse
+import functools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import inmauto
+import inmbatch
+import inmsim
+
+__author__ = 'Thomas Vandenhede'
+
+# Latencies (s) of the simulated INM, in the order of magnitude of the real
+# GUI on a desktop machine
+REALISTIC_LATENCIES = {
+    'start': 0.05,
+    'menu': 0.002,
+    'control': 0.001,
+    'query': 0.0002,
+    'render': 0.01,
+    'run': 0.05,
+    'export': 0.002,
+}
+
+# Histogram bin edges (s): 4 logarithmic bins per decade from 10 us to 1000 s
+HISTOGRAM_EDGES = [10 ** (k / 4.0) for k in range(-20, 13)]
+
+
+def make_scenario(name):
+    """
+    Returns (grids, run_options, export_options) of a named benchmark
+    scenario:
+    - 'minimal': one location grid, single metric run, no export
+    - 'grids': several standard and detailed grids, grid exports
+    - 'full': grids, points and contours with every export
+
+    :param name: the scenario name
+    :return:
+    """
+    run_options = inmauto.RunOptions()
+    run_options.noise_metric = 'SEL'
+    export_options = None
+    grids = [inmauto.GridSetup()]
+
+    if name in ('grids', 'full'):
+        for k in range(3):
+            grid = inmauto.GridSetup()
+            grid.grid_type = 'Standard' if k < 2 else 'Detailed'
+            grid.grid_id = 'G%d' % (k + 1)
+            grid.x, grid.y, grid.i, grid.j = -4.0, -4.0, 0.25, 0.25
+            grid.nb_pts_i, grid.nb_pts_j = 33, 33
+            grids.append(grid)
+        run_options.do_standard_grids = True
+        run_options.do_detailed_grids = True
+        export_options = inmauto.ExportOptions()
+        export_options.file_type = 'Comma Delimited (*.csv)'
+        export_options.standard_grids = True
+        export_options.detailed_grids = True
+
+    if name == 'full':
+        run_options.do_contours = True
+        run_options.do_population_points = True
+        run_options.do_location_points = True
+        run_options.sel = True
+        run_options.lamax = True
+        export_options.contour_points = True
+        export_options.contour_area_and_pop = True
+        export_options.noise_at_pop_points = True
+        export_options.noise_at_loc_points = True
+        export_options.flight_path_report = True
+    elif name not in ('minimal', 'grids'):
+        raise ValueError("Unknown scenario '%s'" % name)
+
+    return grids, run_options, export_options
+
+
+class MethodRecorder(object):
+    """
+    Records the duration and GUI call count of every call of the public
+    methods of an INMAuto instance. Nested calls (e.g. export_output
+    calling export_standard_grids) are recorded for both methods.
+
+    """
+    def __init__(self, inm):
+        self.samples = {}
+        self.attach(inm)
+
+    def attach(self, inm):
+        """
+        Records the methods of inm from now on (e.g. a new INMAuto instance
+        replacing one left in an unknown state). Samples and wait statistics
+        accumulate across instances.
+
+        :param inm: INMAuto instance
+        :return:
+        """
+        if getattr(self, 'inm', None) is not None:
+            inm.wait_stats = self.inm.wait_stats
+        self.inm = inm
+        for name in dir(type(inm)):
+            if name.startswith('_') or not callable(getattr(inm, name)):
+                continue
+            setattr(inm, name, self._wrap(name, getattr(inm, name)))
+
+    def _wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            calls = self.inm.backend.total_calls
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.samples.setdefault(name, []).append(
+                    (time.time() - start,
+                     self.inm.backend.total_calls - calls))
+        return wrapper
+
+
+def percentile(sorted_values, q):
+    """
+    Returns the q-th percentile (0-100) of sorted values, interpolating
+    linearly between the closest ranks.
+
+    :param sorted_values: list of values in increasing order
+    :param q: the percentile
+    :return:
+    """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return (sorted_values[lower] * (1 - fraction) +
+            sorted_values[upper] * fraction)
+
+
+def histogram(values, edges=HISTOGRAM_EDGES):
+    """
+    Returns the number of values in each bin [edges[k], edges[k + 1]).
+    Values below the first edge go into the first bin and values above the
+    last edge into the last one.
+
+    :param values: the values
+    :param edges: increasing bin edges
+    :return:
+    """
+    counts = [0] * (len(edges) - 1)
+    for value in values:
+        k = 0
+        while k < len(counts) - 1 and value >= edges[k + 1]:
+            k += 1
+        counts[k] += 1
+    return counts
+
+
+def summarise(samples):
+    """
+    Computes the statistics of the samples of one method.
+
+    :param samples: list of (duration, GUI calls)
+    :return: dictionary of statistics
+    """
+    durations = sorted(d for d, c in samples)
+    calls = [c for d, c in samples]
+    return {
+        'count': len(samples),
+        'total_s': sum(durations),
+        'mean_s': sum(durations) / len(durations),
+        'min_s': durations[0],
+        'p50_s': percentile(durations, 50),
+        'p90_s': percentile(durations, 90),
+        'p95_s': percentile(durations, 95),
+        'p99_s': percentile(durations, 99),
+        'max_s': durations[-1],
+        'gui_calls_total': sum(calls),
+        'gui_calls_mean': sum(calls) / float(len(calls)),
+        'histogram': histogram(durations),
+    }
+
+
+def run_benchmark(iterations, scenario='full', latencies=None,
+                  failure_rates=None, studies=4, seed=0, recycle_after=0,
+                  **run_kwargs):
+    """
+    Runs INMStudy.run_scenario iterations times on the simulated INM, over
+    a pool of study directories created in a temporary workspace. A failed
+    iteration is counted in the report and the benchmark goes on with a new
+    INMAuto instance (or, with a session, a restarted INM).
+
+    :param iterations: number of scenario runs
+    :param scenario: name of the scenario (see make_scenario)
+    :param latencies: latencies of the simulated INM
+    :param failure_rates: failure injection of the simulated INM
+    :param studies: number of distinct study directories
+    :param seed: seed of the failure injection
+    :param recycle_after: if not 0, run the studies in an inmbatch.INMSession
+    restarting INM after recycle_after studies (None: never)
+    :param run_kwargs: extra arguments of INMStudy.run_scenario
+    :return: the benchmark report (dictionary)
+    """
+    grids, run_options, export_options = make_scenario(scenario)
+    backend = inmsim.SimulatedBackend(latencies, failure_rates, seed)
+    workspace = tempfile.mkdtemp(prefix='inm_bench_')
+    cwd = os.getcwd()
+    recorder = MethodRecorder(inmauto.INMAuto('inm.exe', backend))
+    session = None
+    if recycle_after != 0:
+        session = inmbatch.INMSession('inm.exe', recycle_after=recycle_after,
+                                      inm=recorder.inm)
+    scenario_durations = []
+    errors = {}
+    try:
+        os.chdir(workspace)
+        names = ['BENCH_%03d' % k for k in range(studies)]
+        for name in names:
+            os.makedirs(os.path.join('INM Studies', name))
+
+        for k in range(iterations):
+            start = time.time()
+            if session is None:
+                study = inmauto.INMStudy('inm.exe', names[k % studies],
+                                         inm=recorder.inm)
+                try:
+                    study.run_scenario(grids, run_options, export_options,
+                                       **run_kwargs)
+                    error = None
+                except Exception as err:
+                    error = '%s: %s' % (type(err).__name__, err)
+                    # the state of INM is unknown: start over
+                    backend.kill_inm()
+                    recorder.attach(inmauto.INMAuto('inm.exe', backend))
+            else:
+                result = session.run_scenario(
+                    names[k % studies], grids, run_options, export_options,
+                    **run_kwargs)
+                error = None if result['succeeded'] else result['error']
+            if error is None:
+                scenario_durations.append((time.time() - start, 0))
+            else:
+                print('Iteration %d FAILED (%s)' % (k, error))
+                errors[error] = errors.get(error, 0) + 1
+    finally:
+        os.chdir(cwd)
+        if session is not None:
+            session.close()
+        backend.kill_inm()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    methods = dict((name, summarise(samples))
+                   for name, samples in recorder.samples.items())
+    if scenario_durations:
+        methods['run_scenario'] = summarise(scenario_durations)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': iterations,
+        'failed_iterations': sum(errors.values()),
+        'errors': errors,
+        'scenario': scenario,
+        'run_options': dict((k, v) for k, v in run_kwargs.items()),
+        'recycle_after': recycle_after,
+        'inm_starts': backend.starts,
+        'latencies': backend.latencies,
+        'failure_rates': backend.failure_rates,
+        'injected_failures': dict(backend.failures),
+        'gui_calls': dict(backend.calls),
+        'waits': recorder.inm.wait_stats.as_dict(),
+        'histogram_edges_s': HISTOGRAM_EDGES,
+        'methods': methods,
+    }
+
+
+def compare_reports(baseline, report, threshold=1.2):
+    """
+    Returns the methods whose p50 or p95 latency or mean GUI call count grew
+    by more than threshold (ratio) compared to the baseline report.
+
+    :param baseline: previous report
+    :param report: new report
+    :param threshold: ratio above which a change is a regression
+    :return: list of (method, statistic, baseline value, new value)
+    """
+    regressions = []
+    for name, stats in sorted(report['methods'].items()):
+        old = baseline['methods'].get(name)
+        if old is None:
+            continue
+        for key in ('p50_s', 'p95_s', 'gui_calls_mean'):
+            if old[key] and stats[key] > old[key] * threshold:
+                regressions.append((name, key, old[key], stats[key]))
+    return regressions
+
+
+def print_report(report):
+    print('%-40s %6s %10s %10s %10s %8s' % (
+        'method', 'count', 'p50 (ms)', 'p95 (ms)', 'max (ms)', 'calls'))
+    for name, stats in sorted(report['methods'].items(),
+                              key=lambda item: -item[1]['total_s']):
+        print('%-40s %6d %10.2f %10.2f %10.2f %8.1f' % (
+            name, stats['count'], 1000 * stats['p50_s'],
+            1000 * stats['p95_s'], 1000 * stats['max_s'],
+            stats['gui_calls_mean']))
+    if report['failed_iterations']:
+        print('%d of %d iterations failed'
+              % (report['failed_iterations'], report['iterations']))
+
+
+def parse_key_values(items, cast=float):
+    result = {}
+    for item in items or []:
+        key, value = item.split('=', 1)
+        result[key] = cast(value)
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark INMStudy.run_scenario on a simulated INM.')
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('--scenario', default='full',
+                        choices=('minimal', 'grids', 'full'))
+    parser.add_argument('--studies', type=int, default=4,
+                        help='number of distinct study directories')
+    parser.add_argument('--latency', action='append', metavar='CATEGORY=S',
+                        help='override a simulated latency (see inmsim)')
+    parser.add_argument('--ideal', action='store_true',
+                        help='zero latencies: measures the Python overhead')
+    parser.add_argument('--failure-rate', action='append',
+                        metavar='CALL=P', help='inject GUI failures')
+    parser.add_argument('--files', action='store_true',
+                        help='write grids and run options to the study '
+                             'tables instead of using the dialogs')
+    parser.add_argument('--watch-outputs', action='store_true',
+                        help='detect the end of runs from the output files')
+    parser.add_argument('--session', action='store_true',
+                        help='keep INM running across studies')
+    parser.add_argument('--recycle-after', type=int, default=None,
+                        help='with --session, restart INM after N studies')
+    parser.add_argument('-o', '--output', default='bench_inmstudy.json')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='previous report to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    latencies = {} if args.ideal else dict(REALISTIC_LATENCIES)
+    latencies.update(parse_key_values(args.latency))
+    run_kwargs = {}
+    if args.files:
+        run_kwargs = {'grids_to_file': True, 'run_options_to_file': True}
+    if args.watch_outputs:
+        run_kwargs['watch_outputs'] = True
+
+    report = run_benchmark(args.iterations, args.scenario, latencies,
+                           parse_key_values(args.failure_rate),
+                           args.studies,
+                           recycle_after=args.recycle_after if args.session
+                           else 0, **run_kwargs)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print_report(report)
+    print('Report written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.threshold)
+        for name, key, old, new in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g' % (name, key, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
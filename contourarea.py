@@ -0,0 +1,235 @@
+# Contour area and population computed from exported contour points.
+#
+# The 'Contour Area and Pop' and 'Area Contour Coverage' outputs of INM are
+# only available through the GUI. This module computes the same table
+# (LEVEL, AREA, POP) from the contour points and population points exported
+# by a study:
+# - the area of each contour ring is given by the shoelace formula,
+#   evaluated for every ring at once;
+# - a population point counts for a level if it lies inside the contours of
+#   that level (even-odd rule over the rings of the level, so that rings
+#   nested in others are holes), tested with arrays of points and edges,
+#   band by band along y.
+#
+# Areas are in the square of the unit of the coordinates (nmi for INM
+# exports).
+#
+# Usage:
+#   python contourarea.py SEL [--studies-path PATH] [-j JOBS] [-o areas.csv]
+
+import argparse
+import concurrent.futures
+import os
+
+import numpy as np
+
+import inmoutputs
+from CreateINMStudy import get_immediate_subdirectories
+
+__author__ = 'Thomas Vandenhede'
+
+AREA_DTYPE = [('LEVEL', np.float64), ('AREA', np.float64),
+              ('POP', np.float64)]
+# points_in_rings: number of bands along y and of points x edges tested at
+# a time
+BANDS = 256
+CHUNK_SIZE = 1 << 22
+
+
+def _ring_edges(rings):
+    """
+    Returns the start and end points of the edges of rings, and the ring of
+    each edge. A ring given with its first point repeated at the end is
+    closed once only.
+
+    """
+    rings = [r[:-1] if len(r) > 1 and (r[0] == r[-1]).all() else r
+             for r in rings]
+    start = np.concatenate(rings) if rings else np.zeros((0, 2))
+    ring_id = np.repeat(np.arange(len(rings)), [len(r) for r in rings])
+    # next point of each point, wrapping around within each ring
+    first = np.r_[0, np.cumsum([len(r) for r in rings])[:-1]].astype(int)
+    following = np.arange(len(start)) + 1
+    last = following == np.r_[first[1:], len(start)][ring_id]
+    following[last] = first[ring_id[last]]
+    return start, start[following], ring_id
+
+
+def ring_areas(rings):
+    """
+    Computes the signed area of rings with the shoelace formula (positive
+    for counter-clockwise rings).
+
+    :param rings: list of (n, 2) arrays of x, y
+    :return: array of areas, one per ring
+    """
+    start, end, ring_id = _ring_edges(rings)
+    cross = start[:, 0] * end[:, 1] - end[:, 0] * start[:, 1]
+    return 0.5 * np.bincount(ring_id, cross, minlength=len(rings))
+
+
+def points_in_rings(points, rings):
+    """
+    Tests whether points are inside rings, with the even-odd rule: a point
+    inside two nested rings is outside (hole).
+
+    :param points: (m, 2) array of x, y
+    :param rings: list of (n, 2) arrays of x, y
+    :return: array of m booleans
+    """
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    start, end, ring_id = _ring_edges(rings)
+    inside = np.zeros(len(points), bool)
+    if not len(start) or not len(points):
+        return inside
+    x1, y1 = start[:, 0], start[:, 1]
+    x2, y2 = end[:, 0], end[:, 1]
+    # x of the intersection of each edge with a horizontal line is
+    # x1 + (y - y1) * slope (edges crossing the line only)
+    slope = np.divide(x2 - x1, y2 - y1, out=np.zeros(len(start)),
+                      where=y2 != y1)
+    low, high = np.minimum(y1, y2), np.maximum(y1, y2)
+
+    # the points are tested band by band (along y), against the edges that
+    # reach into their band only
+    candidate = ((points[:, 0] >= min(x1.min(), x2.min())) &
+                 (points[:, 0] <= max(x1.max(), x2.max())) &
+                 (points[:, 1] >= low.min()) & (points[:, 1] <= high.max()))
+    bands = max(1, min(BANDS, len(start) // 8))
+    edges = np.linspace(low.min(), high.max(), bands + 1)
+    band = np.clip(np.searchsorted(edges, points[:, 1], 'right') - 1, 0,
+                   bands - 1)
+    first_band = np.searchsorted(edges, low, 'right') - 1
+    last_band = np.searchsorted(edges, high, 'right') - 1
+    for b in np.unique(band[candidate]):
+        indexes = np.flatnonzero(candidate & (band == b))
+        e = np.flatnonzero((first_band <= b) & (last_band >= b))
+        step = max(1, CHUNK_SIZE // max(1, len(e)))
+        for k in range(0, len(indexes), step):
+            chunk = indexes[k:k + step]
+            px, py = points[chunk, 0:1], points[chunk, 1:2]
+            crosses = ((y1[e] > py) != (y2[e] > py)) & \
+                (px < x1[e] + (py - y1[e]) * slope[e])
+            inside[chunk] = crosses.sum(axis=1) % 2 == 1
+    return inside
+
+
+def contour_area_and_pop(contour_points, pop_points=None):
+    """
+    Computes the area and population of each contour level.
+
+    :param contour_points: structured array of a 'contour_points' output
+    (LEVEL, CONTOUR, POINT, X, Y)
+    :param pop_points: structured array of a 'pop_points' output (X, Y,
+    POP), no population if None
+    :return: structured array (LEVEL, AREA, POP), one record per level
+    """
+    rings = inmoutputs.contour_rings(contour_points)
+    levels = np.array([level for level, contour, xy in rings])
+    xy = [xy for level, contour, xy in rings]
+    areas = np.abs(ring_areas(xy))
+
+    result = np.zeros(len(np.unique(levels)), AREA_DTYPE)
+    for k, level in enumerate(np.unique(levels)):
+        indexes = np.flatnonzero(levels == level)
+        level_rings = [xy[n] for n in indexes]
+        # rings inside an odd number of the other rings are holes
+        depth = np.array([
+            points_in_rings(level_rings[n][:1], level_rings[:n] +
+                            level_rings[n + 1:])[0]
+            for n in range(len(level_rings))])
+        result['LEVEL'][k] = level
+        result['AREA'][k] = np.sum(np.where(depth, -1, 1) * areas[indexes])
+        if pop_points is not None and len(pop_points):
+            inside = points_in_rings(
+                np.stack([pop_points['X'], pop_points['Y']], axis=1),
+                level_rings)
+            result['POP'][k] = pop_points['POP'][inside].sum()
+    return result
+
+
+def study_contour_area_and_pop(path_to_study, metric):
+    """
+    Computes the contour area and population table of a study from its
+    exported contour points and population points.
+
+    :return: (structured array, None) or (None, error message)
+    """
+    try:
+        outputs = inmoutputs.read_study_outputs(path_to_study, metric)
+    except (IOError, OSError, ValueError) as err:
+        return None, '%s: %s' % (type(err).__name__, err)
+    if 'contour_points' not in outputs:
+        return None, 'no contour points exported for %s' % metric
+    return contour_area_and_pop(outputs['contour_points'],
+                                outputs.get('pop_points')), None
+
+
+def _study_contour_area_and_pop(args):
+    return study_contour_area_and_pop(*args)
+
+
+def batch_contour_area_and_pop(studies_path, studies, metric, jobs=None):
+    """
+    Computes the contour area and population table of many studies with a
+    pool of processes.
+
+    :param studies_path: the folder of the study directories
+    :param studies: list of study names
+    :param metric: the noise metric (name of the OUTPUT1 sub-directory)
+    :param jobs: number of processes (defaults to the number of CPUs)
+    :return: ({study: table}, {study: error message})
+    """
+    jobs = jobs or os.cpu_count() or 1
+    tasks = [(os.path.join(studies_path, s), metric) for s in studies]
+    if jobs == 1 or len(tasks) < 2:
+        outputs = [_study_contour_area_and_pop(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs) as executor:
+            outputs = list(executor.map(
+                _study_contour_area_and_pop, tasks,
+                chunksize=max(1, len(tasks) // (4 * jobs))))
+    tables, errors = {}, {}
+    for study, (table, error) in zip(studies, outputs):
+        if table is None:
+            errors[study] = error
+        else:
+            tables[study] = table
+    return tables, errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Contour area and population of every study, from its '
+                    'exported contour points and population points.')
+    parser.add_argument('metric', help='noise metric, e.g. DNL')
+    parser.add_argument('--studies-path', default='INM Studies')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of processes (0: one per CPU)')
+    parser.add_argument('-o', '--output', help='write the tables of every '
+                                               'study to a .csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    studies = sorted(d for d in get_immediate_subdirectories(
+        args.studies_path) if d != 'Reference')
+    tables, errors = batch_contour_area_and_pop(
+        args.studies_path, studies, args.metric, args.jobs or None)
+    for study, error in sorted(errors.items()):
+        print('%s skipped: %s' % (study, error))
+    print('Contour area and population computed for %d studies'
+          % len(tables))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('STUDY,LEVEL,AREA,POP\n')
+            for study, table in sorted(tables.items()):
+                for level, area, pop in table.tolist():
+                    f.write('%s,%.1f,%.4f,%g\n' % (study, level, area, pop))
+        print('Tables written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# Columnar NumPy loader for INM dBase tables (flight tracks, profile points).
+#
+# A table is decoded into a NumPy structured array with one column per
+# field. The whole record buffer is parsed at once: each field is sliced out
+# of a (records x record length) byte matrix and converted with vectorised
+# NumPy operations, so no Python code runs per record.
+#
+# Decoded tables can be cached on disk as .npy files named after the hash of
+# the source table, so a table is only parsed again when its content
+# changes.
+
+import glob
+import hashlib
+import io
+import os
+
+import numpy as np
+
+from inmdbf import DBFHeader, DELETED_FLAG, ENCODING
+
+__author__ = 'Thomas Vandenhede'
+
+TRACK_SEGMENTS_TABLE = 'TRK_SEGS.DBF'
+PROFILE_POINTS_TABLE = 'PROF_PTS.DBF'
+
+
+def _decode_numeric(raw, field):
+    """
+    Converts a column of fixed-width numeric strings. Blank values become
+    NaN (or the column stays integer when there are none).
+
+    """
+    text = np.char.strip(raw)
+    blank = (text == b'') | np.char.startswith(text, b'*')
+    if field.decimal_count == 0 and not blank.any():
+        try:
+            return text.astype(np.int64)
+        except ValueError:
+            pass  # e.g. '1.0' in a field declared without decimals
+    result = np.full(len(text), np.nan)
+    result[~blank] = text[~blank].astype(np.float64)
+    return result
+
+
+def _decode_date(raw):
+    """
+    Converts a column of YYYYMMDD strings into datetime64[D] (NaT if blank).
+
+    """
+    text = np.char.strip(raw)
+    blank = text == b''
+    text[blank] = b'19700101'
+    value = text.astype(np.int64)
+    years = (value // 10000 - 1970).astype('timedelta64[Y]')
+    months = (value // 100 % 100 - 1).astype('timedelta64[M]')
+    days = (value % 100 - 1).astype('timedelta64[D]')
+    result = (np.datetime64('1970', 'Y') + years).astype('datetime64[M]')
+    result = (result + months).astype('datetime64[D]') + days
+    result[blank] = np.datetime64('NaT')
+    return result
+
+
+def _decode_column(matrix, field):
+    """
+    Decodes one field from the (records x record length) byte matrix.
+
+    """
+    raw = np.ascontiguousarray(
+        matrix[:, field.offset:field.offset + field.length])
+    raw = raw.view('S%d' % field.length).ravel()
+    if field.type in 'NF':
+        return _decode_numeric(raw, field)
+    if field.type == 'L':
+        return np.isin(raw, [b'T', b't', b'Y', b'y'])
+    if field.type == 'D':
+        return _decode_date(raw)
+    return np.char.rstrip(np.char.decode(raw, ENCODING))
+
+
+def parse_dbf_buffer(data, fields=None, include_deleted=False):
+    """
+    Decodes a whole dBase table held in memory into a structured array.
+
+    :param data: the bytes of the table
+    :param fields: names of the fields to decode (all fields if None)
+    :param include_deleted: keep records flagged as deleted
+    :return: NumPy structured array, one column per field
+    """
+    header = DBFHeader.read(io.BytesIO(data))
+    if fields is None:
+        selected = header.fields
+    else:
+        selected = [header.field_dict[name.upper()] for name in fields]
+
+    available = (len(data) - header.header_length) // header.record_length
+    count = max(0, min(header.record_count, available))
+    matrix = np.frombuffer(data, np.uint8, count * header.record_length,
+                           header.header_length)
+    matrix = matrix.reshape(count, header.record_length)
+    if not include_deleted:
+        matrix = matrix[matrix[:, 0] != ord(DELETED_FLAG)]
+
+    columns = [_decode_column(matrix, f) for f in selected]
+    dtype = [(f.name, c.dtype) for f, c in zip(selected, columns)]
+    result = np.empty(len(matrix), dtype=dtype)
+    for f, column in zip(selected, columns):
+        result[f.name] = column
+    return result
+
+
+def load_dbf_columns(path, fields=None, cache_dir=None):
+    """
+    Loads a dBase table into a NumPy structured array. With cache_dir, the
+    decoded table is stored as a .npy file keyed on the hash of the source
+    file (and on the selected fields) and reused while the table is
+    unchanged.
+
+    :param path: path to the .dbf table
+    :param fields: names of the fields to load (all fields if None)
+    :param cache_dir: directory of the .npy cache (no cache if None)
+    :return: NumPy structured array, one column per field
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if cache_dir is None:
+        return parse_dbf_buffer(data, fields)
+
+    key = hashlib.sha1(data)
+    if fields is not None:
+        key.update(','.join(f.upper() for f in fields).encode(ENCODING))
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_file = os.path.join(cache_dir,
+                              '%s-%s.npy' % (name, key.hexdigest()))
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    result = parse_dbf_buffer(data, fields)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    np.save(cache_file + '.tmp.npy', result)
+    os.replace(cache_file + '.tmp.npy', cache_file)
+    return result
+
+
+def find_table(directory, table_name):
+    """
+    Returns the path of a table in a directory, ignoring the case of its
+    name, or None if there is no such table.
+
+    :param directory: the directory to search
+    :param table_name: the file name of the table
+    :return:
+    """
+    for path in glob.glob(os.path.join(directory, '*')):
+        if os.path.basename(path).lower() == table_name.lower():
+            return path
+    return None
+
+
+def load_track_segments(directory, cache_dir=None):
+    """
+    Loads the track segments table of a flight folder or INM study.
+
+    :param directory: the flight folder or study directory
+    :param cache_dir: directory of the .npy cache (no cache if None)
+    :return:
+    """
+    path = find_table(directory, TRACK_SEGMENTS_TABLE)
+    if path is None:
+        raise IOError("No %s in %s" % (TRACK_SEGMENTS_TABLE, directory))
+    return load_dbf_columns(path, cache_dir=cache_dir)
+
+
+def load_profile_points(directory, cache_dir=None):
+    """
+    Loads the profile points table of a flight folder or INM study.
+
+    :param directory: the flight folder or study directory
+    :param cache_dir: directory of the .npy cache (no cache if None)
+    :return:
+    """
+    path = find_table(directory, PROFILE_POINTS_TABLE)
+    if path is None:
+        raise IOError("No %s in %s" % (PROFILE_POINTS_TABLE, directory))
+    return load_dbf_columns(path, cache_dir=cache_dir)
+
+
+def load_campaign_table(data_path, table_name, cache_dir=None):
+    """
+    Loads the same table from every flight folder of a campaign.
+
+    :param data_path: the folder containing one folder per flight
+    :param table_name: the file name of the table (e.g. PROF_PTS.DBF)
+    :param cache_dir: directory of the .npy cache (no cache if None)
+    :return: dictionary {flight folder name: structured array}
+    """
+    result = {}
+    for d in sorted(os.listdir(data_path)):
+        path = find_table(os.path.join(data_path, d), table_name)
+        if path is not None:
+            result[d] = load_dbf_columns(path, cache_dir=cache_dir)
+    return result
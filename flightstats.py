@@ -0,0 +1,341 @@
+# Statistics across flights of the results exported for each flight study.
+#
+# Each flight of the trials has its own INM study, named after the flight
+# folder (tail number, date and procedure, e.g. CS-TNN_2016-01-05_TP842).
+# load_flight_results reads the grid or point results exported for a metric
+# by every study (in parallel, with a pool of processes) and stacks them
+# into one (flights x receptors) array of levels. The statistics of every
+# receptor across flights, or across the flights of each tail number, date
+# or procedure, are then computed with vectorised NumPy operations.
+#
+# Example:
+#   results = load_flight_results('INM Studies', flights, 'LAMAX')
+#   stats = results.statistics()
+#   by_procedure = results.group_statistics('procedure')
+#
+# Usage:
+#   python flightstats.py SEL [--kind loc_points] [--by procedure]
+#                             [-j JOBS] [-o stats.csv]
+
+import argparse
+import concurrent.futures
+import os
+import re
+
+import numpy as np
+
+import inmoutputs
+from CreateINMStudy import get_immediate_subdirectories
+from inmwatch import RUN_OUTPUT_DIR
+
+__author__ = 'Thomas Vandenhede'
+
+# Flight folder names: <tail number>_<YYYY-MM-DD>_<procedure>
+FLIGHT_NAME_RE = re.compile(r'^(?P<tail>[^_]+)_(?P<date>\d{4}-\d{2}-\d{2})'
+                            r'_(?P<procedure>[^_]+)')
+GROUP_KEYS = ('tail', 'date', 'procedure')
+# Fields identifying a receptor, by output kind
+RECEPTOR_FIELDS = {
+    'standard_grids': ('GRID_ID', 'I', 'J'),
+    'loc_points': ('NAME',),
+    'pop_points': ('NAME',),
+}
+DEFAULT_PERCENTILES = (10, 50, 90)
+
+
+def parse_flight_name(name):
+    """
+    Splits a flight folder name into tail number, date and procedure.
+
+    :param name: the flight folder (or study) name
+    :return: {'tail', 'date', 'procedure'}, None values if the name does not
+    follow the pattern
+    """
+    match = FLIGHT_NAME_RE.match(name)
+    if match is None:
+        return dict((key, None) for key in GROUP_KEYS)
+    return match.groupdict()
+
+
+def receptor_keys(receptors):
+    """
+    Returns one string per receptor (e.g. 'G1/3/12' or 'P01'), built from
+    the receptor fields of the output.
+
+    """
+    key = None
+    for name in receptors.dtype.names:
+        if name in ('X', 'Y', 'POP'):
+            continue
+        column = receptors[name].astype(np.str_)
+        key = column if key is None else np.char.add(
+            np.char.add(key, '/'), column)
+    return key
+
+
+def read_study_levels(path_to_study, metric, kind):
+    """
+    Worker of load_flight_results: reads the levels exported for a metric
+    by a study.
+
+    :return: (receptors, levels) or (None, error message)
+    """
+    output_dir = os.path.join(path_to_study, RUN_OUTPUT_DIR, metric.strip())
+    try:
+        paths = inmoutputs.find_outputs(output_dir, kind)
+        if not paths:
+            return None, 'no %s output in %s' % (kind, output_dir)
+        output = inmoutputs.read_output(paths[0])[1]
+    except (IOError, OSError, ValueError) as err:
+        return None, '%s: %s' % (type(err).__name__, err)
+    names = [n for n in output.dtype.names
+             if n in RECEPTOR_FIELDS[kind] + ('X', 'Y', 'POP')]
+    receptors = np.empty(len(output), [(n, output[n].dtype) for n in names])
+    for name in names:
+        receptors[name] = output[name]
+    return receptors, output[inmoutputs.level_field(output)]
+
+
+def _read_study_levels(args):
+    return read_study_levels(*args)
+
+
+class FlightResults(object):
+    """
+    Levels of a metric at the same receptors for many flights.
+
+    :param flights: list of flight (study) names
+    :param receptors: structured array of the receptors (identifying
+    fields, coordinates)
+    :param levels: (flights x receptors) array, NaN where a study has no
+    level for a receptor
+    :param metric: the noise metric
+    :param kind: the output kind the levels were read from
+    """
+    def __init__(self, flights, receptors, levels, metric=None, kind=None):
+        self.flights = list(flights)
+        self.receptors = receptors
+        self.levels = levels
+        self.metric = metric
+        self.kind = kind
+        self.errors = {}
+
+    def flight_attributes(self, key):
+        """
+        Returns the tail number, date or procedure of every flight.
+
+        :param key: one of GROUP_KEYS
+        :return: array of strings (None where the name does not match)
+        """
+        if key not in GROUP_KEYS:
+            raise ValueError("Unknown group key '%s'" % key)
+        return np.array([parse_flight_name(f)[key] for f in self.flights],
+                        dtype=object)
+
+    def groups(self, key):
+        """
+        Returns {value: indexes of the flights} for a group key.
+
+        """
+        values = self.flight_attributes(key)
+        return dict((value, np.flatnonzero(values == value))
+                    for value in sorted(set(values), key=str))
+
+    def statistics(self, percentiles=DEFAULT_PERCENTILES, flights=None):
+        """
+        Computes the statistics of every receptor across flights, ignoring
+        missing levels.
+
+        :param percentiles: percentiles to compute (0 to 100)
+        :param flights: indexes of the flights to use (all if None)
+        :return: structured array, one record per receptor: count, min, max,
+        mean, energy_mean (10 log10 of the mean of 10^(L/10)), std and
+        p<q> for each percentile
+        """
+        levels = self.levels if flights is None else self.levels[flights]
+        count = (~np.isnan(levels)).sum(axis=0)
+        fields = [('count', np.int64)] + [
+            (name, np.float64) for name in (
+                'min', 'max', 'mean', 'energy_mean', 'std')] + [
+            ('p%g' % q, np.float64) for q in percentiles]
+        result = np.zeros(levels.shape[1], fields)
+        for name, dtype in fields[1:]:
+            result[name] = np.nan
+        result['count'] = count
+        # the NaN-aware functions are much slower: they are only used for
+        # the receptors with missing levels
+        complete = count == len(levels)
+        partial = (count > 0) & ~complete
+        for columns, functions in (
+                (complete, (np.min, np.max, np.mean, np.std,
+                            np.percentile)),
+                (partial, (np.nanmin, np.nanmax, np.nanmean, np.nanstd,
+                           np.nanpercentile))):
+            if not columns.any():
+                continue
+            values = levels[:, columns]
+            for name, function in zip(('min', 'max', 'mean', 'std'),
+                                      functions):
+                result[name][columns] = function(values, axis=0)
+            energy = functions[2](10 ** (values / 10.0), axis=0)
+            result['energy_mean'][columns] = 10 * np.log10(energy)
+            if percentiles:
+                for q, value in zip(percentiles, functions[4](
+                        values, percentiles, axis=0)):
+                    result['p%g' % q][columns] = value
+        return result
+
+    def group_statistics(self, key, percentiles=DEFAULT_PERCENTILES):
+        """
+        Computes the statistics of every receptor across the flights of each
+        tail number, date or procedure.
+
+        :param key: one of GROUP_KEYS
+        :param percentiles: percentiles to compute (0 to 100)
+        :return: {value: statistics (see statistics())}
+        """
+        return dict((value, self.statistics(percentiles, indexes))
+                    for value, indexes in self.groups(key).items())
+
+
+def load_flight_results(studies_path, flights, metric,
+                        kind='standard_grids', jobs=None, pool='process'):
+    """
+    Reads the levels exported for a metric by the study of every flight and
+    stacks them. The receptors are those of the first study read; receptors
+    that other studies do not have get NaN levels, receptors found in other
+    studies only are ignored.
+
+    :param studies_path: the folder of the study directories
+    :param flights: list of flight (study) names
+    :param metric: the noise metric (name of the OUTPUT1 sub-directory)
+    :param kind: output kind (see RECEPTOR_FIELDS)
+    :param jobs: number of workers (defaults to the number of CPUs, 1 reads
+    the studies in this process)
+    :param pool: 'process' or 'thread'
+    :return: FlightResults (the studies that could not be read are left
+    out and listed in its errors)
+    """
+    if kind not in RECEPTOR_FIELDS:
+        raise ValueError("Unknown output kind '%s'" % kind)
+    jobs = jobs or os.cpu_count() or 1
+    tasks = [(os.path.join(studies_path, f), metric, kind) for f in flights]
+    if jobs == 1 or len(tasks) < 2:
+        outputs = [_read_study_levels(task) for task in tasks]
+    else:
+        executor_class = concurrent.futures.ProcessPoolExecutor \
+            if pool == 'process' else concurrent.futures.ThreadPoolExecutor
+        with executor_class(max_workers=jobs) as executor:
+            outputs = list(executor.map(
+                _read_study_levels, tasks,
+                chunksize=max(1, len(tasks) // (4 * jobs))))
+
+    errors = dict((f, error) for f, (receptors, error) in
+                  zip(flights, outputs) if receptors is None)
+    read = [(f, receptors, levels) for f, (receptors, levels) in
+            zip(flights, outputs) if receptors is not None]
+    if not read:
+        results = FlightResults([], np.zeros(0), np.zeros((0, 0)), metric,
+                                kind)
+        results.errors = errors
+        return results
+
+    reference = read[0][1]
+    keys = receptor_keys(reference)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    matrix = np.full((len(read), len(reference)), np.nan)
+    for row, (flight, receptors, levels) in enumerate(read):
+        if len(receptors) == len(reference) and \
+                np.array_equal(receptors[list(RECEPTOR_FIELDS[kind])],
+                               reference[list(RECEPTOR_FIELDS[kind])]):
+            matrix[row] = levels
+            continue
+        # receptors in another order, or missing: align on the keys
+        study_keys = receptor_keys(receptors)
+        position = np.searchsorted(sorted_keys, study_keys)
+        position[position == len(sorted_keys)] = 0
+        found = sorted_keys[position] == study_keys
+        matrix[row, order[position[found]]] = levels[found]
+
+    results = FlightResults([f for f, _, _ in read], reference, matrix,
+                            metric, kind)
+    results.errors = errors
+    return results
+
+
+def write_statistics_csv(path, results, statistics, group_key=None):
+    """
+    Writes per-receptor statistics into a .csv file.
+
+    :param path: the .csv file
+    :param results: FlightResults the statistics were computed from
+    :param statistics: statistics() result, or {value: statistics()} with
+    group_key
+    :param group_key: name of the group column (no such column if None)
+    """
+    if group_key is None:
+        statistics = {None: statistics}
+    receptor_names = list(results.receptors.dtype.names)
+    with open(path, 'w') as f:
+        header = receptor_names + list(
+            next(iter(statistics.values())).dtype.names)
+        if group_key:
+            header.insert(0, group_key.upper())
+        f.write(','.join(header) + '\n')
+        for value, stats in sorted(statistics.items(), key=lambda i:
+                                   str(i[0])):
+            for receptor, record in zip(results.receptors.tolist(),
+                                        stats.tolist()):
+                row = list(receptor) + ['%.2f' % v if isinstance(v, float)
+                                        else v for v in record]
+                if group_key:
+                    row.insert(0, value)
+                f.write(','.join(str(v) for v in row) + '\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Statistics of the exported levels of every receptor '
+                    'across flights.')
+    parser.add_argument('metric', help='noise metric, e.g. SEL or LAMAX')
+    parser.add_argument('--studies-path', default='INM Studies')
+    parser.add_argument('--kind', choices=sorted(RECEPTOR_FIELDS),
+                        default='standard_grids')
+    parser.add_argument('--by', choices=GROUP_KEYS,
+                        help='statistics for each tail, date or procedure')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of parsing processes (0: one per CPU)')
+    parser.add_argument('-o', '--output', help='write the statistics of '
+                                               'every receptor to a .csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    flights = sorted(d for d in get_immediate_subdirectories(
+        args.studies_path) if d != 'Reference')
+    results = load_flight_results(args.studies_path, flights, args.metric,
+                                  args.kind, args.jobs or None)
+    for flight, error in sorted(results.errors.items()):
+        print('%s skipped: %s' % (flight, error))
+    print('%d flights x %d receptors' % results.levels.shape)
+    if args.by:
+        statistics = results.group_statistics(args.by)
+    else:
+        statistics = {'all flights': results.statistics()}
+    for value, stats in sorted(statistics.items(), key=lambda i: str(i[0])):
+        if not len(stats) or not stats['count'].any():
+            continue
+        print('%-20s %4d flights  max %6.2f  max energy mean %6.2f'
+              % (value, stats['count'].max(), np.nanmax(stats['max']),
+                 np.nanmax(stats['energy_mean'])))
+    if args.output:
+        write_statistics_csv(args.output, results,
+                             statistics if args.by else
+                             statistics['all flights'], args.by)
+        print('Statistics written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+# Writers of contour layers in GeoJSON and ESRI shapefile formats.
+#
+# A contour layer has one feature per noise level. The geometry of a feature
+# is the list of rings (closed contours) of its level, oriented by nesting:
+# rings inside an even number of others are outer rings, the other ones are
+# holes. Features are streamed into the file one at a time:
+# - GeoJSONWriter writes a FeatureCollection of MultiPolygon features
+#   (outer rings counter-clockwise, holes clockwise)
+# - ShapefileWriter writes the .shp, .shx and .dbf files of a Polygon
+#   shapefile (outer rings clockwise, holes counter-clockwise), and its .prj
+#   when a projection is given; the attribute table is written with inmdbf
+#
+# Contour points are in nmi, like the INM exports; the layers can be written
+# in feet, metres or nmi (UNITS). The projection of a shapefile is given as
+# WKT text, e.g. local_projection() for the x/y plane of a study centred on
+# its reference point. GeoJSON coordinates are longitude/latitude (RFC
+# 7946): given the origin (reference point) of the study, the x/y of the
+# contours are converted with the inverse of that local projection
+# (local_to_lon_lat, on a sphere). A GeoJSON layer cannot be written in any
+# other projection, so asking for one raises ValueError; without origin nor
+# projection the planar x/y are written as they are. The AREA attribute is
+# in square units of the layer in every case.
+#
+# The layers of a whole campaign are written from the contour points
+# exported by each study (OUTPUT1/<metric>) with a pool of processes,
+# instead of one 'Export As Shapefile' GUI round trip per study.
+#
+# Example:
+#   write_contours('DNL.geojson', contour_points)
+#   write_contours('DNL.shp', contour_points, 'feet', projection)
+#   write_contours('DNL.geojson', contour_points, origin=(38.5, -9.0))
+#
+# Usage:
+#   python gisexport.py METRIC [--studies-path PATH] [--format shp]
+#                              [--format geojson] [--unit feet]
+#                              [--prj FILE | --origin LAT LON] [-j JOBS]
+
+import argparse
+import concurrent.futures
+import json
+import os
+import struct
+
+import numpy as np
+
+import contourarea
+import inmoutputs
+from CreateINMStudy import get_immediate_subdirectories
+from inmdbf import DBFField, DBFWriter
+from inmwatch import RUN_OUTPUT_DIR
+
+__author__ = 'Thomas Vandenhede'
+
+SHP_FILE_CODE = 9994
+SHP_VERSION = 1000
+SHP_POLYGON = 5
+SHP_HEADER_SIZE = 100
+GEOJSON_EXTENSIONS = ('.geojson', '.json')
+SHAPEFILE_EXTENSIONS = ('.shp',)
+# attributes of the features of a contour layer
+CONTOUR_FIELDS = [DBFField('LEVEL', 'N', 8, 2), DBFField('AREA', 'N', 20, 4)]
+# unit -> (length of the unit in nmi, WKT unit name, length in metres)
+UNITS = {
+    'nmi': (1.0, 'Nautical_Mile', 1852.0),
+    'feet': (0.3048 / 1852.0, 'Foot', 0.3048),
+    'metres': (1.0 / 1852.0, 'Meter', 1.0),
+}
+FORMATS = {'shp': '.shp', 'geojson': '.geojson'}
+# radius of the sphere of local_to_lon_lat (mean radius of the Earth)
+EARTH_RADIUS = 6371008.8
+
+
+def orient_rings(rings):
+    """
+    Orients rings by nesting: outer rings counter-clockwise, holes (rings
+    inside an odd number of the other rings) clockwise.
+
+    :param rings: list of (n, 2) arrays of x, y
+    :return: list of (n, 2) arrays, reversed where needed
+    """
+    areas = contourarea.ring_areas(rings)
+    result = []
+    for n, ring in enumerate(rings):
+        hole = contourarea.points_in_rings(ring[:1], rings[:n] +
+                                           rings[n + 1:])[0]
+        result.append(ring[::-1] if (areas[n] < 0) != hole else ring)
+    return result
+
+
+def group_polygons(rings):
+    """
+    Groups oriented rings into polygons: each hole goes with the smallest
+    outer ring around it.
+
+    :param rings: rings oriented with orient_rings
+    :return: list of polygons, each a list [outer ring, hole, ...]
+    """
+    areas = contourarea.ring_areas(rings)
+    outers = np.flatnonzero(areas > 0)
+    polygons = [[rings[k]] for k in outers]
+    for k in np.flatnonzero(areas <= 0):
+        around = [n for n, o in enumerate(outers) if
+                  contourarea.points_in_rings(rings[k][:1], [rings[o]])[0]]
+        if around:
+            polygons[min(around, key=lambda n: areas[outers[n]])].append(
+                rings[k])
+    return polygons
+
+
+def local_projection(latitude, longitude, unit='nmi'):
+    """
+    Returns the WKT of an azimuthal equidistant projection centred on the
+    reference point of a study, which matches the x/y plane of INM near the
+    airport.
+
+    :param latitude: latitude of the study reference point (degrees)
+    :param longitude: longitude of the study reference point (degrees)
+    :param unit: unit of the coordinates (see UNITS)
+    :return: the WKT text of a .prj file
+    """
+    name, metres = UNITS[unit][1:]
+    return ('PROJCS["INM_Study_Local",GEOGCS["GCS_WGS_1984",'
+            'DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,'
+            '298.257223563]],PRIMEM["Greenwich",0.0],'
+            'UNIT["Degree",0.0174532925199433]],'
+            'PROJECTION["Azimuthal_Equidistant"],'
+            'PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],'
+            'PARAMETER["Central_Meridian",%r],'
+            'PARAMETER["Latitude_Of_Origin",%r],UNIT["%s",%r]]'
+            % (float(longitude), float(latitude), name, metres))
+
+
+def local_to_lon_lat(xy, latitude, longitude, unit='nmi'):
+    """
+    Converts x/y coordinates of the local projection of a study (see
+    local_projection) to longitudes and latitudes, with the inverse
+    azimuthal equidistant projection on a sphere.
+
+    :param xy: (n, 2) array of x, y
+    :param latitude: latitude of the study reference point (degrees)
+    :param longitude: longitude of the study reference point (degrees)
+    :param unit: unit of the coordinates (see UNITS)
+    :return: (n, 2) array of longitude, latitude (degrees)
+    """
+    xy = np.asarray(xy, np.float64) * UNITS[unit][2] / EARTH_RADIUS
+    x, y = xy[:, 0], xy[:, 1]
+    c = np.hypot(x, y)
+    # sin(c) / c, 1 at the reference point
+    sinc = np.sinc(c / np.pi)
+    lat0, lon0 = np.radians(latitude), np.radians(longitude)
+    lat = np.arcsin(np.clip(np.cos(c) * np.sin(lat0) +
+                            y * sinc * np.cos(lat0), -1.0, 1.0))
+    lon = lon0 + np.arctan2(x * sinc, np.cos(lat0) * np.cos(c) -
+                            y * sinc * np.sin(lat0))
+    lon = (lon + np.pi) % (2 * np.pi) - np.pi
+    return np.degrees(np.stack([lon, lat], axis=1))
+
+
+def _closed(ring):
+    ring = np.asarray(ring, np.float64)
+    if len(ring) and (ring[0] != ring[-1]).any():
+        ring = np.vstack([ring, ring[:1]])
+    return ring
+
+
+class GeoJSONWriter(object):
+    """
+    Streams polygon features into a GeoJSON FeatureCollection. Given the
+    origin of the study, the coordinates are converted to longitude/latitude
+    (see local_to_lon_lat), otherwise they are written as they are.
+
+    Usage:
+        with GeoJSONWriter('DNL.geojson', (38.5, -9.0)) as layer:
+            layer.write_feature(rings, {'LEVEL': 65.0})
+
+    """
+    def __init__(self, path, origin=None, unit='nmi'):
+        self.path = path
+        self.origin = origin
+        self.unit = unit
+        self.record_count = 0
+        self._file = open(path, 'w')
+        self._file.write('{"type": "FeatureCollection", "features": [')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_feature(self, rings, properties):
+        """
+        Appends a feature.
+
+        :param rings: oriented rings (see orient_rings)
+        :param properties: dictionary of the attributes of the feature
+        :return:
+        """
+        coordinates = [[self._coordinates(_closed(ring)).tolist()
+                        for ring in polygon]
+                       for polygon in group_polygons(rings)]
+        feature = {'type': 'Feature', 'properties': properties,
+                   'geometry': {'type': 'MultiPolygon',
+                                'coordinates': coordinates}}
+        self._file.write((',\n' if self.record_count else '\n') +
+                         json.dumps(feature))
+        self.record_count += 1
+
+    def _coordinates(self, ring):
+        if self.origin is None:
+            return ring
+        return local_to_lon_lat(ring, self.origin[0], self.origin[1],
+                                self.unit)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.write('\n]}\n')
+        self._file.close()
+
+
+class ShapefileWriter(object):
+    """
+    Streams polygon features into a shapefile (.shp, .shx and .dbf, and
+    .prj if a projection is given). The file lengths and the bounding box in
+    the headers are written when the writer is closed.
+
+    Usage:
+        with ShapefileWriter('DNL.shp', CONTOUR_FIELDS) as layer:
+            layer.write_feature(rings, {'LEVEL': 65.0, 'AREA': 1.2})
+
+    """
+    def __init__(self, path, fields, projection=None):
+        base = os.path.splitext(path)[0]
+        if projection:
+            with open(base + '.prj', 'w') as f:
+                f.write(projection)
+        self.path = base + '.shp'
+        self.record_count = 0
+        self.bbox = [np.inf, np.inf, -np.inf, -np.inf]
+        self._shp = open(base + '.shp', 'wb')
+        self._shx = open(base + '.shx', 'wb')
+        self._dbf = DBFWriter(base + '.dbf', fields)
+        self._shp.write(b'\0' * SHP_HEADER_SIZE)
+        self._shx.write(b'\0' * SHP_HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _header(self, file_length):
+        xmin, ymin, xmax, ymax = self.bbox if self.record_count else [0.0] * 4
+        return struct.pack('>7i', SHP_FILE_CODE, 0, 0, 0, 0, 0,
+                           file_length // 2) + \
+            struct.pack('<2i8d', SHP_VERSION, SHP_POLYGON, xmin, ymin, xmax,
+                        ymax, 0.0, 0.0, 0.0, 0.0)
+
+    def write_feature(self, rings, properties):
+        """
+        Appends a feature.
+
+        :param rings: oriented rings (see orient_rings)
+        :param properties: dictionary or sequence of the attributes
+        :return:
+        """
+        # shapefile outer rings are clockwise
+        parts = [_closed(ring)[::-1] for ring in rings]
+        points = np.concatenate(parts) if parts else np.zeros((0, 2))
+        starts = np.cumsum([0] + [len(p) for p in parts])[:-1]
+        bbox = (points.min(axis=0).tolist() + points.max(axis=0).tolist()
+                if len(points) else [0.0] * 4)
+        content = struct.pack('<i4d2i', SHP_POLYGON, bbox[0], bbox[1],
+                              bbox[2], bbox[3], len(parts), len(points)) + \
+            np.asarray(starts, '<i4').tobytes() + \
+            np.ascontiguousarray(points, '<f8').tobytes()
+
+        self.record_count += 1
+        offset = self._shp.tell()
+        self._shp.write(struct.pack('>2i', self.record_count,
+                                    len(content) // 2) + content)
+        self._shx.write(struct.pack('>2i', offset // 2, len(content) // 2))
+        self._dbf.write_record(properties)
+        if len(points):
+            self.bbox = [min(self.bbox[0], bbox[0]),
+                         min(self.bbox[1], bbox[1]),
+                         max(self.bbox[2], bbox[2]),
+                         max(self.bbox[3], bbox[3])]
+
+    def close(self):
+        if self._shp.closed:
+            return
+        for f in (self._shp, self._shx):
+            f.seek(0, os.SEEK_END)
+            length = f.tell()
+            f.seek(0)
+            f.write(self._header(length))
+            f.close()
+        self._dbf.close()
+
+
+def open_layer(path, fields, projection=None, origin=None, unit='nmi'):
+    """
+    Opens a GeoJSON or shapefile writer, depending on the extension of the
+    path.
+
+    :param path: .geojson, .json or .shp file
+    :param fields: list of DBFField describing the attributes (shapefiles
+    only)
+    :param projection: WKT of the projection (shapefiles only)
+    :param origin: (latitude, longitude) of the study reference point, to
+    write GeoJSON layers in longitude/latitude
+    :param unit: unit of the coordinates (see UNITS)
+    :return: GeoJSONWriter or ShapefileWriter
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in GEOJSON_EXTENSIONS:
+        if projection and origin is None:
+            raise ValueError('%s: GeoJSON is in longitude/latitude, give the '
+                             'origin of the study instead of a projection'
+                             % path)
+        return GeoJSONWriter(path, origin, unit)
+    if extension in SHAPEFILE_EXTENSIONS:
+        return ShapefileWriter(path, fields, projection)
+    raise ValueError('Unknown GIS format: %s' % path)
+
+
+def contour_features(contour_points, unit='nmi'):
+    """
+    Yields the features of a contour layer, one per level.
+
+    :param contour_points: structured array of a 'contour_points' output
+    (LEVEL, CONTOUR, POINT, X, Y) in nmi
+    :param unit: unit of the coordinates and areas of the features (see
+    UNITS)
+    :return: iterator of (oriented rings, {'LEVEL': level, 'AREA': area})
+    """
+    scale = 1.0 / UNITS[unit][0]
+    rings = inmoutputs.contour_rings(contour_points)
+    levels = np.array([level for level, contour, xy in rings])
+    for level in np.unique(levels):
+        level_rings = orient_rings([xy * scale for (l, c, xy), same in
+                                    zip(rings, levels == level) if same])
+        area = contourarea.ring_areas(level_rings).sum()
+        yield level_rings, {'LEVEL': float(level), 'AREA': float(area)}
+
+
+def write_contours(path, contour_points, unit='nmi', projection=None,
+                   origin=None):
+    """
+    Writes contour points as a GeoJSON or shapefile layer.
+
+    :param path: .geojson, .json or .shp file
+    :param contour_points: structured array of a 'contour_points' output
+    :param unit: unit of the layer (see UNITS)
+    :param projection: WKT of the projection (shapefiles only)
+    :param origin: (latitude, longitude) of the study reference point
+    (GeoJSON only)
+    :return: number of features written
+    """
+    with open_layer(path, CONTOUR_FIELDS, projection, origin,
+                    unit) as layer:
+        for rings, properties in contour_features(contour_points, unit):
+            layer.write_feature(rings, properties)
+        return layer.record_count
+
+
+def export_graphics(contour_points_path, layer_paths, unit='nmi',
+                    projection=None, origin=None):
+    """
+    Writes the contour points exported by INM as GIS layers.
+
+    :param contour_points_path: the exported contour points (.csv or .txt)
+    :param layer_paths: list of .geojson, .json or .shp files to write
+    :param unit: unit of the layers (see UNITS)
+    :param projection: WKT of the projection (shapefiles only)
+    :param origin: (latitude, longitude) of the study reference point
+    (GeoJSON only)
+    :return: number of features of each layer
+    """
+    kind, points = inmoutputs.read_output(contour_points_path)
+    if kind != 'contour_points':
+        raise ValueError('%s: not a contour points export'
+                         % contour_points_path)
+    return [write_contours(path, points, unit, projection, origin)
+            for path in layer_paths]
+
+
+def study_graphics(path_to_study, metric, formats=('shp',), unit='nmi',
+                   projection=None, origin=None):
+    """
+    Writes the contours of a study as GIS layers CONTOURS_<study> next to
+    its exported contour points (OUTPUT1/<metric>).
+
+    :param path_to_study: the study directory
+    :param metric: the noise metric (name of the OUTPUT1 sub-directory)
+    :param formats: list of keys of FORMATS
+    :param unit: unit of the layers (see UNITS)
+    :param projection: WKT of the projection (shapefiles only)
+    :param origin: (latitude, longitude) of the study reference point
+    (GeoJSON only)
+    :return: (list of the layer paths, None) or (None, error message)
+    """
+    output_dir = os.path.join(path_to_study, RUN_OUTPUT_DIR, metric.strip())
+    study = os.path.basename(os.path.normpath(path_to_study))
+    try:
+        exports = inmoutputs.find_outputs(output_dir, 'contour_points')
+        # the export of the study itself (<name>_<study>) comes first
+        exports.sort(key=lambda p: not os.path.splitext(
+            os.path.basename(p))[0].endswith('_' + study))
+        if not exports:
+            return None, 'no contour points exported for %s' % metric
+        paths = [os.path.join(output_dir, 'CONTOURS_%s%s'
+                              % (study, FORMATS[f])) for f in formats]
+        export_graphics(exports[0], paths, unit, projection, origin)
+    except (IOError, OSError, ValueError) as err:
+        return None, '%s: %s' % (type(err).__name__, err)
+    return paths, None
+
+
+def _study_graphics(args):
+    return study_graphics(*args)
+
+
+def batch_graphics(studies_path, studies, metric, formats=('shp',),
+                   unit='nmi', projection=None, origin=None, jobs=None):
+    """
+    Writes the contour layers of many studies with a pool of processes.
+
+    :param studies_path: the folder of the study directories
+    :param studies: list of study names
+    :param metric: the noise metric (name of the OUTPUT1 sub-directory)
+    :param formats: list of keys of FORMATS
+    :param unit: unit of the layers (see UNITS)
+    :param projection: WKT of the projection (shapefiles only)
+    :param origin: (latitude, longitude) of the study reference point
+    (GeoJSON only)
+    :param jobs: number of processes (defaults to the number of CPUs)
+    :return: ({study: layer paths}, {study: error message})
+    """
+    jobs = jobs or os.cpu_count() or 1
+    tasks = [(os.path.join(studies_path, s), metric, formats, unit,
+              projection, origin) for s in studies]
+    if jobs == 1 or len(tasks) < 2:
+        outputs = [_study_graphics(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs) as executor:
+            outputs = list(executor.map(
+                _study_graphics, tasks,
+                chunksize=max(1, len(tasks) // (4 * jobs))))
+    layers, errors = {}, {}
+    for study, (paths, error) in zip(studies, outputs):
+        if paths is None:
+            errors[study] = error
+        else:
+            layers[study] = paths
+    return layers, errors
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Contour layers (shapefile, GeoJSON) of every study, '
+                    'from its exported contour points.')
+    parser.add_argument('metric', help='noise metric, e.g. DNL')
+    parser.add_argument('--studies-path', default='INM Studies')
+    parser.add_argument('--format', action='append', choices=sorted(FORMATS),
+                        help='layer format (repeatable, default: shp)')
+    parser.add_argument('--unit', choices=sorted(UNITS), default='nmi')
+    projection = parser.add_mutually_exclusive_group()
+    projection.add_argument('--prj', help='.prj file of the projection of '
+                                          'the shapefiles')
+    projection.add_argument('--origin', type=float, nargs=2,
+                            metavar=('LAT', 'LON'),
+                            help='reference point of the studies: local '
+                                 'azimuthal equidistant projection of the '
+                                 'shapefiles, longitude/latitude GeoJSON')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of processes (0: one per CPU)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    formats = args.format or ['shp']
+    if args.prj and 'geojson' in formats:
+        raise SystemExit('--prj does not apply to GeoJSON layers, which are '
+                         'in longitude/latitude: give --origin instead')
+    projection = None
+    if args.prj:
+        with open(args.prj) as f:
+            projection = f.read().strip()
+    elif args.origin:
+        projection = local_projection(args.origin[0], args.origin[1],
+                                      args.unit)
+    studies = sorted(d for d in get_immediate_subdirectories(
+        args.studies_path) if d != 'Reference')
+    layers, errors = batch_graphics(
+        args.studies_path, studies, args.metric, formats, args.unit,
+        projection, args.origin, args.jobs or None)
+    for study, error in sorted(errors.items()):
+        print('%s skipped: %s' % (study, error))
+    print('Contour layers written for %d studies' % len(layers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# Iso-level contours traced on a standard grid with marching squares.
+#
+# INM only computes fine contours when the run does its own contouring pass
+# (RunOptions.do_contours with a recursive or fixed grid), which makes runs
+# much slower. This module traces the contours of any list of levels from a
+# dense standard grid export instead, after a single run:
+# - each cell of the grid is classified by the corners at or above the
+#   level (16 cases, saddles resolved with the mean of the corners), and
+#   the segments of every cell are looked up in a table at once;
+# - segments are oriented with the higher levels on their left, so that
+#   each crossed grid edge ends one segment and starts the next one; the
+#   segments are chained into rings with pointer jumping, without a Python
+#   loop over points;
+# - the crossing points are interpolated linearly along the grid edges (or
+#   taken at the middle of the edges).
+# The grid is bordered with levels below every threshold, so that contours
+# are closed along the edges of the grid.
+#
+# Contours are returned as a 'contour_points' structured array (LEVEL,
+# CONTOUR, POINT, X, Y), like the contour points exported by INM, so that
+# they can be passed to contourarea and gisexport.
+#
+# Usage:
+#   python gridcontours.py STDGRID.csv -l 55 -l 65 [--grid-id ID]
+#                          [--no-interpolation] [-o contours.geojson]
+
+import argparse
+import math
+
+import numpy as np
+
+import gisexport
+import inmoutputs
+
+__author__ = 'Thomas Vandenhede'
+
+CONTOUR_DTYPE = [('LEVEL', np.float64), ('CONTOUR', np.int64),
+                 ('POINT', np.int64), ('X', np.float64), ('Y', np.float64)]
+
+# Corners of a cell (bit of the case): 1 (r, c), 2 (r, c + 1),
+# 4 (r + 1, c + 1), 8 (r + 1, c). Edges of a cell: 0 bottom, 1 right, 2 top,
+# 3 left. Segments (from edge, to edge) of each case, with the corners at or
+# above the level on their left; cases + 16 are the saddles with a high
+# centre.
+_SEGMENTS = {
+    1: [(0, 3)], 2: [(1, 0)], 3: [(1, 3)], 4: [(2, 1)],
+    5: [(0, 3), (2, 1)], 6: [(2, 0)], 7: [(2, 3)], 8: [(3, 2)],
+    9: [(0, 2)], 10: [(1, 0), (3, 2)], 11: [(1, 2)], 12: [(3, 1)],
+    13: [(0, 1)], 14: [(3, 0)],
+    21: [(0, 1), (2, 3)], 26: [(3, 0), (1, 2)],
+}
+SEGMENT_TABLE = np.full((32, 2, 2), -1, np.int64)
+for _case in range(1, 15):
+    SEGMENT_TABLE[_case, :len(_SEGMENTS[_case])] = _SEGMENTS[_case]
+    SEGMENT_TABLE[_case + 16] = SEGMENT_TABLE[_case]
+for _case in (21, 26):
+    SEGMENT_TABLE[_case] = _SEGMENTS[_case]
+# (row offset, column offset, vertical) of the edges of a cell
+EDGE_OFFSETS = np.array([(0, 0, 0), (0, 1, 1), (1, 0, 0), (0, 0, 1)])
+
+
+class GridGeometry(object):
+    """
+    Position of the points of a grid: point (i, j) (1-based) is at
+    origin + (i - 1) * step_i + (j - 1) * step_j.
+
+    :param x: x of point (1, 1) (nmi)
+    :param y: y of point (1, 1) (nmi)
+    :param i: spacing of the points along i (nmi)
+    :param j: spacing of the points along j (nmi)
+    :param nb_pts_i: number of points along i
+    :param nb_pts_j: number of points along j
+    :param grid_rotation_angle: rotation of the grid (degrees)
+    """
+    def __init__(self, x, y, i, j, nb_pts_i, nb_pts_j,
+                 grid_rotation_angle=0.0):
+        angle = math.radians(float(grid_rotation_angle or 0.0))
+        self.origin = np.array([float(x), float(y)])
+        self.step_i = float(i) * np.array([math.cos(angle), math.sin(angle)])
+        self.step_j = float(j) * np.array([-math.sin(angle), math.cos(angle)])
+        self.shape = (int(nb_pts_j), int(nb_pts_i))
+
+    @classmethod
+    def from_setup(cls, grid_setup):
+        """
+        Geometry of an inmauto.GridSetup.
+
+        """
+        return cls(grid_setup.x, grid_setup.y, grid_setup.i, grid_setup.j,
+                   grid_setup.nb_pts_i, grid_setup.nb_pts_j,
+                   grid_setup.grid_rotation_angle)
+
+    @classmethod
+    def from_points(cls, i, j, x, y):
+        """
+        Geometry fitted to the I, J, X, Y columns of a grid export.
+
+        """
+        i, j = np.asarray(i), np.asarray(j)
+        design = np.stack([np.ones(len(i)), i - 1.0, j - 1.0], axis=1)
+        coefficients = np.linalg.lstsq(
+            design, np.stack([x, y], axis=1).astype(np.float64), rcond=None)[0]
+        geometry = cls(0.0, 0.0, 0.0, 0.0, i.max(), j.max())
+        geometry.origin, geometry.step_i, geometry.step_j = coefficients
+        return geometry
+
+    def to_xy(self, u, v):
+        """
+        Position of fractional grid coordinates.
+
+        :param u: 0-based coordinates along i
+        :param v: 0-based coordinates along j
+        :return: (n, 2) array of x, y
+        """
+        return self.origin + np.multiply.outer(u, self.step_i) + \
+            np.multiply.outer(v, self.step_j)
+
+
+def grid_from_output(grid, grid_id=None):
+    """
+    Arranges the levels of a standard grid export into a matrix.
+
+    :param grid: structured array of a 'standard_grids' output
+    :param grid_id: the grid to use (the first one of the export if None)
+    :return: (GridGeometry, (nb_pts_j, nb_pts_i) array of levels, NaN where
+    the export has no level)
+    """
+    ids = grid['GRID_ID'].astype(str)
+    grid = grid[ids == (ids[0] if grid_id is None else str(grid_id))]
+    if not len(grid):
+        raise ValueError('No point of grid %s in the export' % grid_id)
+    geometry = GridGeometry.from_points(grid['I'], grid['J'], grid['X'],
+                                        grid['Y'])
+    levels = np.full(geometry.shape, np.nan)
+    levels[grid['J'] - 1, grid['I'] - 1] = grid[inmoutputs.level_field(grid)]
+    return geometry, levels
+
+
+def _chain(following):
+    """
+    Orders the elements of a permutation by cycle.
+
+    :param following: the next element of each element
+    :return: (order of the elements, cycle number of each ordered element)
+    """
+    count = len(following)
+    steps = max(1, int(np.ceil(np.log2(max(count, 2)))))
+    # cycle label: smallest element of the cycle
+    label, jump = np.arange(count), following.copy()
+    for _ in range(steps):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+    # distance to the end of the cycle, once cut before its smallest element
+    last = following == label
+    distance = np.where(last, 0, 1)
+    jump = np.where(last, np.arange(count), following)
+    for _ in range(steps):
+        distance = distance + distance[jump]
+        jump = jump[jump]
+    order = np.lexsort((-distance, label))
+    cycle = np.cumsum(np.r_[True, label[order][1:] != label[order][:-1]])
+    return order, cycle
+
+
+def _level_contours(padded, level, interpolate):
+    """
+    Traces the rings of one level on a grid bordered with -inf.
+
+    :return: (cycle number, u, v) of the ring points, in ring order
+    """
+    rows, columns = padded.shape
+    high = padded >= level
+    case = (high[:-1, :-1] * 1 + high[:-1, 1:] * 2 + high[1:, 1:] * 4 +
+            high[1:, :-1] * 8).ravel()
+    cells = np.flatnonzero((case != 0) & (case != 15))
+    if not len(cells):
+        return np.zeros(0, np.int64), np.zeros(0), np.zeros(0)
+    case = case[cells]
+    r, c = np.divmod(cells, columns - 1)
+    saddle = (case == 5) | (case == 10)
+    centre = np.zeros(len(cells), bool)
+    centre[saddle] = (padded[r, c] + padded[r, c + 1] + padded[r + 1, c] +
+                      padded[r + 1, c + 1])[saddle] / 4.0 >= level
+    segments = SEGMENT_TABLE[case + 16 * centre]
+    valid = segments[:, :, 0] >= 0
+    segments = segments[valid]
+    r = np.broadcast_to(r[:, None], valid.shape)[valid]
+    c = np.broadcast_to(c[:, None], valid.shape)[valid]
+
+    # global number of the edges: horizontal edges first, then vertical
+    def edge_ids(local):
+        dr, dc, vertical = EDGE_OFFSETS[local].T
+        return vertical * rows * columns + (r + dr) * columns + c + dc
+
+    start, end = edge_ids(segments[:, 0]), edge_ids(segments[:, 1])
+    starting = np.full(2 * rows * columns, -1)
+    starting[start] = np.arange(len(start))
+    order, cycle = _chain(starting[end])
+
+    # crossing point of the start edge of each segment
+    vertical, node = np.divmod(start[order], rows * columns)
+    nr, nc = np.divmod(node, columns)
+    low_end = padded[nr, nc]
+    high_end = padded[nr + vertical, nc + 1 - vertical]
+    if interpolate:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (level - low_end) / (high_end - low_end)
+    else:
+        t = np.full(len(order), 0.5)
+    # crossings with the border are on the grid points
+    t = np.where(np.isinf(low_end), 1.0, np.where(np.isinf(high_end), 0.0, t))
+    u = nc + t * (1 - vertical) - 1.0
+    v = nr + t * vertical - 1.0
+    return _drop_repeated_points(cycle, u, v)
+
+
+def _drop_repeated_points(cycle, u, v):
+    """
+    Removes the points equal to the previous point of their ring (the last
+    point of a ring preceding its first one). Crossings snapped to the same
+    grid point at the border, or a level equal to a grid value, make such
+    repeated vertices.
+
+    :return: (cycle number, u, v) of the remaining points
+    """
+    index = np.arange(len(cycle))
+    first = np.searchsorted(cycle, cycle)
+    last = np.searchsorted(cycle, cycle, 'right') - 1
+    previous = np.where(index == first, last, index - 1)
+    repeated = (u == u[previous]) & (v == v[previous])
+    # a ring of identical points keeps one of them
+    distinct = np.bincount(cycle, ~repeated)
+    keep = ~repeated | ((distinct[cycle] == 0) & (index == first))
+    return cycle[keep], u[keep], v[keep]
+
+
+def trace_contours(levels, thresholds, geometry=None, interpolate=True):
+    """
+    Traces the iso-level contours of a grid of levels.
+
+    :param levels: (nb_pts_j, nb_pts_i) array of levels (NaN where unknown,
+    counted as below every threshold)
+    :param thresholds: list of contour levels
+    :param geometry: GridGeometry of the grid (grid coordinates if None)
+    :param interpolate: interpolate the crossing points linearly, or put them
+    at the middle of the grid edges
+    :return: 'contour_points' structured array (LEVEL, CONTOUR, POINT, X, Y)
+    """
+    levels = np.asarray(levels, np.float64)
+    padded = np.full((levels.shape[0] + 2, levels.shape[1] + 2), -np.inf)
+    padded[1:-1, 1:-1] = np.where(np.isnan(levels), -np.inf, levels)
+    if geometry is None:
+        geometry = GridGeometry(0.0, 0.0, 1.0, 1.0, levels.shape[1],
+                                levels.shape[0])
+
+    parts = []
+    for level in sorted(float(t) for t in thresholds):
+        cycle, u, v = _level_contours(padded, level, interpolate)
+        part = np.zeros(len(cycle), CONTOUR_DTYPE)
+        part['LEVEL'] = level
+        part['CONTOUR'] = cycle
+        first = np.searchsorted(cycle, cycle)
+        part['POINT'] = np.arange(len(cycle)) - first + 1
+        xy = geometry.to_xy(u, v)
+        part['X'], part['Y'] = xy[:, 0], xy[:, 1]
+        parts.append(part)
+    return np.concatenate(parts) if parts else np.zeros(0, CONTOUR_DTYPE)
+
+
+def write_contour_points_csv(path, contour_points):
+    """
+    Writes contour points in the format of the INM contour points export.
+
+    """
+    with open(path, 'w') as f:
+        f.write('LEVEL,CONTOUR,POINT,X,Y\n')
+        for row in contour_points.tolist():
+            f.write('%.2f,%d,%d,%.6f,%.6f\n' % row)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Contours of a standard grid export, traced with '
+                    'marching squares.')
+    parser.add_argument('grid', help='standard grid export (.csv or .txt)')
+    parser.add_argument('-l', '--level', type=float, action='append',
+                        required=True, help='contour level (repeatable)')
+    parser.add_argument('--grid-id', help='grid of the export to contour '
+                                          '(default: the first one)')
+    parser.add_argument('--no-interpolation', action='store_true',
+                        help='put the contour points at the middle of the '
+                             'grid edges')
+    parser.add_argument('-o', '--output', help='write the contours to a '
+                                               '.geojson, .shp or .csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    kind, grid = inmoutputs.read_output(args.grid)
+    if kind != 'standard_grids':
+        raise SystemExit('%s is not a standard grid export' % args.grid)
+    geometry, levels = grid_from_output(grid, args.grid_id)
+    contours = trace_contours(levels, args.level, geometry,
+                              not args.no_interpolation)
+    for level in sorted(set(args.level)):
+        selected = contours[contours['LEVEL'] == level]
+        print('%6.2f dB: %d contours, %d points'
+              % (level, len(np.unique(selected['CONTOUR'])), len(selected)))
+    if args.output:
+        if args.output.lower().endswith('.csv'):
+            write_contour_points_csv(args.output, contours)
+        else:
+            gisexport.write_contours(args.output, contours)
+        print('Contours written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
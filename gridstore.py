@@ -0,0 +1,338 @@
+# Columnar store of detailed grid exports.
+#
+# With RunOptions.do_detailed_grids and save_all_flights, the detailed grid
+# export of a study holds one level per grid point and per flight, which is
+# too big to re-read as text for every analysis. ingest_detailed_grids
+# converts such an export once into a store directory of .npy columns:
+#
+#   grid.npy, i.npy, j.npy, flight.npy, level.npy
+#       one value per row, rows sorted by grid, i, j and flight (grids and
+#       flights are stored as indexes into the names of meta.json)
+#   points.npy
+#       one record per grid point: grid, i, j, x, y and the range of its
+#       rows (start, stop)
+#   flight_order.npy, flight_ranges.npy
+#       the rows in (flight, grid, i, j) order and, for each flight and
+#       grid, the range of its rows in that order
+#   meta.json
+#       metric, grid and flight names, size and modification time of the
+#       source export
+#
+# The columns are opened as memory maps: a query only reads the rows it
+# returns, whatever the size of the store.
+#
+# Example:
+#   store = open_store('OUTPUT1/SEL/DETGRID_S1.csv', 'DETGRID_S1.store')
+#   store.point_levels('G1', 10, 12)      # every flight at a grid point
+#   store.flight_over_grid('FLT2', 'G1')  # every point of a grid, one flight
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+import inmoutputs
+
+__author__ = 'Thomas Vandenhede'
+
+META_NAME = 'meta.json'
+COLUMNS = [('grid', np.int32), ('i', np.int32), ('j', np.int32),
+           ('flight', np.int32), ('level', np.float32)]
+# columns only kept per grid point (in points.npy)
+POINT_COLUMNS = [('x', np.float64), ('y', np.float64)]
+POINTS_DTYPE = [('grid', np.int32), ('i', np.int32), ('j', np.int32),
+                ('x', np.float64), ('y', np.float64), ('start', np.int64),
+                ('stop', np.int64)]
+FLIGHT_RANGES_DTYPE = [('flight', np.int32), ('grid', np.int32),
+                       ('start', np.int64), ('stop', np.int64)]
+# bytes of the export parsed at a time while ingesting
+CHUNK_BYTES = 32 << 20
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {'source': os.path.abspath(path), 'source_size': st.st_size,
+            'source_mtime_ns': st.st_mtime_ns}
+
+
+def _read_chunks(path, chunk_bytes):
+    """
+    Yields (header line, list of lines) chunks of a text export, without
+    the blank lines.
+
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                return
+            yield header, [line for line in lines if line.strip()]
+
+
+def _codes(names, table):
+    """
+    Converts an array of names into indexes in table, adding the names not
+    in it yet.
+
+    """
+    unique, inverse = np.unique(names, return_inverse=True)
+    for name in unique:
+        table.setdefault(str(name), len(table))
+    lookup = np.array([table[str(name)] for name in unique], np.int32)
+    return lookup[inverse]
+
+
+def _point_key(grid, i, j):
+    # grid, i and j packed in one int64, in sort order
+    return (np.asarray(grid, np.int64) << 42 |
+            np.asarray(i, np.int64) << 21 | np.asarray(j, np.int64))
+
+
+def ingest_detailed_grids(export_path, store_path, chunk_bytes=CHUNK_BYTES):
+    """
+    Converts a detailed grid export into a store. The export is parsed
+    chunk by chunk and the columns are sorted one at a time, so memory use
+    is bounded by one chunk and a few columns.
+
+    :param export_path: the exported .csv or .txt file
+    :param store_path: the store directory (replaced if it exists)
+    :param chunk_bytes: bytes of the export parsed at a time
+    :return: DetailedGridStore
+    """
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # first pass: count the rows to size the columns
+    count = 0
+    for header, lines in _read_chunks(export_path, chunk_bytes):
+        count += len(lines)
+
+    raw = dict((name, np.lib.format.open_memmap(
+        os.path.join(tmp_path, 'raw_%s.npy' % name), 'w+', dtype, (count,)))
+        for name, dtype in COLUMNS + POINT_COLUMNS)
+    grids, flights = {}, {}
+    metric = None
+    row = 0
+    for header, lines in _read_chunks(export_path, chunk_bytes):
+        kind, chunk = inmoutputs.parse_output_buffer(
+            header + b''.join(lines))
+        if kind != 'detailed_grids':
+            raise ValueError('%s is not a detailed grid export'
+                             % export_path)
+        metric = inmoutputs.level_field(chunk)
+        stop = row + len(chunk)
+        raw['grid'][row:stop] = _codes(chunk['GRID_ID'], grids)
+        raw['flight'][row:stop] = _codes(chunk['FLIGHT'], flights)
+        for name in ('i', 'j', 'x', 'y'):
+            raw[name][row:stop] = chunk[name.upper()]
+        raw['level'][row:stop] = chunk[metric]
+        row = stop
+    if row != count:
+        raise ValueError('%s: %d rows counted, %d parsed'
+                         % (export_path, count, row))
+
+    # sort the rows by grid, i, j and flight, then write the sorted columns
+    # one at a time
+    order = np.lexsort((raw['flight'], raw['j'], raw['i'], raw['grid']))
+    for name, dtype in COLUMNS:
+        column = np.lib.format.open_memmap(
+            os.path.join(tmp_path, '%s.npy' % name), 'w+', dtype, (count,))
+        column[:] = raw[name][order]
+        column.flush()
+        del column
+
+    _write_indexes(tmp_path, raw['x'][order], raw['y'][order])
+    del order, raw
+    for name, dtype in COLUMNS + POINT_COLUMNS:
+        os.remove(os.path.join(tmp_path, 'raw_%s.npy' % name))
+    meta = dict(_source_stamp(export_path), metric=metric, rows=count,
+                grids=sorted(grids, key=grids.get),
+                flights=sorted(flights, key=flights.get))
+    with open(os.path.join(tmp_path, META_NAME), 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+
+    # the store only becomes visible once complete
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+    return DetailedGridStore(store_path)
+
+
+def _write_indexes(store_path, x, y):
+    # x, y: coordinates of the sorted rows
+    def load(name):
+        return np.load(os.path.join(store_path, '%s.npy' % name),
+                       mmap_mode='r')
+
+    grid, i, j, flight = load('grid'), load('i'), load('j'), load('flight')
+    key = _point_key(grid, i, j)
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) \
+        if len(key) else np.zeros(0, np.int64)
+    points = np.empty(len(starts), POINTS_DTYPE)
+    for name, column in (('grid', grid), ('i', i), ('j', j), ('x', x),
+                         ('y', y)):
+        points[name] = column[starts]
+    points['start'] = starts
+    points['stop'] = np.r_[starts[1:], len(key)]
+    np.save(os.path.join(store_path, 'points.npy'), points)
+    del key
+
+    flight_order = np.lexsort((j, i, grid, flight))
+    np.save(os.path.join(store_path, 'flight_order.npy'), flight_order)
+    group = np.asarray(flight, np.int64)[flight_order] << 32 | \
+        np.asarray(grid, np.int64)[flight_order]
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]]) \
+        if len(group) else np.zeros(0, np.int64)
+    ranges = np.empty(len(starts), FLIGHT_RANGES_DTYPE)
+    ranges['flight'] = group[starts] >> 32
+    ranges['grid'] = group[starts] & 0xFFFFFFFF
+    ranges['start'] = starts
+    ranges['stop'] = np.r_[starts[1:], len(group)]
+    np.save(os.path.join(store_path, 'flight_ranges.npy'), ranges)
+
+
+def open_store(export_path, store_path, chunk_bytes=CHUNK_BYTES):
+    """
+    Opens the store of a detailed grid export, (re)building it if it does
+    not exist or the export has changed since it was built.
+
+    :param export_path: the exported .csv or .txt file
+    :param store_path: the store directory
+    :param chunk_bytes: bytes of the export parsed at a time
+    :return: DetailedGridStore
+    """
+    if os.path.exists(os.path.join(store_path, META_NAME)):
+        store = DetailedGridStore(store_path)
+        if store.is_current(export_path):
+            return store
+    return ingest_detailed_grids(export_path, store_path, chunk_bytes)
+
+
+class DetailedGridStore(object):
+    """
+    Read-only access to a store built by ingest_detailed_grids.
+
+    :param store_path: the store directory
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.metric = self.meta['metric']
+        self.grids = self.meta['grids']
+        self.flights = self.meta['flights']
+        self.columns = dict((name, self._load(name)) for name, _ in COLUMNS)
+        self.points = self._load('points')
+        self.flight_order = self._load('flight_order')
+        self.flight_ranges = self._load('flight_ranges')
+        self._point_keys = _point_key(self.points['grid'], self.points['i'],
+                                      self.points['j'])
+        self._point_starts = np.asarray(self.points['start'])
+
+    def _load(self, name):
+        return np.load(os.path.join(self.store_path, '%s.npy' % name),
+                       mmap_mode='r')
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def is_current(self, export_path):
+        """
+        Returns True if the store was built from export_path as it is now.
+
+        """
+        try:
+            stamp = _source_stamp(export_path)
+        except OSError:
+            return False
+        return all(self.meta.get(k) == v for k, v in stamp.items())
+
+    def _grid_index(self, grid):
+        try:
+            return self.grids.index(grid)
+        except ValueError:
+            raise KeyError('No grid %s in %s' % (grid, self.store_path))
+
+    def _flight_index(self, flight):
+        try:
+            return self.flights.index(flight)
+        except ValueError:
+            raise KeyError('No flight %s in %s' % (flight, self.store_path))
+
+    def _rows(self, rows, names):
+        # rows: slice or array of row indexes
+        columns = [self.columns[name][rows] for name in names]
+        result = np.empty(len(columns[0]), [
+            (name, column.dtype) for name, column in zip(names, columns)])
+        for name, column in zip(names, columns):
+            result[name] = column
+        return result
+
+    def point_levels(self, grid, i, j):
+        """
+        Returns the levels of every flight at a grid point.
+
+        :param grid: the grid id
+        :param i: the grid point index along I (from 1)
+        :param j: the grid point index along J (from 1)
+        :return: structured array ('flight' index into self.flights,
+        'level'), empty if the grid has no such point
+        """
+        key = _point_key(self._grid_index(grid), i, j)
+        k = np.searchsorted(self._point_keys, key)
+        if k == len(self._point_keys) or self._point_keys[k] != key:
+            return self._rows(slice(0, 0), ('flight', 'level'))
+        point = self.points[k]
+        return self._rows(slice(point['start'], point['stop']),
+                          ('flight', 'level'))
+
+    def flight_over_grid(self, flight, grid):
+        """
+        Returns the levels of one flight at every point of a grid.
+
+        :param flight: the flight name
+        :param grid: the grid id
+        :return: structured array ('i', 'j', 'x', 'y', 'level')
+        """
+        f, g = self._flight_index(flight), self._grid_index(grid)
+        ranges = self.flight_ranges
+        match = np.flatnonzero((ranges['flight'] == f) &
+                               (ranges['grid'] == g))
+        rows = np.zeros(0, np.int64)
+        if len(match):
+            start, stop = ranges[match[0]][['start', 'stop']]
+            rows = np.asarray(self.flight_order[start:stop])
+        points = self.points[
+            np.searchsorted(self._point_starts, rows, 'right') - 1]
+        result = np.empty(len(rows), [('i', np.int32), ('j', np.int32),
+                                      ('x', np.float64), ('y', np.float64),
+                                      ('level', np.float32)])
+        for name in ('i', 'j', 'x', 'y'):
+            result[name] = points[name]
+        result['level'] = self.columns['level'][rows]
+        return result
+
+    def grid_levels(self, grid):
+        """
+        Returns the levels of a grid as a (flights x points) matrix, NaN
+        where a flight has no level at a point.
+
+        :param grid: the grid id
+        :return: (points, levels): the point records of the grid (see
+        points.npy) and the matrix of levels
+        """
+        g = self._grid_index(grid)
+        grid_points = self.points[self.points['grid'] == g]
+        levels = np.full((len(self.flights), len(grid_points)), np.nan,
+                         np.float32)
+        if len(grid_points):
+            rows = slice(grid_points['start'][0], grid_points['stop'][-1])
+            flight = np.asarray(self.columns['flight'][rows])
+            point = np.repeat(np.arange(len(grid_points)),
+                              grid_points['stop'] - grid_points['start'])
+            levels[flight, point] = self.columns['level'][rows]
+        return grid_points, levels
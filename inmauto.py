@@ -19,32 +19,99 @@
 # - Close study with close_study()
 # - Close INM with close_inm()
 
+#
+# GUI BACKEND
+# - INMAuto drives the real INM GUI through pywinauto by default. Pass
+# backend=inmsim.SimulatedBackend() to run against a simulated INM instead
+# (e.g. on Linux)
+
 import os
+import re
 import sys
 import time
 
-import pywinauto
-import pywinauto.timings
-from pywinauto import handleprops
-from pywinauto.application import Application
-from pywinauto.findwindows import find_windows
+import inmtables
+from inmbackend import PywinautoBackend
+from inmwatch import RUN_OUTPUT_DIR, OutputWatcher
+from inmwait import WaitStats, wait_until
 
 __author__ = 'Thomas Vandenhede'
 
+# Outputs of ExportOptions, in export order: (option, 'Output' menu item,
+# selection dialog, output window to wait for, export kind). The outputs
+# without selection dialog or window to wait for have None instead.
+EXPORT_OUTPUTS = [
+    ('output_graphics', 'Output->Output Graphics...', 'Output Select',
+     'Output', 'graphics'),
+    ('contour_points', 'Output->Contour Points...', 'Output Select',
+     'Contour Points', 'file'),
+    ('contour_area_and_pop', 'Output->Contour Area and Pop...',
+     'Output Select', 'Contour Area and Population', 'file'),
+    # an 'ERROR' dialog shows up if the study has no contours
+    ('area_contour_coverage', 'Output->Area Contour Coverage...', None,
+     'Area Contour Coverage', 'file'),
+    ('standard_grids', 'Output->Standard Grids...', 'Scenario Select',
+     None, 'file'),
+    ('detailed_grids', 'Output->Detailed Grids...', 'Scenario Select',
+     None, 'file'),
+    ('noise_at_pop_points', 'Output->Noise at Pop Points...',
+     'Scenario Select', None, 'file'),
+    ('noise_at_loc_points', 'Output->Noise at Loc Points...',
+     'Scenario Select', None, 'file'),
+    ('flight_path_report', 'Output->Flight Path Report...',
+     'Scenario Select', None, 'report'),
+]
+# Output graphics written by gisexport from the exported contour points
+# instead of the 'Export As Shapefile' dialog (INMAuto.native_graphics)
+NATIVE_GRAPHICS_OUTPUT = ('output_graphics', None, None, None,
+                          'native_graphics')
+
 
 class INMAuto:
     """
     This class provides a set of methods to interact with the INM GUI.
     """
 
-    def __init__(self, inm_exe_path):
-        self.app = Application()
+    def __init__(self, inm_exe_path, backend=None, exclusive=True):
+        self.backend = backend or PywinautoBackend()
+        # an exclusive instance kills every INM process when it starts INM;
+        # a non exclusive one only kills its own (see inmpool)
+        self.exclusive = exclusive
+        self.app = self.backend.application()
         self.inm_exe_path = inm_exe_path
         self.wtitle = 'INM.*'  # typical title: 'INM 7.0'
         self.main_window = None
         self.noise_metric = None
         self.path_to_study = None
         self.study_folder = None
+        # deadlines (s) of the waits for INM to start, for a dialog or output
+        # window to show up and for a run to finish
+        self.start_timeout = 60
+        self.dialog_timeout = 30
+        self.run_timeout = 300
+        self.wait_stats = WaitStats()
+        # patterns of the result files a run writes into OUTPUT1, watched
+        # by run_study(watch_outputs=True); they must be set for the INM
+        # installation unless the backend knows them (simulated INM)
+        self.run_output_files = getattr(self.backend, 'run_output_files',
+                                        None)
+        self.output_settle_time = 0.5
+        self.last_run = None
+        # file dialogs: type full paths where the dialog accepts them,
+        # otherwise walk the directory list with cached item indexes
+        self.fast_navigation = True
+        self.navigation_cache = {}
+        self.navigations = []
+        # exports: scenario selected in the 'Scenario Select' and 'Output
+        # Select' dialogs, time and GUI calls of each exported output
+        self.scenario_index = 0
+        self.exports = []
+        # output graphics: unit of the shapefile, and native_graphics to
+        # write it from the exported contour points with gisexport (WKT
+        # graphics_projection for its .prj) instead of the GUI
+        self.graphics_unit = 'feet'
+        self.native_graphics = False
+        self.graphics_projection = None
 
     @staticmethod
     def __path_to_dir(path):
@@ -55,7 +122,7 @@ class INMAuto:
 
         """
         path = path.lower()
-        directory = path.split('\\')
+        directory = re.split(r'[\\/]', path)
         directory[0] += "\\"
         return directory
 
@@ -65,18 +132,18 @@ class INMAuto:
 
         """
         # close any INM window if already open
-        os.system("taskkill /f /im inm.exe 2> nul")
+        self.kill_inm()
         try:
             # open INM
             self.app.start(self.inm_exe_path)
             self.main_window = self.app.window_(title_re=self.wtitle)
-            self.main_window.Wait('ready')
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
+            self.wait_until(self.is_ready, 'INM start', self.start_timeout)
+        except self.backend.errors as err:
             print(err)
             print('Error: %s' % sys.exc_info()[0].__name__)
             print(sys.exc_info()[1])
-            exit(1)
+            # let the caller decide: a batch or a worker pool restarts INM
+            raise
 
     def open_study(self, path_to_study):
         """
@@ -87,32 +154,31 @@ class INMAuto:
             # Close any open study
             self.close_study()
 
-            # split and format path in preparation for use in inm open menu
             self.path_to_study = path_to_study
             self.study_folder = os.path.basename(path_to_study)
-            dir_path = self.__path_to_dir(path_to_study)
 
             # Open study specified in path_to_study
             self.main_window.MenuItem('File->Open Study...').Click()
-            self.main_window.WaitNot('ready')
+            self.wait_until(lambda: not self.is_ready(), 'Open Study dialog')
             w_open = self.app.top_window_()
 
             # browse through directories and accept
-            w_open['ListBox'].SetFocus()
-            for d in dir_path:
-                item_texts = w_open['ListBox'].ItemTexts()
-                item_index = [name.lower() for name in item_texts].index(d)
-                w_open['ListBox'].Select(item_index)
-                w_open.TypeKeys('{ENTER}')
+            calls = self.backend.total_calls
+            if self.__type_path(w_open, path_to_study):
+                method = 'path'
+            else:
+                w_open['ListBox'].SetFocus()
+                self.__walk_to_directory(w_open, 'Open Study', path_to_study)
+                method = 'walk'
+            self.__log_navigation(path_to_study, method, calls)
 
             w_open['OKButton'].Click()
 
             # update INM window title with study folder
             self.main_window = self.app['- [Study %s]' % path_to_study.upper()]
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
+        except self.backend.errors as err:
             print(err)
-            self.close_all_windows()
+            self.recover()
             self.open_study(path_to_study)
 
     def open_grid_setup(self):
@@ -138,13 +204,12 @@ class INMAuto:
             item_count = w_grid_setup['ListBox'].ItemCount()
             for i in range(item_count):
                 self.click_menu_item('Edit->Delete Records')
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
+        except self.backend.errors as err:
             print(err)
-            self.close_all_windows()
+            self.recover()
             self.open_grid_setup()
 
-    def set_grid(self, grid_setup):
+    def set_grid(self, grid_setup, add_record=True):
         """
         This function configures a grid in the 'Grid Setup' Menu.
 
@@ -152,7 +217,9 @@ class INMAuto:
         try:
             # create new grid and set grid type
             w_grid_setup = self.app.top_window_()
-            self.click_menu_item('Edit->Add Record')
+            if add_record:
+                self.click_menu_item('Edit->Add Record')
+                add_record = False
             w_grid_setup['Grip TypeComboBox'].Select(grid_setup.grid_type)
 
             # set threshold and 'do percent of time' option
@@ -195,11 +262,11 @@ class INMAuto:
                 w_grid_setup['Grid IdEdit'].SetEditText(grid_setup.grid_id)
                 w_grid_setup['IEdit'].SetEditText(grid_setup.nb_pts_i)
                 w_grid_setup['JEdit'].SetEditText(grid_setup.nb_pts_j)
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
+        except self.backend.errors as err:
             print(err)
-            self.close_all_windows()
-            self.set_grid(grid_setup)
+            # keep the 'Grid Points Setup' window and the record just added
+            self.recover(close_windows=False)
+            self.set_grid(grid_setup, add_record)
 
     def set_run_options(self, run_options):
         """
@@ -301,27 +368,41 @@ class INMAuto:
                     w_runoptions['LCMAXCheckBox'].Check()
                 if run_options.talc:
                     w_runoptions['TALCCheckBox'].Check()
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
+        except self.backend.errors as err:
             print(err)
-            self.close_all_windows()
+            self.recover()
             self.set_run_options(run_options)
 
-    def run_study(self):
+    def run_study(self, watch_outputs=False):
         """
         Simply runs the INM study.
 
+        With watch_outputs, the end of the run is detected from the result
+        files written into the study's OUTPUT1 directory (see inmwatch)
+        instead of the state of the GUI, and run_timeout may be None for
+        runs of any length. The run duration and output sizes are returned
+        and kept in last_run.
+
         """
+        if watch_outputs and not self.run_output_files:
+            raise ValueError('watch_outputs requires run_output_files, the '
+                             'result files of an INM run')
+        watcher = None
         try:
             # Run Start... from 'Run' Menu
             self.close_all_windows()
             self.main_window.MenuItem('Run->Run Start...').Click()
-            self.main_window.WaitNot('ready')
+            self.wait_until(lambda: not self.is_ready(), 'Run Start dialog')
             w_runstart = self.app['Run Start']
 
             # Select first scenario in list and proceed...
             w_runstart['Scenario ListListBox'].Select(0)
             w_runstart['Include --- >ListBox'].Click()
+            if watch_outputs:
+                watcher = OutputWatcher(
+                    os.path.join(self.path_to_study, RUN_OUTPUT_DIR),
+                    self.run_output_files, self.output_settle_time)
+                watcher.start()
             w_runstart['OKButton'].Click()
 
             # Close all intermediary windows until the 'Run Status' window
@@ -329,7 +410,8 @@ class INMAuto:
             try:
                 while True:
                     self.main_window.Maximize()
-                    self.main_window.WaitNot('ready')
+                    self.wait_until(lambda: not self.is_ready(),
+                                    'run start')
                     dlg = self.app.top_window_()
                     # Close the 'Warning' window that shows up if study has
                     # already been run
@@ -346,60 +428,153 @@ class INMAuto:
                         break
             except OverflowError as err:
                 print(err)
+            if watcher is not None:
+                self.last_run = watcher.wait(self.run_timeout)
+                print('Run finished in %.1f s (%d bytes of output)'
+                      % (self.last_run['duration_s'],
+                         self.last_run['total_bytes']))
+                # the 'Run Status' window closes once the files are written
+                self.wait_until(self.is_ready, 'run end')
+                return self.last_run
             # Wait until the 'Run Status' window closes
-            self.main_window.Wait('ready', timeout=300, retry_interval=0.01)
+            self.wait_until(self.is_ready, 'run end', self.run_timeout,
+                            max_interval=0.1)
             print('Run finished!')
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
+        except self.backend.errors as err:
             print(err)
-            self.close_all_windows()
-            self.run_study()
+            self.recover()
+            return self.run_study(watch_outputs)
+        finally:
+            if watcher is not None:
+                watcher.close()
 
-    # 'Run Options' Menu
-    def export_output(self, export_options):
+    def write_run_options(self, run_options, path_to_study=None):
         """
-        This function exports all the output specified in its arguments.
+        This function writes the run options straight into the run options
+        table of the study instead of going through the 'Run Options' menu.
+        It must be called before the study is opened.
 
         """
-        try:
-            self.get_noise_metric_from_run_options_menu()
-            self.set_output_noise_metric()
+        inmtables.write_run_options_table(
+            path_to_study or self.path_to_study, run_options)
+        self.noise_metric = run_options.noise_metric.ljust(6).upper()
 
-            # Start Outputting...
-            if export_options.output_graphics:
-                self.export_output_graphics()
+    # 'Run Options' Menu
+    def export_output(self, export_options, metric_from_file=False):
+        """
+        This function exports all the output specified in its arguments.
+        With metric_from_file the noise metric is read from the run options
+        table of the study instead of the 'Run Options' menu.
 
-            if export_options.contour_points:
-                self.export_contour_points(export_options.file_type)
+        If export_options.metrics lists several metrics (computed by the run,
+        see the metric flags of RunOptions), the output is exported for each
+        of them in turn into OUTPUT1/<metric>, without running INM again.
 
-            if export_options.contour_area_and_pop:
-                self.export_contour_area_and_pop(export_options.file_type)
+        """
+        metrics = export_options.metrics
+        if not metrics:
+            try:
+                if metric_from_file:
+                    self.get_noise_metric_from_run_options_table()
+                else:
+                    self.get_noise_metric_from_run_options_menu()
+            except self.backend.errors as err:
+                print(err)
+                self.recover()
+                return self.export_output(export_options, metric_from_file)
+            metrics = [self.noise_metric]
 
-            if export_options.area_contour_coverage:
-                self.export_area_contour_coverage(export_options.file_type)
+        # the outputs are planned once for all the metrics
+        plan = self.plan_exports(export_options)
+        for metric in metrics:
+            self.export_metric_output(export_options, metric, plan)
 
-            if export_options.standard_grids:
-                self.export_standard_grids(export_options.file_type)
+    def plan_exports(self, export_options):
+        """
+        Returns the outputs requested by export_options (entries of
+        EXPORT_OUTPUTS), in export order.
 
-            if export_options.detailed_grids:
-                self.export_detailed_grids(export_options.file_type)
+        """
+        # TODO: implement the export function for the input report
+        # (export_options.scenario_run_input_report)
+        plan = [output for output in EXPORT_OUTPUTS
+                if getattr(export_options, output[0])]
+        if self.native_graphics and export_options.output_graphics:
+            # the graphics are written once the contour points are exported
+            contour_points = [o for o in EXPORT_OUTPUTS
+                              if o[0] == 'contour_points'][0]
+            plan = [o for o in plan if o[0] not in ('output_graphics',
+                                                    'contour_points')]
+            plan[:0] = [contour_points, NATIVE_GRAPHICS_OUTPUT]
+        return plan
+
+    def export_metric_output(self, export_options, metric, plan=None):
+        """
+        Switches 'Output Setup' to metric and exports the outputs of plan
+        (by default, every output requested by export_options) into
+        OUTPUT1/<metric>.
 
-            if export_options.noise_at_pop_points:
-                self.export_noise_at_pop_point(export_options.file_type)
+        The output windows are closed once, after the last export. If an
+        export fails, the GUI is recovered and the export goes on from the
+        output that failed.
 
-            if export_options.noise_at_loc_points:
-                self.export_noise_at_loc_point(export_options.file_type)
+        """
+        if plan is None:
+            plan = self.plan_exports(export_options)
+        done = 0
+        try:
+            self.noise_metric = metric.ljust(6).upper()
+            self.set_output_noise_metric()
+            output_dir = self.__make_output_dir()
+            for output in plan:
+                self.export_planned_output(output, export_options.file_type,
+                                           output_dir)
+                done += 1
+            self.close_all_windows()
+        except self.backend.errors as err:
+            print(err)
+            self.recover()
+            self.export_metric_output(export_options, metric, plan[done:])
 
-            if export_options.scenario_run_input_report:
-                pass  # TODO: implement the export function for input report
+    def export_planned_output(self, output, file_type=None, output_dir=None):
+        """
+        Opens the window of one output (entry of EXPORT_OUTPUTS) and exports
+        it into output_dir, leaving the output window open. The time and
+        number of GUI calls of the export are appended to self.exports.
 
-            if export_options.flight_path_report:
-                self.export_flight_path_report()
-        except (pywinauto.application.AppStartError,
-                pywinauto.findbestmatch.MatchError) as err:
-            print(err)
-            self.close_all_windows()
-            self.export_output(export_options)
+        """
+        option, menu_item, select_title, window_title, kind = output
+        if output_dir is None:
+            output_dir = self.__make_output_dir()
+        start = time.time()
+        calls = self.backend.total_calls
+
+        if menu_item:
+            self.click_menu_item(menu_item)
+        if select_title:
+            self.__select(select_title)
+        if window_title and not self.__wait_for_output_window(window_title):
+            print("%s output skipped for %s: INM reported an error"
+                  % (option, self.noise_metric.strip()))
+            return
+
+        if kind == 'graphics':
+            self.__export_graphics(output_dir)
+        elif kind == 'native_graphics':
+            self.__write_graphics(output_dir)
+        elif kind == 'report':
+            # Click OK button in dialog that appears to confirm
+            self.app.top_window_()['OKButton'].Click()
+        else:
+            self.__export(file_type, output_dir)
+
+        export = {'metric': self.noise_metric.strip(), 'output': option,
+                  'time_s': time.time() - start,
+                  'gui_calls': self.backend.total_calls - calls}
+        self.exports.append(export)
+        print("%s output created for %s in %.3f s (%d GUI calls)"
+              % (option, export['metric'], export['time_s'],
+                 export['gui_calls']))
 
     def get_noise_metric_from_run_options_menu(self):
         self.click_menu_item('Run->Run Options')
@@ -408,6 +583,10 @@ class INMAuto:
         self.noise_metric = noise_metric.ljust(6).upper()
         self.close_all_windows()
 
+    def get_noise_metric_from_run_options_table(self):
+        params = inmtables.read_run_options_table(self.path_to_study)
+        self.noise_metric = params['noise_metric'].ljust(6).upper()
+
     def set_output_noise_metric(self):
         # set output metric to be the same as 'Run Options' noise metric
         self.click_menu_item('Output->Output Setup')
@@ -416,125 +595,72 @@ class INMAuto:
         self.close_all_windows()
 
     def export_output_graphics(self):
-        self.main_window.MenuItem('Output->Output Graphics...').Click()
-        dlg_title = 'Output Select'
-        self.__select(dlg_title)
-
-        while True:
-            w_top = self.app.top_window_()
-            if w_top['OKButton'].Exists(0.005, 0.001):
-                w_top['OKButton'].Click()
-            else:
-                if w_top.ChildWindow(
-                        title_re='Output',
-                        class_name='AfxFrameOrView42'
-                ).Exists(0.005, 0.001):
-                    break
-
-        self.rearrange_windows_in_cascade()
-        self.__export_graphics()
+        self.__export_output('output_graphics')
 
     def export_contour_points(self, file_type):
-        self.main_window.MenuItem('Output->Contour Points...').Click()
-        dlg_title = 'Output Select'
-        self.__select(dlg_title)
-
-        while True:
-            w_top = self.app.top_window_()
-            if w_top['OKButton'].Exists(0.005, 0.001):
-                w_top['OKButton'].Click()
-            else:
-                if w_top.ChildWindow(
-                        title_re='Contour Points',
-                        class_name='AfxFrameOrView42'
-                ).Exists(0.005, 0.001):
-                    break
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('contour_points', file_type)
 
     def export_contour_area_and_pop(self, file_type):
-        self.main_window.MenuItem('Output->Contour Area and Pop...').Click()
-        dlg_title = 'Output Select'
-        self.__select(dlg_title)
-
-        # wait until 'Contour Area and Population' window appears
-        while True:
-            w_top = self.app.top_window_()
-            if w_top['OKButton'].Exists(0.005, 0.001):
-                w_top['OKButton'].Click()
-            else:
-                if w_top.ChildWindow(
-                        title_re='Contour Area and Population',
-                        class_name='AfxFrameOrView42').Exists(0.005,
-                                                              0.001):
-                    break
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('contour_area_and_pop', file_type)
 
     def export_area_contour_coverage(self, file_type):
-        self.main_window.MenuItem(
-            'Output->Area Contour Coverage...').Click()
-        if self.app.window_(title='ERROR').Exists():
-            self.app.top_window_().OKButton.Click()
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('area_contour_coverage', file_type)
 
     def export_standard_grids(self, file_type):
-        self.click_menu_item('Output->Standard Grids...')
-        dlg_title = 'Scenario Select'
-        self.__select(dlg_title)
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('standard_grids', file_type)
 
     def export_detailed_grids(self, file_type):
-        self.click_menu_item('Output->Detailed Grids...')
-        dlg_title = 'Scenario Select'
-        self.__select(dlg_title)
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('detailed_grids', file_type)
 
     def export_noise_at_pop_point(self, file_type):
-        self.click_menu_item('Output->Noise at Pop Points...')
-        dlg_title = 'Scenario Select'
-        self.__select(dlg_title)
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('noise_at_pop_points', file_type)
 
     def export_noise_at_loc_point(self, file_type):
-        # open 'Noise at Loc Points...' menu
-        self.click_menu_item('Output->Noise at Loc Points...')
-        dlg_title = 'Scenario Select'
-        self.__select(dlg_title)
-
-        self.rearrange_windows_in_cascade()
-        self.__export(file_type)
+        self.__export_output('noise_at_loc_points', file_type)
 
     def export_flight_path_report(self):
-        self.click_menu_item('Output->Flight Path Report...')
-        dlg_title = 'Scenario Select'
-        self.__select(dlg_title)
+        self.__export_output('flight_path_report')
 
-        # Click OK button in dialog that appears to confirm
-        self.app.top_window_()['OKButton'].Click()
-
-    def __select(self, w_title):
-        w_select = self.app[w_title]
-        w_select['ListBox'].Select(0)
-        w_select['OKButton'].Click()
+    def __export_output(self, option, file_type=None):
+        # export a single output on its own and close its window
+        output = [o for o in EXPORT_OUTPUTS if o[0] == option][0]
+        self.export_planned_output(output, file_type)
+        self.close_all_windows()
 
-    def __export(self, file_type):
+    def __make_output_dir(self):
         # create new folder in 'OUTPUT1' with same name as noise metric
         output_dir = os.path.join(
-            self.path_to_study, 'OUTPUT1', self.noise_metric.strip())
+            self.path_to_study, RUN_OUTPUT_DIR, self.noise_metric.strip())
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
+        return output_dir
+
+    def __wait_for_output_window(self, title_re):
+        # confirm the dialogs that show up until the output window is
+        # displayed; an 'ERROR' dialog (e.g. no contours in the study) means
+        # there is no output: returns False
+        errors = []
+
+        def output_window_shown():
+            w_top = self.app.top_window_()
+            if w_top['OKButton'].Exists(timeout=0):
+                if w_top.WindowText() == 'ERROR':
+                    errors.append(True)
+                w_top['OKButton'].Click()
+                return bool(errors)
+            return self.main_window.ChildWindow(
+                title_re=title_re,
+                class_name='AfxFrameOrView42').Exists(timeout=0)
 
+        self.wait_until(output_window_shown, "'%s' window" % title_re)
+        return not errors
+
+    def __select(self, w_title):
+        w_select = self.app[w_title]
+        w_select['ListBox'].Select(self.scenario_index)
+        w_select['OKButton'].Click()
+
+    def __export(self, file_type, output_dir):
         # Open 'Export As...' window
         self.click_menu_item('File->Export As...')
         w_export = self.app.window_(title_re='Export As*')
@@ -543,62 +669,111 @@ class INMAuto:
         edit_text = w_export['File NameEdit'].Texts()[0]
         export_file = "%s_%s" % (edit_text, self.study_folder)
         w_export['List Files or TypeComboBox'].Select(file_type)
-        w_export['File NameEdit'].SetEditText(export_file)
 
-        # Get output directory (exclude the drive from the split path)
-        dir_path = self.__path_to_dir(output_dir)
-        if w_export['ListBox'].GetItemFocus() == 0:
-            dir_path.pop(0)
+        calls = self.backend.total_calls
+        if self.__type_path(w_export, os.path.join(output_dir, export_file)):
+            method = 'path'
+        else:
+            w_export['File NameEdit'].SetEditText(export_file)
 
-        # browse through directories and accept
-        w_export['ListBox'].Click()
-        print(dir_path)
-        for d in dir_path:
-            item_texts = w_export['ListBox'].ItemTexts()
-            item_index = [name.lower() for name in item_texts].index(d)
-            print(d, item_index)
-            w_export['ListBox'].Select(item_index)
-            w_export.TypeKeys('{ENTER}')
+            # Get output directory (exclude the drive from the split path)
+            skip_drive = w_export['ListBox'].GetItemFocus() == 0
+
+            # browse through directories and accept
+            w_export['ListBox'].Click()
+            self.__walk_to_directory(w_export, 'Export As', output_dir,
+                                     skip_drive)
+            method = 'walk'
+        self.__log_navigation(output_dir, method, calls)
 
         # if confirm dialog appears chose to override existing file
-        if len(find_windows(title_re='Export As.*')) != 0:
+        if len(self.backend.find_windows(
+                'Export As.*', None if self.exclusive else self.app.process)):
             self.app.top_window_()['ReplaceButton'].Click()
-        self.close_all_windows()
-        print("%s output created for %s"
-              % (export_file, self.noise_metric.strip()))
 
-    def __export_graphics(self):
-        # create new folder in 'OUTPUT1' with same name as noise metric
-        output_dir = os.path.join(
-            self.path_to_study, 'OUTPUT1', self.noise_metric.strip())
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-            # Open 'Export As...' window
-            self.click_menu_item('File->Export as ShapeFile...')
+    def __export_graphics(self, output_dir):
+        # Open 'Export As Shapefile' window
+        self.click_menu_item('File->Export as ShapeFile...')
         w_export = self.app.window_(title_re='Export As Shapefile')
+        self.wait_until(w_export.Exists, "'Export As Shapefile' dialog")
 
-        # add study folder to name of output file
-        unit = 'feet'
-        w_export['Export UnitsComboBox'].Select(unit)
+        w_export['Export UnitsComboBox'].Select(self.graphics_unit)
         w_export['BrowseButton'].Click()
 
         # 'Directories' window appears
         w_directories = self.app.window_(title_re='Directories')
+        self.wait_until(w_directories.Exists, "'Directories' dialog")
         w_directories['ListBox'].SetFocus()
 
         # browse through directories and accept
-        dir_ = self.__path_to_dir(output_dir)
-        if w_directories['ListBox'].GetItemFocus() == 0:
-            dir_.pop(0)
+        calls = self.backend.total_calls
+        skip_drive = w_directories['ListBox'].GetItemFocus() == 0
         w_directories.TypeKeys('{HOME}')
-        for d in dir_:
-            w_directories['ListBox'].Select(d)
-            w_directories.TypeKeys('{ENTER}')
+        self.__walk_to_directory(w_directories, 'Directories', output_dir,
+                                 skip_drive)
+        self.__log_navigation(output_dir, 'walk', calls)
         w_directories['OKButton'].Click()
 
         w_export['OKButton'].Click()
 
+    def __write_graphics(self, output_dir):
+        # write the graphics shapefile CONTOURS_<study> from the contour
+        # points exported into output_dir, without the GUI (gisexport and
+        # the modules it imports are only loaded when graphics are written)
+        import gisexport
+        paths, error = gisexport.study_graphics(
+            self.path_to_study, self.noise_metric, ('shp',),
+            self.graphics_unit, self.graphics_projection)
+        if paths is None:
+            raise IOError('%s: %s' % (output_dir, error))
+
+    def __type_path(self, dialog, path):
+        # Fast path: a path typed in the 'File Name' box followed by ENTER
+        # makes a file dialog go to a directory, or save to a file, at once
+        if not (self.fast_navigation and
+                dialog['File NameEdit'].Exists(timeout=0)):
+            return False
+        dialog['File NameEdit'].SetEditText(path)
+        dialog['File NameEdit'].SetFocus()
+        dialog.TypeKeys('{ENTER}')
+        return True
+
+    def __walk_to_directory(self, dialog, dialog_name, path,
+                            skip_drive=False):
+        # Enters the directories of path one by one in the 'ListBox' of a
+        # file dialog. The index of each directory in its listing is cached
+        # and reused until the modification time of the listed directory
+        # changes, which saves reading every item text of the listing.
+        dir_path = self.__path_to_dir(path)
+        parts = re.split(r'[\\/]', path)
+        listbox = dialog['ListBox']
+        for k in range(1 if skip_drive else 0, len(dir_path)):
+            key = (dialog_name, tuple(dir_path[:k]))
+            stamp = None  # drive level: the listing does not change
+            if k > 0:
+                try:
+                    stamp = os.stat(os.sep.join(parts[:k]) +
+                                    (os.sep if k == 1 else '')).st_mtime_ns
+                except OSError:
+                    stamp = 'unknown'
+            cached = self.navigation_cache.get(key)
+            if (cached is not None and cached[0] == stamp != 'unknown' and
+                    dir_path[k] in cached[1]):
+                item_index = cached[1][dir_path[k]]
+            else:
+                item_texts = [name.lower() for name in listbox.ItemTexts()]
+                item_index = item_texts.index(dir_path[k])
+                indexes = dict((name, i) for i, name in enumerate(item_texts))
+                self.navigation_cache[key] = (stamp, indexes)
+            listbox.Select(item_index)
+            dialog.TypeKeys('{ENTER}')
+
+    def __log_navigation(self, path, method, calls_before):
+        calls = self.backend.total_calls - calls_before
+        self.navigations.append({'path': path, 'method': method,
+                                 'gui_calls': calls})
+        print('Navigated to %s in %d GUI calls (%s)' % (path, calls, method))
+
     def close_study(self):
         """
         Closes the study.
@@ -615,6 +790,20 @@ class INMAuto:
         """
         self.click_menu_item('File->Exit')
 
+    def kill_inm(self):
+        """
+        Kills INM: every INM process if the instance is exclusive, only the
+        process it started otherwise.
+        """
+        if self.exclusive:
+            self.backend.kill_inm()
+        elif self.main_window is not None:
+            try:
+                self.app.kill_()
+            except self.backend.errors as err:
+                print(err)
+        self.main_window = None
+
     def rearrange_windows_in_cascade(self):
         """
         Self explanatory. Rearranges all windows of the GUI in cascade.
@@ -624,6 +813,40 @@ class INMAuto:
     def close_all_windows(self):
         self.click_menu_item('Window->Close All')
 
+    def recover(self, close_windows=True):
+        """
+        Brings the GUI back to a known state after an error: dismisses the
+        dialogs left open (they disable the main window and its menus),
+        then closes all windows.
+        """
+        try:
+            for i in range(5):
+                if self.main_window.IsEnabled():
+                    break
+                self.app.top_window_().TypeKeys('{ESC}')
+            if close_windows:
+                self.close_all_windows()
+        except self.backend.errors as err:
+            print(err)
+
+    def is_ready(self):
+        """
+        Returns True if the main window is visible and enabled, i.e. no
+        dialog is open and no run is in progress.
+        """
+        return self.main_window.IsVisible() and self.main_window.IsEnabled()
+
+    def wait_until(self, condition, name, timeout=None, **kwargs):
+        """
+        Polls condition with inmwait.wait_until (dialog_timeout by
+        default). GUI errors raised by the condition count as false and the
+        wait is recorded in wait_stats.
+        """
+        if timeout is None:
+            timeout = self.dialog_timeout
+        return wait_until(condition, timeout, name, self.wait_stats,
+                          ignore=self.backend.errors, **kwargs)
+
     def click_menu_item(self, item_string):
         """
         Close all windows in the GUI.
@@ -641,6 +864,19 @@ class StudyOptions(object):
     def reset(self):
         raise NotImplementedError()
 
+    def set_params(self, params):
+        """
+        Sets parameters from a dictionary, e.g. one read back from a study
+        table.
+
+        :param params: dictionary {parameter name: value}
+        :return:
+        """
+        for key, value in params.items():
+            if key not in self._params:
+                raise KeyError("Unknown parameter '%s'" % key)
+            self._params[key] = value
+
 
 class GridSetup(StudyOptions):
     """
@@ -1141,6 +1377,7 @@ class ExportOptions(StudyOptions):
         self._params['scenario_run_input_report'] = None
         self._params['flight_path_report'] = None
         self._params['file_type'] = None
+        self._params['metrics'] = None
 
     def get_export_options_dict(self):
         return self._params
@@ -1233,6 +1470,14 @@ class ExportOptions(StudyOptions):
     def file_type(self, file_type):
         self._params['file_type'] = file_type
 
+    @property
+    def metrics(self):
+        return self._params['metrics']
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._params['metrics'] = metrics
+
 
 class INMStudy(object):
     """
@@ -1243,34 +1488,83 @@ class INMStudy(object):
 
     """
 
-    def __init__(self, inm_exe_path, study_path):
-        self.inm = INMAuto(inm_exe_path)
+    def __init__(self, inm_exe_path, study_path, backend=None, inm=None):
+        # an INMAuto instance can be shared between studies (see inmbatch)
+        self.inm = inm or INMAuto(inm_exe_path, backend)
         self.study_folder = study_path
 
         # path must be absolute
         self.path_to_study = os.path.join(
             os.getcwd(), 'INM Studies', self.study_folder)
 
-    def run_scenario(self, grids, run_options, export_options=None):
-        self.inm.open_inm()
+    def run_scenario(self, grids, run_options, export_options=None,
+                     grids_to_file=False, run_options_to_file=False,
+                     watch_outputs=False, start_inm=True):
+        # Write grids and run options straight into the study's tables
+        # before INM is launched: the corresponding dialogs are then skipped
+        # completely
+        if grids_to_file:
+            self.write_grids(grids)
+        if run_options_to_file:
+            self.inm.write_run_options(run_options, self.path_to_study)
+
+        # Without start_inm, the study is opened in the running INM
+        if start_inm:
+            self.inm.open_inm()
         self.inm.open_study(self.path_to_study)
 
         # Setup grids
-        self.inm.open_grid_setup()
-        for grid in grids:
-            self.inm.set_grid(grid)
+        if not grids_to_file:
+            self.inm.open_grid_setup()
+            for grid in grids:
+                self.inm.set_grid(grid)
 
         # Set 'Run Options' and run studies
-        self.inm.set_run_options(run_options)
-        self.inm.run_study()
+        if not run_options_to_file:
+            self.inm.set_run_options(run_options)
+        self.inm.run_study(watch_outputs)
 
         # Export only if export options specified
         if export_options:
-            self.inm.export_output(export_options)
+            self.inm.export_output(export_options, run_options_to_file)
 
         # Close study
         self.inm.close_study()
 
+    def write_grids(self, grids, case=None):
+        """
+        Replaces the grids of the study with grids (list of GridSetup)
+        directly in the study's grid table (the one of the case directory
+        case if the study has several).
+
+        """
+        return inmtables.write_grid_table(self.path_to_study, grids, case)
+
+    def read_grids(self, case=None):
+        """
+        Returns the grids stored in the study's grid table (the one of the
+        case directory case if the study has several) as a list of GridSetup
+        objects.
+
+        """
+        grids = []
+        for params in inmtables.read_grid_table(self.path_to_study, case):
+            grid = GridSetup()
+            grid.set_params(params)
+            grids.append(grid)
+        return grids
+
+    def read_run_options(self):
+        """
+        Returns the run options stored in the study's run options table as a
+        RunOptions object.
+
+        """
+        run_options = RunOptions()
+        run_options.set_params(
+            inmtables.read_run_options_table(self.path_to_study))
+        return run_options
+
     def __is_inm_open(self):
         pass
 
@@ -0,0 +1,128 @@
+# GUI backends used by INMAuto.
+#
+# INMAuto never talks to pywinauto directly: it gets its Application object,
+# the exceptions raised when a window or control cannot be found, and the
+# few process-level operations it needs (killing INM, listing windows) from
+# a backend. Two backends exist:
+# - PywinautoBackend (this module) drives the real INM GUI on Windows
+# - SimulatedBackend (inmsim module) models the INM dialogs in-process
+#
+# Every backend counts the GUI calls made through it in backend.calls
+# (a Counter {method name: number of calls}).
+
+import collections
+import inspect
+import os
+
+__author__ = 'Thomas Vandenhede'
+
+
+class GUIBackend(object):
+    """
+    Interface between INMAuto and the INM GUI.
+
+    The object returned by application() must provide the subset of the
+    pywinauto Application, window and control API used by INMAuto
+    (window_, top_window_, item access, MenuItem, Click, Select, ...).
+
+    """
+    # exceptions raised when a window, control or menu item is not found
+    errors = ()
+    # exceptions raised when a wait times out
+    timeout_errors = ()
+
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    def application(self):
+        """
+        Returns a new pywinauto-like Application object.
+
+        :return:
+        """
+        raise NotImplementedError()
+
+    def kill_inm(self):
+        """
+        Kills every running INM process.
+
+        :return:
+        """
+        raise NotImplementedError()
+
+    def find_windows(self, title_re, process=None):
+        """
+        Returns the handles of the top level windows whose title matches
+        title_re.
+
+        :param title_re: regular expression
+        :param process: only windows of this process id (all if None)
+        :return:
+        """
+        raise NotImplementedError()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class _CountingProxy(object):
+    """
+    Wraps a pywinauto object (application, window specification, control,
+    menu item...) and counts every method called on it.
+
+    """
+    _PLAIN_TYPES = (type(None), bool, int, float, str, bytes, list, tuple,
+                    dict)
+
+    def __init__(self, target, calls):
+        self._target = target
+        self._calls = calls
+
+    def _wrap(self, value):
+        if isinstance(value, self._PLAIN_TYPES):
+            return value
+        return _CountingProxy(value, self._calls)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not (inspect.ismethod(value) or inspect.isbuiltin(value)):
+            # e.g. dialog.OKButton: a window specification, not a call
+            return self._wrap(value)
+
+        def call(*args, **kwargs):
+            self._calls[name] += 1
+            return self._wrap(value(*args, **kwargs))
+        return call
+
+    def __getitem__(self, key):
+        return self._wrap(self._target[key])
+
+
+class PywinautoBackend(GUIBackend):
+    """
+    Drives the real INM GUI through pywinauto (Windows only).
+
+    """
+    def __init__(self):
+        GUIBackend.__init__(self)
+        import pywinauto.application
+        import pywinauto.findbestmatch
+        import pywinauto.findwindows
+        import pywinauto.timings
+        self._pywinauto = pywinauto
+        self.errors = (pywinauto.application.AppStartError,
+                       pywinauto.findbestmatch.MatchError)
+        self.timeout_errors = (pywinauto.timings.TimeoutError,)
+
+    def application(self):
+        return _CountingProxy(self._pywinauto.application.Application(),
+                              self.calls)
+
+    def kill_inm(self):
+        os.system("taskkill /f /im inm.exe 2> nul")
+
+    def find_windows(self, title_re, process=None):
+        self.calls['find_windows'] += 1
+        return self._pywinauto.findwindows.find_windows(title_re=title_re,
+                                                        process=process)
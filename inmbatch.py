@@ -0,0 +1,185 @@
+# Runs a batch of INM studies in one INM session.
+#
+# INMStudy.run_scenario kills and cold-starts INM for every study. An
+# INMSession keeps the INM process of one INMAuto instance alive and only
+# opens/closes the studies in it: the process is restarted after
+# recycle_after studies (to bound the effect of leaks in a long-running
+# INM) and after a study failed. The time spent starting INM is measured so
+# the startup time saved compared with one start per study can be reported.
+#
+# Example:
+#   session = INMSession('C:\\Program Files\\INM7.0\\inm.exe')
+#   report = session.run_batch(studies, grids, run_options, export_options)
+
+import time
+import traceback
+
+from inmauto import INMAuto, INMStudy
+
+__author__ = 'Thomas Vandenhede'
+
+
+class INMSession(object):
+    """
+    An INM process reused across studies.
+
+    :param inm_exe_path: path to inm.exe
+    :param backend: GUI backend (pywinauto if None)
+    :param recycle_after: number of studies after which INM is restarted
+    (never if None)
+    :param retries: number of times a failed study is retried, in a fresh
+    INM process
+    :param inm: INMAuto instance to use (created if None)
+    """
+    def __init__(self, inm_exe_path, backend=None, recycle_after=50,
+                 retries=1, inm=None):
+        self.inm_exe_path = inm_exe_path
+        self.inm = inm or INMAuto(inm_exe_path, backend)
+        self.recycle_after = recycle_after
+        self.retries = retries
+        self.running = False
+        self.studies_since_start = 0
+        self.start_durations = []
+
+    def start(self):
+        """
+        (Re)starts INM.
+
+        :return:
+        """
+        start = time.time()
+        self.inm.open_inm()
+        self.start_durations.append(time.time() - start)
+        self.running = True
+        self.studies_since_start = 0
+
+    def ensure_started(self):
+        """
+        Starts INM if it is not running or has reached recycle_after
+        studies.
+
+        :return:
+        """
+        if (not self.running or self.recycle_after is not None and
+                self.studies_since_start >= self.recycle_after):
+            self.start()
+
+    def begin_study(self):
+        """
+        Makes INM ready for the next study and counts it towards
+        recycle_after.
+
+        :return:
+        """
+        self.ensure_started()
+        self.studies_since_start += 1
+
+    def mark_failed(self):
+        """
+        Records that a study failed: the state of INM is unknown, so a
+        fresh process is started for the next study.
+
+        :return:
+        """
+        self.running = False
+
+    def close(self):
+        """
+        Exits INM.
+
+        :return:
+        """
+        if self.running:
+            try:
+                self.inm.close_inm()
+            except self.inm.backend.errors as err:
+                print(err)
+            self.inm.kill_inm()
+            self.running = False
+
+    def run_scenario(self, study_folder, grids, run_options,
+                     export_options=None, **kwargs):
+        """
+        Runs a scenario on a study (see INMStudy.run_scenario) in the
+        running INM, retrying in a restarted INM if it fails.
+
+        :param study_folder: the study folder in 'INM Studies'
+        :param grids: list of GridSetup
+        :param run_options: RunOptions
+        :param export_options: ExportOptions (no export if None)
+        :param kwargs: other arguments of INMStudy.run_scenario
+        :return: {'study', 'succeeded', 'attempts', 'time_s', 'error'}
+        """
+        study = INMStudy(self.inm_exe_path, study_folder, inm=self.inm)
+        result = {'study': study_folder, 'succeeded': False, 'attempts': 0,
+                  'error': None}
+        start = time.time()
+        while not result['succeeded'] and \
+                result['attempts'] <= self.retries:
+            result['attempts'] += 1
+            try:
+                self.begin_study()
+                study.run_scenario(grids, run_options, export_options,
+                                   start_inm=False, **kwargs)
+                result['succeeded'] = True
+            except Exception as err:
+                traceback.print_exc()
+                result['error'] = '%s: %s' % (type(err).__name__, err)
+                self.mark_failed()
+        result['time_s'] = time.time() - start
+        return result
+
+    def run_batch(self, study_folders, grids, run_options,
+                  export_options=None, **kwargs):
+        """
+        Runs the same scenario on every study of a list and exits INM.
+
+        :param study_folders: list of study folders in 'INM Studies'
+        :param grids: list of GridSetup
+        :param run_options: RunOptions
+        :param export_options: ExportOptions (no export if None)
+        :param kwargs: other arguments of INMStudy.run_scenario
+        :return: batch report (see report())
+        """
+        start = time.time()
+        results = []
+        try:
+            for folder in study_folders:
+                results.append(self.run_scenario(
+                    folder, grids, run_options, export_options, **kwargs))
+                print('%s: %s' % (folder, 'done' if results[-1]['succeeded']
+                                  else 'FAILED'))
+        finally:
+            self.close()
+        report = self.report(results, time.time() - start)
+        print('%d studies in %.1f s, %d INM starts, %.1f s of startup saved'
+              % (len(results), report['total_time_s'], report['starts'],
+                 report['startup_saved_s']))
+        return report
+
+    def report(self, results, total_time):
+        """
+        Summarises a batch. The startup time saved is estimated as the mean
+        INM start time times the number of starts avoided compared with one
+        start per study attempt.
+
+        :param results: list of run_scenario results
+        :param total_time: wall time of the batch (s)
+        :return:
+        """
+        starts = len(self.start_durations)
+        attempts = sum(r['attempts'] for r in results)
+        startup_time = sum(self.start_durations)
+        mean_start = startup_time / starts if starts else 0.0
+        return {
+            'studies': len(results),
+            'succeeded': sum(1 for r in results if r['succeeded']),
+            'failed': [r['study'] for r in results if not r['succeeded']],
+            'attempts': attempts,
+            'starts': starts,
+            'startup_time_s': startup_time,
+            'mean_start_time_s': mean_start,
+            'startup_saved_s': mean_start * max(0, attempts - starts),
+            'total_time_s': total_time,
+            'results': results,
+        }
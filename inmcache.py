@@ -0,0 +1,311 @@
+# Cache of INM results in front of INMStudy.run_scenario.
+#
+# A scenario is identified by the hash of the input .dbf tables of the
+# study and of the grid, run and export options. The grid and run options
+# tables are left out of the hash since the options they hold are hashed
+# directly (and INM rewrites them when the options are set through the
+# GUI); every other table, including the case and scenario tables, is
+# hashed. After a run, the files of the OUTPUT1 directory of the study that
+# the run and its exports wrote are stored in the cache, leaving out the
+# results of earlier runs; when the same scenario comes up again, OUTPUT1 is
+# replaced by them instead of launching INM. The exported files are named
+# after their study (<output>_<study folder>); on restore they are renamed
+# after the study being restored.
+#
+# Entries are directories of cache_dir named after their key. The total size
+# of the cache is kept under max_bytes by evicting the least recently used
+# entries.
+#
+# Example:
+#   cache = ResultCache('INM Cache', max_bytes=2 << 30)
+#   cache.run_scenario(INMStudy(inm_exe, folder), grids, run_options,
+#                      export_options)
+#   print(cache.stats())
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import inmtables
+from CreateINMStudy import INM_OUTPUT_DIRS, hash_file
+from inmwatch import RUN_OUTPUT_DIR
+
+__author__ = 'Thomas Vandenhede'
+
+# Tables holding the grid and run options, hashed through the options
+OPTION_TABLES = [inmtables.GRID_TABLE.lower(),
+                 inmtables.RUN_OPTIONS_TABLE.lower()]
+META_NAME = 'meta.json'
+
+
+def get_study_inputs(path_to_study):
+    """
+    Returns {relative path: path} of the input .dbf tables of a study
+    (output directories and option tables excluded).
+
+    :param path_to_study: the study directory
+    :return:
+    """
+    result = {}
+    for root, dirs, files in os.walk(path_to_study):
+        dirs[:] = [d for d in dirs if not any(
+            fnmatch.fnmatch(d.lower(), p) for p in INM_OUTPUT_DIRS)]
+        for name in files:
+            if (name.lower().endswith('.dbf') and
+                    name.lower() not in OPTION_TABLES):
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, path_to_study)
+                result[rel_path.replace('\\', '/').lower()] = path
+    return result
+
+
+def snapshot_directory(directory):
+    """
+    Returns {relative path: (size, modification time)} of the files of a
+    directory tree (empty if it does not exist).
+
+    :param directory: the directory (e.g. OUTPUT1 of a study)
+    :return:
+    """
+    result = {}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            result[os.path.relpath(path, directory)] = (stat.st_size,
+                                                        stat.st_mtime_ns)
+    return result
+
+
+def rename_study_files(directory, old_study, new_study):
+    """
+    Renames the files of a directory tree named after a study
+    (<name>_<old_study>.<ext>) after another study.
+
+    :param directory: the directory (e.g. OUTPUT1 of a study)
+    :param old_study: study folder the files are named after
+    :param new_study: study folder to name them after
+    :return: number of files renamed
+    """
+    suffix = '_' + old_study
+    renamed = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            stem, ext = os.path.splitext(name)
+            if stem.endswith(suffix):
+                new_name = stem[:-len(suffix)] + '_' + new_study + ext
+                os.rename(os.path.join(root, name),
+                          os.path.join(root, new_name))
+                renamed += 1
+    return renamed
+
+
+def scenario_key(path_to_study, grids, run_options, export_options=None):
+    """
+    Returns the cache key of a scenario: SHA-1 of the study inputs and of
+    the option dictionaries.
+
+    :param path_to_study: the study directory
+    :param grids: list of GridSetup
+    :param run_options: RunOptions
+    :param export_options: ExportOptions or None
+    :return:
+    """
+    inputs = get_study_inputs(path_to_study)
+    content = {
+        'inputs': dict((k, hash_file(p)) for k, p in inputs.items()),
+        'grids': [g.get_grid_setup_dict() for g in grids],
+        'run_options': run_options.get_run_options_dict(),
+        'export_options': export_options.get_export_options_dict()
+        if export_options else None,
+    }
+    text = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+
+class ResultCache(object):
+    """
+    LRU cache of the OUTPUT1 directories of studies.
+
+    :param cache_dir: directory of the cache (created if needed)
+    :param max_bytes: maximum total size of the entries (no limit if None)
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_restored = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self._entry_dir(key), META_NAME)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_meta(self, key, meta):
+        path = os.path.join(self._entry_dir(key), META_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def entries(self):
+        """
+        Returns the metadata of every complete entry.
+
+        :return: list of {'key', 'size', 'created', 'last_used', 'hits'}
+        """
+        result = []
+        for key in os.listdir(self.cache_dir):
+            meta = self._read_meta(key)
+            if meta is not None:
+                result.append(meta)
+        return result
+
+    def restore(self, key, path_to_study):
+        """
+        Replaces the OUTPUT1 directory of a study with a cached one, with
+        the files named after the study stored renamed after this one.
+
+        :param key: scenario key
+        :param path_to_study: the study directory
+        :return: True if the entry exists (hit), False otherwise
+        """
+        meta = self._read_meta(key)
+        if meta is None:
+            self.misses += 1
+            return False
+        output_dir = os.path.join(path_to_study, RUN_OUTPUT_DIR)
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        shutil.copytree(os.path.join(self._entry_dir(key), RUN_OUTPUT_DIR),
+                        output_dir)
+        study = os.path.basename(os.path.normpath(path_to_study))
+        if meta.get('study') not in (None, study):
+            rename_study_files(output_dir, meta['study'], study)
+        meta['last_used'] = time.time()
+        meta['hits'] += 1
+        self._write_meta(key, meta)
+        self.hits += 1
+        self.bytes_restored += meta['size']
+        return True
+
+    def store(self, key, path_to_study, before=None, **details):
+        """
+        Copies the files of the OUTPUT1 directory of a study written since
+        the snapshot before (see snapshot_directory) into the cache, then
+        evicts old entries if the cache is too big.
+
+        :param key: scenario key
+        :param path_to_study: the study directory
+        :param before: snapshot of OUTPUT1 taken before the run (every file
+        is stored if None)
+        :param details: other values kept in the entry metadata
+        :return:
+        """
+        output_dir = os.path.join(path_to_study, RUN_OUTPUT_DIR)
+        entry_dir = self._entry_dir(key)
+        tmp_dir = entry_dir + '.tmp'
+        for d in (tmp_dir, entry_dir):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        before = before or {}
+        os.makedirs(os.path.join(tmp_dir, RUN_OUTPUT_DIR))
+        for rel_path, stamp in snapshot_directory(output_dir).items():
+            if before.get(rel_path) == stamp:
+                continue  # left by an earlier run
+            dst = os.path.join(tmp_dir, RUN_OUTPUT_DIR, rel_path)
+            if not os.path.exists(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            shutil.copy2(os.path.join(output_dir, rel_path), dst)
+        # the entry only becomes visible once complete
+        os.rename(tmp_dir, entry_dir)
+        now = time.time()
+        self._write_meta(key, dict(details, key=key,
+                                   size=get_directory_size(entry_dir),
+                                   created=now, last_used=now, hits=0))
+        self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        max_bytes.
+
+        :return: number of entries removed
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(self.entries(), key=lambda m: m['last_used'])
+        total = sum(m['size'] for m in entries)
+        removed = 0
+        # the most recent entry is kept even if it alone exceeds max_bytes
+        while total > self.max_bytes and len(entries) > 1:
+            meta = entries.pop(0)
+            shutil.rmtree(self._entry_dir(meta['key']), ignore_errors=True)
+            total -= meta['size']
+            removed += 1
+        self.evictions += removed
+        return removed
+
+    def run_scenario(self, study, grids, run_options, export_options=None,
+                     **kwargs):
+        """
+        INMStudy.run_scenario with the cache in front: on a hit the cached
+        OUTPUT1 is restored and INM is not launched.
+
+        :param study: INMStudy
+        :param grids: list of GridSetup
+        :param run_options: RunOptions
+        :param export_options: ExportOptions or None
+        :param kwargs: other arguments of INMStudy.run_scenario
+        :return: True on a cache hit
+        """
+        key = scenario_key(study.path_to_study, grids, run_options,
+                           export_options)
+        if self.restore(key, study.path_to_study):
+            print('%s: results restored from cache' % study.study_folder)
+            return True
+        before = snapshot_directory(os.path.join(study.path_to_study,
+                                                 RUN_OUTPUT_DIR))
+        study.run_scenario(grids, run_options, export_options, **kwargs)
+        self.store(key, study.path_to_study, before,
+                   study=study.study_folder)
+        return False
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of this object and the current size of
+        the cache.
+
+        :return:
+        """
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'bytes_restored': self.bytes_restored,
+            'entries': len(entries),
+            'size': sum(m['size'] for m in entries),
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,329 @@
+# Declarative INM campaigns with checkpoint/resume.
+#
+# A campaign file (JSON, or TOML on Python 3.11+) lists the flights to study
+# and the grids, run options and export options applied to each of them:
+#
+#   {
+#     "inm_exe_path": "C:\\Program Files\\INM7.0\\inm.exe",
+#     "data_path": "INM Files/MCDP Flight Trials",
+#     "studies_path": "INM Studies",
+#     "flights": "*",
+#     "grids": [{"grid_type": "Standard", "grid_id": "G1", "nb_pts_i": 33,
+#                "nb_pts_j": 33}],
+#     "run_options": {"noise_metric": "SEL", "do_standard_grids": true},
+#     "export_options": {"standard_grids": true,
+#                        "file_type": "Comma Delimited (*.csv)"}
+#   }
+#
+# "flights" is a list of flight folder names of data_path, or "*" for all
+# of them. Grid, run and export options use the parameter names of
+# GridSetup, RunOptions and ExportOptions.
+#
+# Every study goes through the steps of STEPS:
+# - 'prepared': study directory created from Reference and the flight data
+# - 'gridded': grids and run options written into the study tables
+# - 'run': study run in INM
+# - 'exported': outputs exported (only if export_options is given)
+# Each finished step is appended to a journal file (one JSON object per
+# line, flushed to disk). When the campaign is run again, e.g. after a
+# crash, the steps found in the journal are skipped; a step recorded for a
+# different campaign definition does not count.
+#
+# Usage:
+#   python inmcampaign.py campaign.json [--status] [--reset FLIGHT]
+#                                       [--simulate]
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import traceback
+
+import CreateINMStudy
+import inmtables
+from inmauto import ExportOptions, GridSetup, INMAuto, RunOptions
+from inmbatch import INMSession
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: JSON campaigns only
+    tomllib = None
+
+__author__ = 'Thomas Vandenhede'
+
+STEPS = ('prepared', 'gridded', 'run', 'exported')
+
+
+def load_campaign(path):
+    """
+    Reads a campaign file (.toml or JSON) and fills in the defaults.
+
+    :param path: path to the campaign file
+    :return: campaign dictionary
+    """
+    if path.lower().endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('TOML campaigns require Python 3.11 or later')
+        with open(path, 'rb') as f:
+            campaign = tomllib.load(f)
+    else:
+        with open(path) as f:
+            campaign = json.load(f)
+
+    campaign.setdefault('inm_exe_path',
+                        'C:\\Program Files\\INM7.0\\inm.exe')
+    campaign.setdefault('data_path',
+                        os.path.join('INM Files', 'MCDP Flight Trials'))
+    campaign.setdefault('studies_path', 'INM Studies')
+    campaign.setdefault('flights', '*')
+    campaign.setdefault('clone_mode', 'copy')
+    campaign.setdefault('recycle_after', 50)
+    campaign.setdefault('retries', 1)
+    campaign.setdefault('journal',
+                        os.path.splitext(path)[0] + '.journal.jsonl')
+    for key in ('grids', 'run_options'):
+        if key not in campaign:
+            raise ValueError("Campaign %s has no '%s'" % (path, key))
+    return campaign
+
+
+def campaign_key(campaign):
+    """
+    Returns a hash of the parts of a campaign that determine the content of
+    a study: journal entries made with another definition are ignored.
+
+    :param campaign: campaign dictionary
+    :return:
+    """
+    definition = dict((k, campaign.get(k)) for k in (
+        'data_path', 'grids', 'run_options', 'export_options'))
+    text = json.dumps(definition, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def make_options(options_class, params):
+    options = options_class()
+    options.set_params(params)
+    return options
+
+
+class Journal(object):
+    """
+    Append-only record of the finished steps of each study.
+
+    :param path: path to the journal file
+    :param key: campaign key (see campaign_key) of the entries to consider
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.steps = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+                if entry.get('key') != self.key:
+                    continue
+                if entry['step'] == 'reset':
+                    self.steps.pop(entry['study'], None)
+                else:
+                    self.steps.setdefault(entry['study'],
+                                          set()).add(entry['step'])
+
+    def done(self, study):
+        return self.steps.get(study, set())
+
+    def record(self, study, step, **details):
+        """
+        Appends a finished step and forces it to disk.
+
+        :param study: the study folder name
+        :param step: the step (see STEPS), or 'reset' to forget the steps of
+        the study
+        :param details: other values stored in the entry
+        :return:
+        """
+        entry = dict(details, study=study, step=step, key=self.key,
+                     time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if step == 'reset':
+            self.steps.pop(study, None)
+        else:
+            self.steps.setdefault(study, set()).add(step)
+
+
+class Campaign(object):
+    """
+    Expands a campaign into one job per flight and runs the jobs step by
+    step, resuming from the journal.
+
+    :param campaign: campaign dictionary (see load_campaign)
+    :param backend: GUI backend (pywinauto if None)
+    """
+    def __init__(self, campaign, backend=None):
+        self.campaign = campaign
+        self.grids = [make_options(GridSetup, g) for g in campaign['grids']]
+        self.run_options = make_options(RunOptions, campaign['run_options'])
+        self.export_options = None
+        if campaign.get('export_options'):
+            self.export_options = make_options(ExportOptions,
+                                               campaign['export_options'])
+        self.journal = Journal(campaign['journal'], campaign_key(campaign))
+        self.backend = backend
+        self.session = None
+
+    @property
+    def steps(self):
+        return STEPS if self.export_options else STEPS[:-1]
+
+    def flights(self):
+        flights = self.campaign['flights']
+        if flights == '*':
+            flights = sorted(CreateINMStudy.get_immediate_subdirectories(
+                self.campaign['data_path']))
+        return list(flights)
+
+    def status(self):
+        """
+        Returns {study: list of finished steps}.
+
+        :return:
+        """
+        return dict((flight, [s for s in self.steps
+                              if s in self.journal.done(flight)])
+                    for flight in self.flights())
+
+    def path_to_study(self, flight):
+        # INM needs absolute paths
+        return os.path.abspath(
+            os.path.join(self.campaign['studies_path'], flight))
+
+    def run(self):
+        """
+        Runs every step not yet in the journal.
+
+        :return: {'completed', 'failed', 'skipped_steps', 'run_steps'}
+        """
+        report = {'completed': [], 'failed': {}, 'skipped_steps': 0,
+                  'run_steps': 0}
+        self.session = INMSession(
+            self.campaign['inm_exe_path'],
+            recycle_after=self.campaign['recycle_after'], retries=0,
+            inm=INMAuto(self.campaign['inm_exe_path'], self.backend))
+        try:
+            for flight in self.flights():
+                try:
+                    self.run_study(flight, report)
+                    report['completed'].append(flight)
+                except Exception as err:
+                    traceback.print_exc()
+                    report['failed'][flight] = '%s: %s' % (
+                        type(err).__name__, err)
+        finally:
+            self.session.close()
+        print('%d studies completed, %d failed, %d steps run, %d skipped'
+              % (len(report['completed']), len(report['failed']),
+                 report['run_steps'], report['skipped_steps']))
+        return report
+
+    def run_study(self, flight, report):
+        """
+        Runs the missing steps of one study. Once a step is run, the
+        following ones are run again too, since they depend on it.
+
+        """
+        done = self.journal.done(flight)
+        redo = False
+        for step in self.steps:
+            if not redo and step in done:
+                report['skipped_steps'] += 1
+                continue
+            if not redo and done:
+                print('%s: resuming at step %s' % (flight, step))
+            redo = True
+            start = time.time()
+            self.run_step(flight, step)
+            self.journal.record(flight, step,
+                                duration_s=round(time.time() - start, 3))
+            report['run_steps'] += 1
+
+    def run_step(self, flight, step):
+        if step == 'prepared':
+            CreateINMStudy.create_inm_study_directory(
+                self.campaign['data_path'], self.campaign['studies_path'],
+                flight, self.campaign['clone_mode'])
+        elif step == 'gridded':
+            path = self.path_to_study(flight)
+            inmtables.write_grid_table(path, self.grids)
+            inmtables.write_run_options_table(path, self.run_options)
+        else:
+            self.run_in_inm(flight, step)
+
+    def run_in_inm(self, flight, step):
+        """
+        Runs or exports a study in the INM session, retrying in a new INM
+        process on error.
+
+        """
+        inm = self.session.inm
+        for attempt in range(self.campaign['retries'] + 1):
+            try:
+                self.session.begin_study()
+                inm.open_study(self.path_to_study(flight))
+                if step == 'run':
+                    inm.run_study(self.campaign.get('watch_outputs', False))
+                else:
+                    inm.export_output(self.export_options,
+                                      metric_from_file=True)
+                inm.close_study()
+                return
+            except Exception:
+                self.session.mark_failed()
+                if attempt == self.campaign['retries']:
+                    raise
+                traceback.print_exc()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run an INM campaign, resuming from its journal.')
+    parser.add_argument('campaign', help='campaign file (.json or .toml)')
+    parser.add_argument('--status', action='store_true',
+                        help='print the finished steps and exit')
+    parser.add_argument('--reset', action='append', metavar='FLIGHT',
+                        help='forget the finished steps of a study')
+    parser.add_argument('--simulate', action='store_true',
+                        help='use the simulated INM (inmsim)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    backend = None
+    if args.simulate:
+        import inmsim
+        backend = inmsim.SimulatedBackend()
+    campaign = Campaign(load_campaign(args.campaign), backend)
+    for flight in args.reset or []:
+        campaign.journal.record(flight, 'reset')
+    if args.status:
+        for flight, steps in sorted(campaign.status().items()):
+            print('%-40s %s' % (flight, ', '.join(steps) or '-'))
+        return
+    report = campaign.run()
+    if report['failed']:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,532 @@
+# Pure-Python reader and writer for the dBase III (.dbf) tables INM uses
+# for all of its study inputs.
+#
+# - DBFReader streams the records of a table one at a time
+# - DBFTable gives memory-mapped random access by record number and
+#   updates fields in place
+# - DBFWriter streams records into a new table
+#
+# Records are returned as dictionaries {field name: value}. Values are
+# decoded according to the field type:
+# - 'C' (character): str, trailing blanks removed
+# - 'N' and 'F' (numeric): int if the field has no decimals, float otherwise
+# - 'L' (logical): True, False or None
+# - 'D' (date): datetime.date
+# Blank numeric, logical and date fields are returned as None.
+
+import datetime
+import mmap
+import os
+import shutil
+import struct
+
+__author__ = 'Thomas Vandenhede'
+
+HEADER_FORMAT = '<BBBBIHH20x'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FIELD_FORMAT = '<11sc4xBB14x'
+FIELD_SIZE = struct.calcsize(FIELD_FORMAT)
+HEADER_TERMINATOR = b'\r'
+EOF_MARKER = b'\x1a'
+DELETED_FLAG = b'*'
+VALID_FLAG = b' '
+DBASE_III = 0x03
+ENCODING = 'latin-1'
+
+
+class DBFError(Exception):
+    pass
+
+
+class DBFField(object):
+    """
+    Description of a field (column) of a dBase table.
+
+    """
+    def __init__(self, name, field_type, length, decimal_count=0):
+        self.name = name.upper()
+        self.type = field_type.upper()
+        self.length = length
+        self.decimal_count = decimal_count
+        # offset of the field in the record (the deletion flag is at 0)
+        self.offset = None
+
+        if len(self.name) > 10:
+            raise DBFError("Field name '%s' is longer than 10 characters"
+                           % name)
+        if self.type not in 'CNFLD':
+            raise DBFError("Unsupported field type '%s'" % field_type)
+        if self.type == 'L':
+            self.length = 1
+        elif self.type == 'D':
+            self.length = 8
+
+    def __repr__(self):
+        return 'DBFField(%r, %r, %d, %d)' % (
+            self.name, self.type, self.length, self.decimal_count)
+
+    def decode(self, raw):
+        """
+        Converts the raw bytes of a field into a Python value.
+
+        :param raw: the bytes of the field
+        :return:
+        """
+        if self.type == 'C':
+            return raw.decode(ENCODING).rstrip(' \x00')
+        text = raw.strip(b' \x00')
+        if self.type in 'NF':
+            if not text or text.startswith(b'*'):
+                return None
+            if self.decimal_count == 0 and b'.' not in text:
+                return int(text)
+            return float(text)
+        if self.type == 'L':
+            if text in (b'', b'?'):
+                return None
+            return text in b'YyTt'
+        if self.type == 'D':
+            if not text:
+                return None
+            return datetime.datetime.strptime(
+                text.decode(ENCODING), '%Y%m%d').date()
+
+    def encode(self, value):
+        """
+        Converts a Python value into the raw bytes of the field.
+
+        :param value: the value to encode (None for a blank field)
+        :return:
+        """
+        if value is None:
+            return b' ' * self.length
+        if self.type == 'C':
+            raw = str(value).encode(ENCODING)
+            if len(raw) > self.length:
+                raise DBFError("Value %r too long for field %s"
+                               % (value, self.name))
+            return raw.ljust(self.length)
+        if self.type in 'NF':
+            if self.decimal_count:
+                text = '%.*f' % (self.decimal_count, float(value))
+            else:
+                text = '%d' % int(round(float(value)))
+            if len(text) > self.length:
+                raise DBFError("Value %r too long for field %s"
+                               % (value, self.name))
+            return text.rjust(self.length).encode(ENCODING)
+        if self.type == 'L':
+            return b'T' if value else b'F'
+        if self.type == 'D':
+            return value.strftime('%Y%m%d').encode(ENCODING)
+
+
+class DBFHeader(object):
+    """
+    Header of a dBase table: table properties and field descriptors.
+
+    """
+    def __init__(self, fields, record_count=0, last_update=None,
+                 version=DBASE_III):
+        self.version = version
+        self.last_update = last_update or datetime.date.today()
+        self.record_count = record_count
+        self.fields = list(fields)
+        offset = 1
+        for field in self.fields:
+            field.offset = offset
+            offset += field.length
+        self.record_length = offset
+        self.header_length = (HEADER_SIZE + FIELD_SIZE * len(self.fields) +
+                              len(HEADER_TERMINATOR))
+        self.field_dict = dict((f.name, f) for f in self.fields)
+
+    @classmethod
+    def read(cls, f):
+        """
+        Reads the header from a binary file object positioned at the start
+        of the table.
+
+        :param f: binary file object
+        :return:
+        """
+        data = f.read(HEADER_SIZE)
+        if len(data) < HEADER_SIZE:
+            raise DBFError("File too short to be a dBase table")
+        (version, year, month, day, record_count, header_length,
+         record_length) = struct.unpack(HEADER_FORMAT, data)
+
+        fields = []
+        while True:
+            data = f.read(1)
+            if data in (HEADER_TERMINATOR, b''):
+                break
+            data += f.read(FIELD_SIZE - 1)
+            name, field_type, length, decimal_count = struct.unpack(
+                FIELD_FORMAT, data)
+            name = name.split(b'\x00')[0].decode(ENCODING)
+            fields.append(DBFField(name, field_type.decode(ENCODING),
+                                   length, decimal_count))
+
+        try:
+            last_update = datetime.date(1900 + year, month, day)
+        except ValueError:
+            last_update = None
+        header = cls(fields, record_count, last_update, version)
+        if header.record_length != record_length:
+            raise DBFError("Record length %d does not match field sizes %d"
+                           % (record_length, header.record_length))
+        # some writers pad the header: trust the stored length
+        header.header_length = header_length
+        return header
+
+    def pack(self):
+        """
+        Returns the header as bytes.
+
+        :return:
+        """
+        d = self.last_update
+        data = struct.pack(HEADER_FORMAT, self.version, d.year - 1900,
+                           d.month, d.day, self.record_count,
+                           self.header_length, self.record_length)
+        for field in self.fields:
+            data += struct.pack(FIELD_FORMAT,
+                                field.name.encode(ENCODING),
+                                field.type.encode(ENCODING),
+                                field.length, field.decimal_count)
+        data += HEADER_TERMINATOR
+        return data.ljust(self.header_length, b'\x00')
+
+    def decode_record(self, raw):
+        """
+        Converts the raw bytes of a record (deletion flag included) into a
+        dictionary.
+
+        :param raw: the bytes of the record
+        :return:
+        """
+        return dict((f.name, f.decode(raw[f.offset:f.offset + f.length]))
+                    for f in self.fields)
+
+    def encode_record(self, values):
+        """
+        Converts a record given as a dictionary or a sequence of values into
+        raw bytes (deletion flag included). Fields missing from a dictionary
+        are left blank.
+
+        :param values: the values of the record
+        :return:
+        """
+        if isinstance(values, dict):
+            unknown = set(k.upper() for k in values) - set(self.field_dict)
+            if unknown:
+                raise DBFError("Unknown fields %s"
+                               % ', '.join(sorted(unknown)))
+            values = dict((k.upper(), v) for k, v in values.items())
+            values = [values.get(f.name) for f in self.fields]
+        elif len(values) != len(self.fields):
+            raise DBFError("Expected %d values, got %d"
+                           % (len(self.fields), len(values)))
+        return VALID_FLAG + b''.join(f.encode(v)
+                                     for f, v in zip(self.fields, values))
+
+
+class DBFReader(object):
+    """
+    Streams the records of a dBase table. Only a block of records is held
+    in memory at any time.
+
+    Usage:
+        with DBFReader('TRACKS.DBF') as table:
+            for record in table:
+                ...
+
+    """
+    def __init__(self, path, include_deleted=False, block_records=1024):
+        self.path = path
+        self.include_deleted = include_deleted
+        self.block_records = block_records
+        self._file = open(path, 'rb')
+        self.header = DBFHeader.read(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.header.record_count
+
+    def __iter__(self):
+        for deleted, record in self.iter_records():
+            if self.include_deleted or not deleted:
+                yield record
+
+    @property
+    def fields(self):
+        return self.header.fields
+
+    def iter_raw(self):
+        """
+        Yields the raw bytes of every record (deletion flag included).
+
+        :return:
+        """
+        header = self.header
+        self._file.seek(header.header_length)
+        remaining = header.record_count
+        while remaining > 0:
+            n = min(remaining, self.block_records)
+            block = self._file.read(n * header.record_length)
+            n = len(block) // header.record_length
+            if n == 0:
+                break
+            for k in range(n):
+                start = k * header.record_length
+                yield block[start:start + header.record_length]
+            remaining -= n
+
+    def iter_records(self):
+        """
+        Yields (deleted, record) for every record of the table.
+
+        :return:
+        """
+        for raw in self.iter_raw():
+            yield raw[:1] == DELETED_FLAG, self.header.decode_record(raw)
+
+    def close(self):
+        self._file.close()
+
+
+def _break_link(path):
+    """
+    Replaces a hard-linked file by a copy of its own.
+
+    :param path: path to the file
+    :return:
+    """
+    tmp_path = path + '.tmp'
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class DBFTable(object):
+    """
+    Memory-mapped random access to the records of a dBase table. When
+    opened with writable=True fields can be updated in place; the file
+    size never changes. A writable table that is hard-linked (e.g. a study
+    cloned with CreateINMStudy 'link' mode) is first replaced by a copy, so
+    that the update never reaches the other links.
+
+    """
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable and os.stat(path).st_nlink > 1:
+            _break_link(path)
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self.header = DBFHeader.read(self._file)
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), 0, access=access)
+
+        # truncated files: only expose the records actually present
+        available = ((len(self._map) - self.header.header_length) //
+                     self.header.record_length)
+        self.record_count = max(0, min(self.header.record_count, available))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.record_count
+
+    def __getitem__(self, index):
+        return self.record(index)
+
+    @property
+    def fields(self):
+        return self.header.fields
+
+    def _record_offset(self, index):
+        if index < 0:
+            index += self.record_count
+        if not 0 <= index < self.record_count:
+            raise IndexError("Record %d out of range" % index)
+        return self.header.header_length + index * self.header.record_length
+
+    def raw(self, index):
+        """
+        Returns the raw bytes of record number index.
+
+        :param index: the record number (0-based)
+        :return:
+        """
+        offset = self._record_offset(index)
+        return self._map[offset:offset + self.header.record_length]
+
+    def record(self, index):
+        """
+        Returns record number index as a dictionary.
+
+        :param index: the record number (0-based)
+        :return:
+        """
+        return self.header.decode_record(self.raw(index))
+
+    def is_deleted(self, index):
+        offset = self._record_offset(index)
+        return self._map[offset:offset + 1] == DELETED_FLAG
+
+    def get_field(self, index, name):
+        """
+        Returns the value of a single field of a record.
+
+        :param index: the record number (0-based)
+        :param name: the field name
+        :return:
+        """
+        field = self._get_field(name)
+        offset = self._record_offset(index) + field.offset
+        return field.decode(self._map[offset:offset + field.length])
+
+    def update_field(self, index, name, value):
+        """
+        Overwrites a single field of a record in place.
+
+        :param index: the record number (0-based)
+        :param name: the field name
+        :param value: the new value (None for a blank field)
+        :return:
+        """
+        if not self.writable:
+            raise DBFError("Table %s is opened read-only" % self.path)
+        field = self._get_field(name)
+        offset = self._record_offset(index) + field.offset
+        self._map[offset:offset + field.length] = field.encode(value)
+
+    def update_record(self, index, values):
+        """
+        Overwrites the fields of a record given in the dictionary values.
+
+        :param index: the record number (0-based)
+        :param values: dictionary {field name: new value}
+        :return:
+        """
+        for name, value in values.items():
+            self.update_field(index, name, value)
+
+    def set_deleted(self, index, deleted=True):
+        if not self.writable:
+            raise DBFError("Table %s is opened read-only" % self.path)
+        offset = self._record_offset(index)
+        self._map[offset:offset + 1] = DELETED_FLAG if deleted else VALID_FLAG
+
+    def _get_field(self, name):
+        try:
+            return self.header.field_dict[name.upper()]
+        except KeyError:
+            raise DBFError("Table %s has no field '%s'" % (self.path, name))
+
+    def flush(self):
+        if self.writable:
+            self._map.flush()
+
+    def close(self):
+        if not self._map.closed:
+            self.flush()
+            self._map.close()
+        self._file.close()
+
+
+class DBFWriter(object):
+    """
+    Streams records into a new dBase table. The record count in the header
+    is written when the writer is closed.
+
+    Usage:
+        fields = [DBFField('ID', 'C', 8), DBFField('X', 'N', 12, 4)]
+        with DBFWriter('TABLE.DBF', fields) as table:
+            table.write_record({'ID': 'A', 'X': 1.5})
+
+    """
+    def __init__(self, path, fields):
+        self.path = path
+        self.header = DBFHeader([DBFField(f.name, f.type, f.length,
+                                          f.decimal_count) for f in fields])
+        self._file = open(path, 'wb')
+        self._file.write(self.header.pack())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def fields(self):
+        return self.header.fields
+
+    def write_record(self, values):
+        """
+        Appends a record given as a dictionary or a sequence of values.
+
+        :param values: the values of the record
+        :return:
+        """
+        self._file.write(self.header.encode_record(values))
+        self.header.record_count += 1
+
+    def write_records(self, records):
+        for values in records:
+            self.write_record(values)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.write(EOF_MARKER)
+        self._file.seek(0)
+        self._file.write(self.header.pack())
+        self._file.close()
+
+
+def read_fields(path):
+    """
+    Returns the field descriptors of a dBase table.
+
+    :param path: path to the table
+    :return:
+    """
+    with open(path, 'rb') as f:
+        return DBFHeader.read(f).fields
+
+
+def read_records(path, include_deleted=False):
+    """
+    Returns all the records of a (small) dBase table as a list.
+
+    :param path: path to the table
+    :param include_deleted: also return records flagged as deleted
+    :return:
+    """
+    with DBFReader(path, include_deleted) as table:
+        return list(table)
+
+
+def write_records(path, fields, records):
+    """
+    Writes a whole dBase table.
+
+    :param path: path to the table
+    :param fields: list of DBFField
+    :param records: iterable of records (dictionaries or sequences)
+    :return: number of records written
+    """
+    with DBFWriter(path, fields) as table:
+        table.write_records(records)
+        return table.header.record_count
@@ -0,0 +1,298 @@
+# Reader of the outputs exported by INMAuto into OUTPUT1/<metric>.
+#
+# Each exported file (comma delimited .csv or space aligned .txt) starts
+# with a header line naming its columns. The kind of output is recognised
+# from the header:
+# - 'standard_grids': GRID_ID, I, J, X, Y, <metric>
+# - 'detailed_grids': GRID_ID, I, J, X, Y, FLIGHT, <metric>
+# - 'loc_points': NAME, X, Y, <metric>
+# - 'pop_points': NAME, X, Y, POP, <metric>
+# - 'contour_points': LEVEL, CONTOUR, POINT, X, Y
+# - 'contour_areas': LEVEL, AREA, POP (contour area and population, area
+#   contour coverage)
+#
+# Lines before a recognised header (a title, the study name, the date of
+# the run...) are skipped, as long as the header is within the first
+# MAX_PREAMBLE_LINES lines. A file with no recognised header is decoded
+# from its first line and its kind is None.
+#
+# Known gap: these headers are the ones written by the simulated INM
+# (inmsim). The layout of the files exported by a real INM 7 (column names,
+# units in the names, preamble) has not been checked against this reader,
+# so such files may not be recognised: read_study_outputs reports and skips
+# the files whose header it does not recognise. Supporting them means
+# adding their headers to OUTPUT_KINDS.
+#
+# A file is decoded into a NumPy structured array with one column per
+# header field. Comma delimited files are split with the csv module, so
+# quoted values may hold commas, and every row must have one value per
+# header field. Space aligned files are cut into fixed width columns, at
+# blank positions between the header names, so values may hold spaces
+# (e.g. a location named 'SITE 1'), and every row must have a value in
+# every column. The columns are then converted with vectorised NumPy
+# operations.
+#
+# Example:
+#   kind, grid = read_output('OUTPUT1/SEL/STDGRID_S1.csv')
+#   levels = grid[level_field(grid)]
+
+import csv
+import glob
+import os
+import re
+
+import numpy as np
+
+from inmwatch import RUN_OUTPUT_DIR
+
+__author__ = 'Thomas Vandenhede'
+
+# Output kinds: (kind, leading header fields, followed by a metric column)
+OUTPUT_KINDS = [
+    ('standard_grids', ('GRID_ID', 'I', 'J', 'X', 'Y'), True),
+    ('detailed_grids', ('GRID_ID', 'I', 'J', 'X', 'Y', 'FLIGHT'), True),
+    ('loc_points', ('NAME', 'X', 'Y'), True),
+    ('pop_points', ('NAME', 'X', 'Y', 'POP'), True),
+    ('contour_points', ('LEVEL', 'CONTOUR', 'POINT', 'X', 'Y'), False),
+    ('contour_areas', ('LEVEL', 'AREA', 'POP'), False),
+]
+OUTPUT_EXTENSIONS = ('.csv', '.txt')
+MAX_PREAMBLE_LINES = 20
+ENCODING = 'latin-1'
+
+
+def detect_kind(header):
+    """
+    Returns the kind of output (see OUTPUT_KINDS) of a header.
+
+    :param header: list of the column names
+    :return: the kind, or None if the header is not recognised
+    """
+    header = tuple(name.upper() for name in header)
+    for kind, fields, has_metric in OUTPUT_KINDS:
+        if header[:len(fields)] == fields and \
+                len(header) == len(fields) + int(has_metric):
+            return kind
+    return None
+
+
+def _split_header(line):
+    line = line.decode(ENCODING).strip()
+    if ',' in line:
+        return [name.strip() for name in next(csv.reader([line]))], True
+    return line.split(), False
+
+
+def _find_header(lines):
+    """
+    Returns the index of the header among the first lines of an export:
+    the first line recognised as the header of an output kind, or 0.
+
+    """
+    for k, line in enumerate(lines[:MAX_PREAMBLE_LINES + 1]):
+        if line.strip() and detect_kind(_split_header(line)[0]) is not None:
+            return k
+    return 0
+
+
+def _check_row_lengths(lengths, header):
+    bad = np.flatnonzero(np.asarray(lengths) != len(header))
+    if len(bad):
+        raise ValueError('line %d has %d values instead of %d (%s)'
+                         % (bad[0] + 2, lengths[bad[0]], len(header),
+                            ', '.join(header)))
+
+
+def _split_csv(header, lines):
+    """
+    Splits the lines of a comma delimited export into a (rows, columns)
+    array of byte strings.
+
+    """
+    rows = list(csv.reader(line.decode(ENCODING) for line in lines))
+    _check_row_lengths([len(row) for row in rows], header)
+    matrix = np.array(rows, dtype=np.str_).reshape(-1, len(header))
+    return np.char.encode(np.char.strip(matrix), ENCODING)
+
+
+def _column_bounds(header_line, blank):
+    """
+    Returns the (start, stop) character positions of the columns of a space
+    aligned export: each column boundary is the widest run of positions
+    between two header names that are blank on every line (the last one on
+    ties), or None if two columns are not separated.
+
+    """
+    spans = [m.span() for m in re.finditer(br'\S+', header_line)]
+    cuts = [0]
+    for (_, end), (start, _) in zip(spans[:-1], spans[1:]):
+        gap = np.flatnonzero(blank[end:start]) + end
+        if not len(gap):
+            return None
+        runs = np.split(gap, np.flatnonzero(np.diff(gap) > 1) + 1)
+        cuts.append(max(reversed(runs), key=len)[0])
+    cuts.append(len(blank))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _split_aligned(header, header_line, lines):
+    """
+    Splits the lines of a space aligned export into a (rows, columns) array
+    of byte strings, cutting them at the column positions of the header.
+    If the lines are not aligned with the header (some cell would be
+    blank), they are split on whitespace instead.
+
+    """
+    width = max(len(line) for line in lines + [header_line])
+    chars = np.frombuffer(b''.join(line.ljust(width) for line in lines),
+                          dtype='S1').reshape(len(lines), width)
+    bounds = _column_bounds(header_line.ljust(width),
+                            (chars == b' ').all(axis=0))
+    if bounds is not None:
+        columns = [chars[:, start:stop].copy().view('S%d' % (stop - start))
+                   .ravel() for start, stop in bounds]
+        matrix = np.char.strip(np.stack(columns, axis=1))
+        if (matrix != b'').all():
+            return matrix
+    rows = [line.split() for line in lines]
+    _check_row_lengths([len(row) for row in rows], header)
+    return np.array(rows, dtype=bytes).reshape(-1, len(header))
+
+
+def _convert_column(text):
+    """
+    Converts a column of byte strings to int64, float64 (blank values become
+    NaN) or str, whichever fits every value.
+
+    """
+    blank = text == b''
+    if not blank.any():
+        try:
+            return text.astype(np.int64)
+        except ValueError:
+            pass
+    try:
+        return np.where(blank, b'nan', text).astype(np.float64)
+    except ValueError:
+        pass
+    width = np.char.str_len(text).max() if len(text) else 1
+    text = text.astype('S%d' % max(width, 1))
+    try:
+        return text.astype(np.str_)
+    except UnicodeDecodeError:  # not ASCII
+        return np.char.decode(text, ENCODING)
+
+
+def parse_output_buffer(data):
+    """
+    Decodes an exported output held in memory.
+
+    :param data: the bytes of the file
+    :return: (kind, structured array), kind is None if the header is not
+    recognised
+    """
+    data = data.replace(b'\r', b'').strip(b'\n')
+    lines = data.split(b'\n')
+    start = _find_header(lines)
+    header_line = lines[start]
+    header, comma_delimited = _split_header(header_line)
+    lines = [line for line in lines[start + 1:] if line.strip()]
+    if comma_delimited:
+        # empty values are kept, so that a missing value cannot shift the
+        # following columns
+        matrix = _split_csv(header, lines)
+    else:
+        matrix = _split_aligned(header, header_line, lines)
+    columns = [_convert_column(matrix[:, k]) for k in range(len(header))]
+    result = np.empty(len(matrix), dtype=[
+        (name, column.dtype) for name, column in zip(header, columns)])
+    for name, column in zip(header, columns):
+        result[name] = column
+    return detect_kind(header), result
+
+
+def read_output(path):
+    """
+    Reads an exported output file.
+
+    :param path: path to the .csv or .txt file
+    :return: (kind, structured array)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        return parse_output_buffer(data)
+    except ValueError as err:
+        raise ValueError('%s: %s' % (path, err))
+
+
+def read_header_kind(path):
+    """
+    Returns the kind of an exported output from its header only (read from
+    its first lines, see MAX_PREAMBLE_LINES).
+
+    """
+    with open(path, 'rb') as f:
+        lines = [f.readline().replace(b'\r', b'')
+                 for _ in range(MAX_PREAMBLE_LINES + 1)]
+    return detect_kind(_split_header(lines[_find_header(lines)])[0])
+
+
+def level_field(array):
+    """
+    Returns the name of the metric column of a grid or point output.
+
+    """
+    return array.dtype.names[-1]
+
+
+def find_outputs(output_dir, kind=None):
+    """
+    Returns the exported output files of a directory, in name order.
+
+    :param output_dir: the directory (e.g. OUTPUT1/SEL of a study)
+    :param kind: only return the files of this kind (all if None)
+    :return: list of paths
+    """
+    paths = sorted(p for p in glob.glob(os.path.join(output_dir, '*'))
+                   if os.path.splitext(p)[1].lower() in OUTPUT_EXTENSIONS)
+    if kind is None:
+        return paths
+    return [p for p in paths if read_header_kind(p) == kind]
+
+
+def read_study_outputs(path_to_study, metric):
+    """
+    Reads the outputs exported for a metric of a study. If several files
+    have the same kind, the first one in name order is read.
+
+    :param path_to_study: the study directory
+    :param metric: the noise metric (name of the OUTPUT1 sub-directory)
+    :return: dictionary {kind: structured array}
+    """
+    output_dir = os.path.join(path_to_study, RUN_OUTPUT_DIR, metric.strip())
+    result = {}
+    for path in find_outputs(output_dir):
+        kind = read_header_kind(path)
+        if kind is None:
+            print('%s: output not recognised from its header, skipped'
+                  % path)
+        elif kind not in result:
+            result[kind] = read_output(path)[1]
+    return result
+
+
+def contour_rings(points):
+    """
+    Splits contour points into one ring per contour.
+
+    :param points: structured array of a 'contour_points' output
+    :return: list of (level, contour number, (n, 2) array of x, y)
+    """
+    order = np.lexsort((points['POINT'], points['CONTOUR'], points['LEVEL']))
+    points = points[order]
+    keys = np.stack([points['LEVEL'], points['CONTOUR']], axis=1)
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    xy = np.stack([points['X'], points['Y']], axis=1)
+    return [(points['LEVEL'][s], points['CONTOUR'][s], ring)
+            for s, ring in zip(starts, np.split(xy, starts[1:]))]
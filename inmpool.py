@@ -0,0 +1,243 @@
+# Runs INM studies on several INM instances at once.
+#
+# An INMWorkerPool starts N worker threads. Each worker owns a GUI backend,
+# a non exclusive INMAuto (it only ever kills the INM process it started)
+# and an inmbatch.INMSession, and pulls jobs from a shared queue. A job that
+# fails is put back into the queue, to be retried by any worker in a fresh
+# INM process, until it has used up its retries; a failing job never stops
+# the other workers.
+#
+# Every job must work on its own study folder: two workers never open the
+# same study.
+#
+# NB: the real INM GUI is driven with keystrokes and mouse clicks, which go
+# to the foreground window. Running several pywinauto workers on the same
+# desktop is only safe if each INM instance runs in its own desktop session;
+# the simulated backend (inmsim) has no such limit and is used to measure
+# how throughput scales with the number of workers:
+#   python inmpool.py -w 4 -n 40 --latency run=0.5
+
+import argparse
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+from inmauto import INMAuto
+from inmbackend import PywinautoBackend
+from inmbatch import INMSession
+
+__author__ = 'Thomas Vandenhede'
+
+
+class INMJob(object):
+    """
+    A scenario to run on a study (see INMStudy.run_scenario).
+
+    """
+    def __init__(self, study_folder, grids, run_options, export_options=None,
+                 **kwargs):
+        self.study_folder = study_folder
+        self.grids = grids
+        self.run_options = run_options
+        self.export_options = export_options
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.errors = []
+
+
+class INMWorkerPool(object):
+    """
+    Runs jobs on workers INM instances.
+
+    :param inm_exe_path: path to inm.exe
+    :param workers: number of INM instances
+    :param backend_factory: callable returning a new GUI backend (one per
+    worker)
+    :param retries: number of times a failed job is retried
+    :param recycle_after: number of studies after which a worker restarts
+    its INM (never if None)
+    """
+    def __init__(self, inm_exe_path, workers=2,
+                 backend_factory=PywinautoBackend, retries=1,
+                 recycle_after=50):
+        self.inm_exe_path = inm_exe_path
+        self.workers = workers
+        self.backend_factory = backend_factory
+        self.retries = retries
+        self.recycle_after = recycle_after
+        self.sessions = []
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._results = []
+
+    def run(self, jobs):
+        """
+        Runs every job and returns when they have all succeeded or used up
+        their retries.
+
+        :param jobs: list of INMJob
+        :return: report dictionary
+        """
+        folders = [job.study_folder for job in jobs]
+        if len(set(folders)) != len(folders):
+            raise ValueError('Several jobs work on the same study folder')
+
+        start = time.time()
+        self._results = []
+        self._pending = len(jobs)
+        for job in jobs:
+            self._queue.put(job)
+        threads = [threading.Thread(target=self._work, args=(k,),
+                                    name='inm-worker-%d' % k)
+                   for k in range(min(self.workers, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - start)
+
+    def _work(self, worker_id):
+        session = INMSession(
+            self.inm_exe_path, recycle_after=self.recycle_after, retries=0,
+            inm=INMAuto(self.inm_exe_path, self.backend_factory(),
+                        exclusive=False))
+        with self._lock:
+            self.sessions.append(session)
+        try:
+            while True:
+                with self._lock:
+                    if self._pending == 0:
+                        return
+                try:
+                    job = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue  # jobs being retried by other workers
+                self._run_job(worker_id, session, job)
+        finally:
+            session.close()
+
+    def _run_job(self, worker_id, session, job):
+        job.attempts += 1
+        result = session.run_scenario(job.study_folder, job.grids,
+                                      job.run_options, job.export_options,
+                                      **job.kwargs)
+        if not result['succeeded']:
+            job.errors.append(result['error'])
+            if job.attempts <= self.retries:
+                print('%s failed on worker %d, retrying'
+                      % (job.study_folder, worker_id))
+                self._queue.put(job)
+                return
+        result.update(worker=worker_id, attempts=job.attempts,
+                      errors=job.errors)
+        print('%s: %s (worker %d)' % (job.study_folder, 'done' if
+                                      result['succeeded'] else 'FAILED',
+                                      worker_id))
+        with self._lock:
+            self._results.append(result)
+            self._pending -= 1
+
+    def report(self, total_time):
+        """
+        Summarises the last run.
+
+        :param total_time: wall time of the run (s)
+        :return:
+        """
+        results = sorted(self._results, key=lambda r: r['study'])
+        succeeded = [r for r in results if r['succeeded']]
+        return {
+            'workers': self.workers,
+            'jobs': len(results),
+            'succeeded': len(succeeded),
+            'failed': [r['study'] for r in results if not r['succeeded']],
+            'retries': sum(r['attempts'] - 1 for r in results),
+            'inm_starts': sum(len(s.start_durations) for s in self.sessions),
+            'total_time_s': total_time,
+            'jobs_per_second': len(succeeded) / total_time
+            if total_time else 0.0,
+            'jobs_per_worker': dict(
+                (k, sum(1 for r in results if r['worker'] == k))
+                for k in range(self.workers)),
+            'results': results,
+        }
+
+
+def benchmark_scaling(worker_counts, jobs=20, latencies=None,
+                      failure_rates=None):
+    """
+    Measures the throughput of the pool on the simulated INM for several
+    numbers of workers.
+
+    :param worker_counts: list of numbers of workers
+    :param jobs: number of jobs of each run
+    :param latencies: latencies of the simulated INM
+    :param failure_rates: failure injection of the simulated INM
+    :return: list of (workers, jobs per second, speedup over 1 worker)
+    """
+    import inmauto
+    import inmsim
+
+    run_options = inmauto.RunOptions()
+    run_options.noise_metric = 'SEL'
+    grids = [inmauto.GridSetup()]
+    workspace = tempfile.mkdtemp(prefix='inm_pool_')
+    cwd = os.getcwd()
+    scaling = []
+    try:
+        os.chdir(workspace)
+        folders = ['POOL_%03d' % k for k in range(jobs)]
+        for folder in folders:
+            os.makedirs(os.path.join('INM Studies', folder))
+        for workers in worker_counts:
+            pool = INMWorkerPool(
+                'inm.exe', workers,
+                lambda: inmsim.SimulatedBackend(latencies, failure_rates))
+            report = pool.run([INMJob(f, grids, run_options, None,
+                                      run_options_to_file=True)
+                               for f in folders])
+            scaling.append((workers, report['jobs_per_second']))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+    base = scaling[0][1] / scaling[0][0] if scaling else 0.0
+    return [(w, rate, rate / base if base else 0.0) for w, rate in scaling]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of INMWorkerPool on a '
+                    'simulated INM.')
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('-n', '--jobs', type=int, default=20)
+    parser.add_argument('--latency', action='append', metavar='CATEGORY=S',
+                        help='simulated latency (see inmsim)')
+    parser.add_argument('--failure-rate', action='append',
+                        metavar='CALL=P', help='inject GUI failures')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    def key_values(items):
+        return dict((k, float(v)) for k, v in
+                    (item.split('=', 1) for item in items or []))
+
+    latencies = {'start': 0.2, 'menu': 0.002, 'control': 0.001,
+                 'run': 0.5}
+    latencies.update(key_values(args.latency))
+    scaling = benchmark_scaling(args.workers, args.jobs, latencies,
+                                key_values(args.failure_rate))
+    print('%8s %12s %8s' % ('workers', 'jobs/s', 'speedup'))
+    for workers, rate, speedup in scaling:
+        print('%8d %12.2f %8.2f' % (workers, rate, speedup))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1311 @@
+# In-process simulation of the INM 7.0 GUI.
+#
+# SimulatedBackend replaces PywinautoBackend so that INMAuto and INMStudy
+# can run end-to-end on any platform, for throughput and regression
+# testing. It models the menus, dialogs and MDI windows that inmauto.py
+# drives:
+# - the study 'Open' dialog and the 'Export As' / 'Directories' browsers,
+#   which list the real directories of the local filesystem
+# - 'Grid Points Setup', 'Run Options' and 'Output Setup' windows
+# - 'Run Start', 'Warning' and the untitled 'Run Status' dialog
+# - the 'Scenario Select' / 'Output Select' dialogs and the output windows
+#   of the 'Output' menu
+#
+# A study run lasts latencies['run'] seconds and then writes
+# RUN_OUTPUT_FILES into OUTPUT1. Exports write synthetic but well-formed
+# result files, computed from the grids and run options of the study, so
+# the exported files can be parsed downstream.
+#
+# Every GUI call sleeps for the latency of its category and may fail with
+# SimulatedGUIError (the equivalent of pywinauto's MatchError) according
+# to failure_rates ({call name or category: probability}).
+#
+# Simulation conventions (not INM behaviour):
+# - file dialogs start at the drive level, whose only entry is the drive
+#   of the current working directory ('\\' on POSIX systems)
+# - the 'Export As' dialog saves as soon as the browsed directory has no
+#   subdirectory, which is always the case of the OUTPUT1/<metric> folders
+#   INMAuto exports to
+# - ENTER goes to the file name box of 'Export As' only if it was given the
+#   focus (SetFocus or Click)
+# - the latencies['run'] seconds of a run only start once the 'Run Status'
+#   dialog has been seen as the top window, so that a short simulated run
+#   cannot end before INMAuto sees it start (a real run outlasts that)
+
+import collections
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+import inmtables
+from inmbackend import GUIBackend
+from inmwatch import RUN_OUTPUT_DIR
+
+__author__ = 'Thomas Vandenhede'
+
+# Result files written into OUTPUT1 by a simulated run (simulation
+# convention, not the files of a real INM run)
+RUN_OUTPUT_FILES = ('RUN.LOG', 'NOISE.OUT')
+
+# Latency (s) of each category of GUI call
+DEFAULT_LATENCIES = {
+    'start': 0.0,    # process start
+    'menu': 0.0,     # menu item click
+    'control': 0.0,  # click, select, edit... on a control
+    'query': 0.0,    # reading texts, item lists, states
+    'render': 0.0,   # delay before an output window is displayed
+    'run': 0.0,      # duration of a study run
+    'export': 0.0,   # writing an export file
+}
+
+CONTROL_CALLS = ('Click', 'Check', 'UnCheck', 'Select', 'SetEditText',
+                 'SetFocus', 'TypeKeys', 'Maximize')
+QUERY_CALLS = ('Texts', 'ItemTexts', 'ItemCount', 'GetItemFocus',
+               'GetCheckState', 'WindowText', 'Text', 'IsEnabled',
+               'IsVisible', 'Exists')
+
+SCENARIOS = ['SCEN1']
+FILE_TYPES = ['Text (*.txt)', 'Comma Delimited (*.csv)']
+MAIN_TITLE = 'INM 7.0'
+DEFAULT_METRIC = 'LAMAX '
+
+# Run Options controls -> RunOptions parameters
+RUN_OPTIONS_CONTROLS = {
+    'Run TypeComboBox': 'run_type',
+    'Noise MetricComboBox': 'noise_metric',
+    'Do TerrainCheckBox': 'do_terrain',
+    'Lateral AttenuationComboBox': 'lateral_attenuation',
+    'Use Bank AngleCheckBox': 'use_bank_angle',
+    'Do ContoursCheckBox': 'do_contours',
+    'Use Boundary FileCheckBox': 'use_boundary_file',
+    'Fixed GridRadioButton': 'fixed_grid',
+    'Recursive Grid': None,
+    'Fixed SpacingRadioButton': 'fixed_spacing',
+    'RefinementRadioButton': None,
+    'SpacingEdit': 'spacing',
+    'RefinementComboBox': 'refinement',
+    'ToleranceEdit': 'tolerance',
+    'Low CutoffEdit': 'low_cutoff',
+    'High CutoffEdit': 'high_cutoff',
+    'Do Population PointsCheckBox': 'do_population_points',
+    'Do Location PointsCheckBox': 'do_location_points',
+    'Do Standard GridsCheckBox': 'do_standard_grids',
+    'Do Detailed GridsCheckBox': 'do_detailed_grids',
+    'Save 100% FlightsCheckBox': 'save_all_flights',
+}
+for _metric in ('DNL', 'CNEL', 'LAEQ', 'LAEQD', 'LAEQN', 'SEL', 'LAMAX',
+                'TALA', 'NEF', 'WECPNL', 'EPNL', 'PNLTM', 'TAPNL', 'CEXP',
+                'LCMAX', 'TALC'):
+    RUN_OPTIONS_CONTROLS[_metric + 'CheckBox'] = _metric.lower()
+
+# Grid Points Setup controls -> GridSetup parameters
+GRID_CONTROLS = {
+    'Grip TypeComboBox': 'grid_type',
+    'Relative ThresholdRadioButton': None,
+    'Ambient + Delta (dB)Edit': 'relative_threshold',
+    'Fixed Threshold (dB)RadioButton': None,
+    'Fixed Threshold (dB)Edit': 'fixed_threshold',
+    'Do Percent of Time (hr)CheckBox': None,
+    'Do Percent of Time (hr)Edit': 'do_percent_of_time',
+    'X/YRadioButton': None,
+    'X (nmi)Edit': 'x',
+    'Y (nmi)Edit': 'y',
+    'I (nmi)Edit': 'i',
+    'J (nmi)Edit': 'j',
+    'Grid Rotation Angle (deg)Edit': 'grid_rotation_angle',
+    'Grid IdEdit': 'grid_id',
+    'IEdit': 'nb_pts_i',
+    'JEdit': 'nb_pts_j',
+}
+
+# Output menu items -> (selection dialog, output window title, export kind,
+# default export file name)
+OUTPUT_MENUS = {
+    'Output->Output Graphics...':
+        ('Output Select', 'Output Graphics', 'graphics', 'GRAPHICS'),
+    'Output->Contour Points...':
+        ('Output Select', 'Contour Points', 'contour_points', 'CNTPTS'),
+    'Output->Contour Area and Pop...':
+        ('Output Select', 'Contour Area and Population',
+         'contour_area_and_pop', 'CNTAREA'),
+    'Output->Area Contour Coverage...':
+        (None, 'Area Contour Coverage', 'area_contour_coverage', 'AREACOV'),
+    'Output->Standard Grids...':
+        ('Scenario Select', 'Standard Grids', 'standard_grids', 'STDGRID'),
+    'Output->Detailed Grids...':
+        ('Scenario Select', 'Detailed Grids', 'detailed_grids', 'DETGRID'),
+    'Output->Noise at Pop Points...':
+        ('Scenario Select', 'Noise at Pop Points', 'pop_points', 'POPPTS'),
+    'Output->Noise at Loc Points...':
+        ('Scenario Select', 'Noise at Loc Points', 'loc_points', 'LOCPTS'),
+    'Output->Flight Path Report...':
+        ('Scenario Select', 'Flight Path Report', 'flight_path_report',
+         'FLTPATH'),
+}
+
+# Flights of the synthetic detailed grid results: (name, lateral offset of
+# the track in nmi, level offset in dB)
+SIM_FLIGHTS = [('FLT1', 0.0, 0.0), ('FLT2', 0.3, -2.0), ('FLT3', -0.4, -4.0)]
+
+
+class SimulatedGUIError(Exception):
+    """
+    Raised when a window, control or menu item cannot be found or used
+    (the equivalent of pywinauto's MatchError).
+
+    """
+    pass
+
+
+class SimulatedTimeoutError(Exception):
+    pass
+
+
+class SimulatedBackend(GUIBackend):
+    """
+    Backend running a simulated INM inside the Python process.
+
+    :param latencies: {category: seconds}, see DEFAULT_LATENCIES
+    :param failure_rates: {call name or category: probability of failure}
+    :param seed: seed of the random generator used for failure injection
+    """
+    errors = (SimulatedGUIError,)
+    timeout_errors = (SimulatedTimeoutError,)
+    # INMAuto.run_output_files of the simulated INM
+    run_output_files = RUN_OUTPUT_FILES
+
+    def __init__(self, latencies=None, failure_rates=None, seed=None):
+        GUIBackend.__init__(self)
+        self.latencies = dict(DEFAULT_LATENCIES)
+        self.latencies.update(latencies or {})
+        self.failure_rates = dict(failure_rates or {})
+        self.random = random.Random(seed)
+        self.failures = collections.Counter()
+        self.inm = None
+        self.starts = 0
+
+    def application(self):
+        return SimApplication(self)
+
+    def kill_inm(self):
+        if self.inm is not None:
+            self.inm.terminate()
+            self.inm = None
+
+    def find_windows(self, title_re, process=None):
+        # a simulated backend runs a single INM: process is not checked
+        self.calls['find_windows'] += 1
+        if self.inm is None:
+            return []
+        return [id(w) for w in self.inm.top_level_windows()
+                if re.match(title_re, w.title)]
+
+    def call(self, name, category=None):
+        """
+        Accounts for a GUI call: counts it, waits for its latency and
+        injects a failure with the configured probability.
+
+        :param name: name of the call (e.g. 'Click')
+        :param category: latency category (guessed from name if None)
+        :return:
+        """
+        if category is None:
+            if name in CONTROL_CALLS:
+                category = 'control'
+            elif name in QUERY_CALLS:
+                category = 'query'
+            else:
+                category = 'menu'
+        self.calls[name] += 1
+        delay = self.latencies.get(category, 0.0)
+        if delay:
+            time.sleep(delay)
+        rate = self.failure_rates.get(name, self.failure_rates.get(category))
+        if rate and category != 'query' and self.random.random() < rate:
+            self.failures[name] += 1
+            raise SimulatedGUIError("Injected failure in %s" % name)
+
+    def get_inm(self):
+        if self.inm is None or not self.inm.running:
+            raise SimulatedGUIError("INM is not running")
+        return self.inm
+
+
+def _title_matches(key, title):
+    """
+    Loose title matching in the spirit of pywinauto's best match: exact
+    title, substring or regular expression.
+
+    """
+    if key == title or key in title:
+        return True
+    try:
+        return re.match(key + '$', title) is not None
+    except re.error:
+        return False
+
+
+def _to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class SimControl(object):
+    """
+    State of a control: text, items, selection and check state. A free
+    control (edit, combo box of the option windows) accepts any value.
+
+    """
+    def __init__(self, name, items=None, text='', checked=False,
+                 free=False):
+        self.name = name
+        self.items = list(items or [])
+        self.text = text
+        self.checked = checked
+        self.free = free
+        self.selected = -1
+
+
+class SimWindow(object):
+    """
+    A simulated window. Dialogs are modal; MDI windows live inside the main
+    window. Subclasses react to control actions through on_action.
+
+    """
+    modal = True
+    class_name = '#32770'
+    kind = None
+
+    def __init__(self, inm, title, controls=()):
+        self.inm = inm
+        self.title = title
+        self.controls = dict((c.name, c) for c in controls)
+        self.visible_at = 0.0
+        # called the first time the window is seen as the top window
+        self.on_shown = None
+
+    def get_control(self, name):
+        try:
+            return self.controls[name]
+        except KeyError:
+            raise SimulatedGUIError("No control '%s' in window '%s'"
+                                    % (name, self.title))
+
+    def has_control(self, name):
+        return name in self.controls
+
+    def on_action(self, control, action, arg):
+        pass
+
+    def on_keys(self, keys):
+        # ESC cancels a dialog, but not the 'Run Status' one
+        if '{ESC}' in keys and self.modal and self.title:
+            self.close()
+
+    def close(self):
+        self.inm.remove_window(self)
+
+
+class SimMDIWindow(SimWindow):
+    modal = False
+    class_name = 'AfxFrameOrView42'
+
+
+class SimOptionsWindow(SimMDIWindow):
+    """
+    MDI window whose controls hold the parameters of a StudyOptions object
+    ('Run Options', 'Output Setup').
+
+    """
+    def __init__(self, inm, title, control_map, params):
+        controls = []
+        for name, param in control_map.items():
+            value = params.get(param) if param else None
+            if name.endswith('CheckBox') or name.endswith('RadioButton'):
+                controls.append(SimControl(name, checked=bool(value)))
+            else:
+                text = '' if value is None else str(value)
+                controls.append(SimControl(name, text=text, free=True))
+        SimMDIWindow.__init__(self, inm, title, controls)
+        self.control_map = control_map
+        self.params = params
+
+    def on_action(self, control, action, arg):
+        param = self.control_map.get(control.name)
+        if param is None:
+            return
+        if action in ('Check', 'UnCheck', 'Click'):
+            self.params[param] = control.checked
+        elif action in ('Select', 'SetEditText'):
+            self.params[param] = control.text
+
+
+class SimGridWindow(SimMDIWindow):
+    """
+    'Grid Points Setup' window: a list of grid records edited through the
+    Edit menu and the grid controls.
+
+    """
+    kind = 'grid_setup'
+
+    def __init__(self, inm):
+        controls = [SimControl('ListBox')]
+        controls += [SimControl(name, free=True) for name in GRID_CONTROLS]
+        SimMDIWindow.__init__(self, inm, 'Grid Points Setup', controls)
+        self.current = None
+        self.refresh()
+
+    def refresh(self):
+        self.get_control('ListBox').items = [
+            str(g.get('grid_id') or g.get('grid_type')) for g in
+            self.inm.study.grids]
+
+    def add_record(self):
+        self.current = {'grid_type': 'Location', 'coordinates': 'X/Y'}
+        self.inm.study.grids.append(self.current)
+        self.refresh()
+
+    def delete_record(self):
+        if self.inm.study.grids:
+            self.inm.study.grids.pop(0)
+        self.current = None
+        self.refresh()
+
+    def on_action(self, control, action, arg):
+        param = GRID_CONTROLS.get(control.name)
+        if param is None or self.current is None:
+            return
+        if action in ('Select', 'SetEditText'):
+            self.current[param] = control.text
+            self.refresh()
+
+
+class SimOutputWindow(SimMDIWindow):
+    """
+    Output window opened from the 'Output' menu. It contains a child
+    window titled after the output, displayed after the render latency.
+
+    """
+    def __init__(self, inm, title, kind, export_name):
+        SimMDIWindow.__init__(self, inm, title)
+        self.kind = kind
+        self.export_name = export_name
+        self.visible_at = time.time() + inm.backend.latencies['render']
+
+
+class SimSelectDialog(SimWindow):
+    """
+    'Scenario Select' and 'Output Select' dialogs. OK opens the window the
+    selection was made for.
+
+    """
+    def __init__(self, inm, title, on_ok):
+        SimWindow.__init__(self, inm, title, [
+            SimControl('ListBox', SCENARIOS), SimControl('OKButton')])
+        self.on_ok = on_ok
+
+    def on_action(self, control, action, arg):
+        if control.name == 'OKButton' and action == 'Click':
+            if self.get_control('ListBox').selected < 0:
+                raise SimulatedGUIError("No scenario selected")
+            self.close()
+            self.on_ok()
+
+
+class SimMessageDialog(SimWindow):
+    """
+    Message box closed by its button ('OKButton', 'OuiButton'...).
+
+    """
+    def __init__(self, inm, title, button, on_click=None, text=''):
+        SimWindow.__init__(self, inm, title, [
+            SimControl(button), SimControl('Static2', [text], text)])
+        self.button = button
+        self.on_click = on_click
+
+    def on_action(self, control, action, arg):
+        if control.name == self.button and action == 'Click':
+            self.close()
+            if self.on_click:
+                self.on_click()
+
+
+class SimRunStartDialog(SimWindow):
+    def __init__(self, inm):
+        SimWindow.__init__(self, inm, 'Run Start', [
+            SimControl('Scenario ListListBox', SCENARIOS),
+            SimControl('Include --- >ListBox'), SimControl('OKButton')])
+
+    def on_action(self, control, action, arg):
+        if control.name == 'OKButton' and action == 'Click':
+            self.close()
+            if self.inm.study.has_run():
+                self.inm.open_window(SimMessageDialog(
+                    self.inm, 'Warning', 'OuiButton', self.inm.start_run))
+            else:
+                self.inm.start_run()
+
+
+class SimFileDialog(SimWindow):
+    """
+    Directory browser shared by the 'Open', 'Export As' and 'Directories'
+    dialogs. The 'ListBox' control lists the drive, then the parent ('..')
+    and subdirectories of the current directory; ENTER enters the selected
+    item.
+
+    """
+    def __init__(self, inm, title, controls=()):
+        SimWindow.__init__(self, inm, title,
+                           [SimControl('ListBox')] + list(controls))
+        self.cwd = None
+        self.list_directory()
+
+    @staticmethod
+    def drive_label():
+        drive = os.path.splitdrive(os.getcwd())[0]
+        return drive.lower() + '\\'
+
+    def list_directory(self):
+        listbox = self.get_control('ListBox')
+        if self.cwd is None:
+            listbox.items = [self.drive_label()]
+        else:
+            try:
+                names = sorted(n for n in os.listdir(self.cwd)
+                               if os.path.isdir(os.path.join(self.cwd, n)))
+            except OSError:
+                names = []
+            listbox.items = ['..'] + names
+        listbox.selected = -1
+
+    def enter(self, index):
+        listbox = self.get_control('ListBox')
+        if not 0 <= index < len(listbox.items):
+            raise SimulatedGUIError("Nothing selected in '%s'" % self.title)
+        item = listbox.items[index]
+        if self.cwd is None:
+            self.cwd = os.path.splitdrive(os.getcwd())[0] + os.sep
+        elif item == '..':
+            self.cwd = os.path.dirname(self.cwd.rstrip(os.sep)) or os.sep
+        else:
+            self.cwd = os.path.join(self.cwd, item)
+        self.list_directory()
+        self.on_enter()
+
+    def on_enter(self):
+        pass
+
+    def on_keys(self, keys):
+        SimWindow.on_keys(self, keys)
+        listbox = self.get_control('ListBox')
+        for key in re.findall(r'\{(\w+)\}', keys):
+            if key == 'HOME':
+                listbox.selected = 0
+            elif key == 'ENTER':
+                self.enter(listbox.selected)
+
+
+class SimOpenDialog(SimFileDialog):
+    def __init__(self, inm):
+        SimFileDialog.__init__(self, inm, 'Open Study',
+                               [SimControl('OKButton')])
+
+    def on_action(self, control, action, arg):
+        if control.name == 'OKButton' and action == 'Click':
+            if self.cwd is None:
+                raise SimulatedGUIError("No study directory selected")
+            self.close()
+            self.inm.open_study(self.cwd)
+
+
+class SimExportDialog(SimFileDialog):
+    """
+    'Export As' dialog of an output window.
+
+    """
+    def __init__(self, inm, output):
+        SimFileDialog.__init__(self, inm, 'Export As', [
+            SimControl('File NameEdit', [output.export_name],
+                       output.export_name),
+            SimControl('List Files or TypeComboBox', text=FILE_TYPES[0],
+                       free=True),
+            SimControl('OKButton')])
+        self.output = output
+        self.focus = None
+
+    def export_path(self):
+        name = self.get_control('File NameEdit').text
+        file_type = self.get_control('List Files or TypeComboBox').text
+        ext = re.search(r'\*(\.\w+)', file_type)
+        if not os.path.splitext(name)[1]:
+            name += ext.group(1) if ext else '.txt'
+        return os.path.join(self.cwd, name)
+
+    def on_enter(self):
+        if len(self.get_control('ListBox').items) == 1:  # only '..'
+            self.save()
+
+    def on_keys(self, keys):
+        if '{ENTER}' in keys and self.focus == 'File NameEdit':
+            self.enter_path()
+        else:
+            SimFileDialog.on_keys(self, keys)
+
+    def enter_path(self):
+        """
+        ENTER in the file name box: a directory path goes to the directory,
+        a file path in an existing directory saves the file.
+
+        """
+        edit = self.get_control('File NameEdit')
+        directory, name = os.path.split(edit.text)
+        if not directory:
+            if self.cwd is None:
+                raise SimulatedGUIError("No directory selected")
+            self.save()
+        elif os.path.isdir(edit.text):
+            self.cwd = edit.text
+            edit.text = ''
+            self.list_directory()
+        elif os.path.isdir(directory):
+            self.cwd = directory
+            edit.text = name
+            self.save()
+        else:
+            raise SimulatedGUIError("Path '%s' does not exist" % edit.text)
+
+    def save(self):
+        path = self.export_path()
+        self.close()
+        if os.path.exists(path):
+            self.inm.open_window(SimMessageDialog(
+                self.inm, 'Export As', 'ReplaceButton',
+                lambda: self.inm.write_export(self.output, path)))
+        else:
+            self.inm.write_export(self.output, path)
+
+    def on_action(self, control, action, arg):
+        if action in ('SetFocus', 'Click'):
+            self.focus = control.name
+        if control.name == 'OKButton' and action == 'Click':
+            if self.cwd is None:
+                raise SimulatedGUIError("No directory selected")
+            self.save()
+
+
+class SimDirectoriesDialog(SimFileDialog):
+    def __init__(self, inm, on_ok):
+        SimFileDialog.__init__(self, inm, 'Directories',
+                               [SimControl('OKButton')])
+        self.on_ok = on_ok
+
+    def on_action(self, control, action, arg):
+        if control.name == 'OKButton' and action == 'Click':
+            self.close()
+            self.on_ok(self.cwd)
+
+
+class SimShapefileDialog(SimWindow):
+    def __init__(self, inm, output):
+        SimWindow.__init__(self, inm, 'Export As Shapefile', [
+            SimControl('Export UnitsComboBox', text='feet', free=True),
+            SimControl('BrowseButton'), SimControl('OKButton')])
+        self.output = output
+        self.directory = None
+
+    def set_directory(self, directory):
+        self.directory = directory
+
+    def on_action(self, control, action, arg):
+        if control.name == 'BrowseButton' and action == 'Click':
+            self.inm.open_window(
+                SimDirectoriesDialog(self.inm, self.set_directory))
+        elif control.name == 'OKButton' and action == 'Click':
+            if self.directory is None:
+                raise SimulatedGUIError("No export directory")
+            self.close()
+            path = os.path.join(self.directory, '%s_%s.shp' % (
+                self.output.export_name, self.inm.study.folder))
+            self.inm.write_export(self.output, path)
+
+
+class SimStudy(object):
+    """
+    Study opened in the simulated INM: its grids and run options are read
+    from the study tables when they exist and edited through the dialogs.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.basename(path.rstrip(os.sep))
+        try:
+            self.grids = inmtables.read_grid_table(path)
+        except (IOError, OSError):
+            self.grids = []
+        try:
+            self.run_options = inmtables.read_run_options_table(path)
+        except (IOError, OSError):
+            self.run_options = {'noise_metric': DEFAULT_METRIC}
+        self.output_metric = self.run_options.get('noise_metric')
+        # flight level offset, so that studies give different results
+        self.level_offset = zlib.crc32(self.folder.encode()) % 1000 / 100.0
+
+    @property
+    def output_dir(self):
+        return os.path.join(self.path, RUN_OUTPUT_DIR)
+
+    def has_run(self):
+        return os.path.exists(os.path.join(self.output_dir,
+                                           RUN_OUTPUT_FILES[0]))
+
+    def metric(self):
+        return str(self.output_metric or DEFAULT_METRIC).strip().upper()
+
+    def level(self, x, y, flight_offset=0.0, level_offset=0.0):
+        """
+        Synthetic noise level (dB) at (x, y) in nmi for a straight track
+        along the x axis.
+
+        """
+        r = math.hypot(y - flight_offset, 0.25) + 0.05 * abs(x)
+        return (90.0 + self.level_offset + level_offset -
+                20.0 * math.log10(max(r, 0.05) / 0.25))
+
+
+class SimulatedINM(object):
+    """
+    State of a simulated INM process: main window, window stack, opened
+    study and run in progress.
+
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.running = True
+        self.lock = threading.RLock()
+        self.dialogs = []
+        self.mdi_windows = []
+        self.study = None
+        self.run_timer = None
+        self.run_done = threading.Event()
+        self.run_done.set()
+
+    @property
+    def title(self):
+        if self.study is None:
+            return MAIN_TITLE
+        return '%s - [Study %s]' % (MAIN_TITLE, self.study.path.upper())
+
+    def terminate(self):
+        with self.lock:
+            self.running = False
+            if self.run_timer is not None:
+                self.run_timer.cancel()
+            self.run_done.set()
+
+    def top_level_windows(self):
+        with self.lock:
+            return [self.main_window()] + list(self.dialogs)
+
+    def main_window(self):
+        window = SimWindow(self, self.title)
+        window.modal = False
+        return window
+
+    def is_ready(self):
+        with self.lock:
+            return not self.dialogs and self.run_done.is_set()
+
+    def open_window(self, window):
+        with self.lock:
+            if window.modal:
+                self.dialogs.append(window)
+            else:
+                self.mdi_windows.append(window)
+
+    def remove_window(self, window):
+        with self.lock:
+            for windows in (self.dialogs, self.mdi_windows):
+                if window in windows:
+                    windows.remove(window)
+
+    def active_window(self):
+        with self.lock:
+            if self.dialogs:
+                return self.dialogs[-1]
+            if self.mdi_windows:
+                return self.mdi_windows[-1]
+            return None
+
+    def find_control_window(self, name):
+        """
+        Returns the window a control name resolves to when searched from
+        the main window: the most recent MDI window owning it.
+
+        """
+        with self.lock:
+            for window in reversed(self.mdi_windows):
+                if window.has_control(name):
+                    return window
+        return None
+
+    # menus
+    def menu_enabled(self, path):
+        with self.lock:
+            if self.dialogs or not self.run_done.is_set():
+                return False
+            active = self.mdi_windows[-1] if self.mdi_windows else None
+        if path in ('File->Open Study...', 'File->Exit', 'Window->Cascade',
+                    'Window->Close All'):
+            return True
+        if path.startswith('Edit->'):
+            return isinstance(active, SimGridWindow)
+        if path == 'File->Export As...':
+            return isinstance(active, SimOutputWindow)
+        if path == 'File->Export as ShapeFile...':
+            return (isinstance(active, SimOutputWindow) and
+                    active.kind == 'graphics')
+        return self.study is not None
+
+    def click_menu(self, path):
+        if path not in MENU_ITEMS:
+            raise SimulatedGUIError("No menu item '%s'" % path)
+        if not self.menu_enabled(path):
+            raise SimulatedGUIError("Menu item '%s' is disabled" % path)
+        active = self.active_window()
+        if path == 'File->Open Study...':
+            self.open_window(SimOpenDialog(self))
+        elif path == 'File->Close Study':
+            self.close_study()
+        elif path == 'File->Exit':
+            self.terminate()
+        elif path == 'File->Export As...':
+            self.open_window(SimExportDialog(self, active))
+        elif path == 'File->Export as ShapeFile...':
+            self.open_window(SimShapefileDialog(self, active))
+        elif path == 'Window->Close All':
+            with self.lock:
+                del self.mdi_windows[:]
+        elif path == 'Edit->Add Record':
+            active.add_record()
+        elif path == 'Edit->Delete Records':
+            active.delete_record()
+        elif path == 'Run->Grid Setup...':
+            self.open_window(SimSelectDialog(
+                self, 'Scenario Select',
+                lambda: self.open_window(SimGridWindow(self))))
+        elif path == 'Run->Run Options':
+            self.open_window(SimOptionsWindow(
+                self, 'Run Options', RUN_OPTIONS_CONTROLS,
+                self.study.run_options))
+        elif path == 'Run->Run Start...':
+            self.open_window(SimRunStartDialog(self))
+        elif path == 'Output->Output Setup':
+            self.open_window(SimOptionsWindow(
+                self, 'Output Setup', {'MetricComboBox': 'metric'},
+                {'metric': self.study.output_metric}))
+        elif path in OUTPUT_MENUS:
+            self.open_output(path)
+
+    def open_output(self, path):
+        select_title, title, kind, export_name = OUTPUT_MENUS[path]
+
+        def show():
+            self.open_window(SimOutputWindow(self, title, kind, export_name))
+            if kind == 'flight_path_report':
+                self.open_window(SimMessageDialog(
+                    self, MAIN_TITLE, 'OKButton'))
+
+        if select_title is None:
+            # without contours INM only shows an error, no output window
+            if self.study.run_options.get('do_contours'):
+                show()
+            else:
+                self.open_window(SimMessageDialog(self, 'ERROR', 'OKButton'))
+        else:
+            self.open_window(SimSelectDialog(self, select_title, show))
+
+    # study
+    def open_study(self, path):
+        with self.lock:
+            del self.mdi_windows[:]
+            self.study = SimStudy(path)
+
+    def close_study(self):
+        with self.lock:
+            del self.mdi_windows[:]
+            self.study = None
+
+    def set_output_metric(self, metric):
+        self.study.output_metric = metric
+
+    def start_run(self):
+        status = SimWindow(self, '')
+        self.open_window(status)
+        self.run_done.clear()
+        study = self.study
+
+        def finish():
+            with self.lock:
+                if not self.running:
+                    return
+                self.write_run_outputs(study)
+                self.remove_window(status)
+                self.run_timer = None
+                self.run_done.set()
+
+        def start_timer():
+            with self.lock:
+                if not self.running:
+                    return
+                self.run_timer = threading.Timer(
+                    self.backend.latencies['run'], finish)
+                self.run_timer.daemon = True
+                self.run_timer.start()
+
+        status.on_shown = start_timer
+
+    def write_run_outputs(self, study):
+        if not os.path.exists(study.output_dir):
+            os.makedirs(study.output_dir)
+        with open(os.path.join(study.output_dir, RUN_OUTPUT_FILES[1]),
+                  'w') as f:
+            f.write('metric %s\n' % study.metric())
+            for g in study.grids:
+                f.write('grid %s %s\n' % (g.get('grid_id'),
+                                          g.get('grid_type')))
+        with open(os.path.join(study.output_dir, RUN_OUTPUT_FILES[0]),
+                  'w') as f:
+            f.write('Run finished %s\n' % time.ctime())
+
+    # exports
+    def write_export(self, output, path):
+        """
+        Writes the synthetic result file of an output window.
+
+        """
+        delay = self.backend.latencies['export']
+        if delay:
+            time.sleep(delay)
+        csv = path.lower().endswith('.csv')
+        rows = self.export_rows(output.kind)
+        with open(path, 'w') as f:
+            for row in rows:
+                if csv:
+                    f.write(','.join(str(v) for v in row) + '\n')
+                else:
+                    f.write(' '.join(str(v).rjust(10) for v in row) + '\n')
+
+    def _grid_points(self, grid_types):
+        study = self.study
+        for g in study.grids:
+            if str(g.get('grid_type')) not in grid_types:
+                continue
+            x0, y0 = _to_float(g.get('x'), -8.0), _to_float(g.get('y'), -8.0)
+            di, dj = _to_float(g.get('i'), 16.0), _to_float(g.get('j'), 16.0)
+            ni = int(_to_float(g.get('nb_pts_i'), 2))
+            nj = int(_to_float(g.get('nb_pts_j'), 2))
+            angle = math.radians(_to_float(g.get('grid_rotation_angle')))
+            for j in range(nj):
+                for i in range(ni):
+                    u, v = i * di, j * dj
+                    x = x0 + u * math.cos(angle) - v * math.sin(angle)
+                    y = y0 + u * math.sin(angle) + v * math.cos(angle)
+                    yield g.get('grid_id') or 'GRID', i + 1, j + 1, x, y
+
+    def export_rows(self, kind):
+        study = self.study
+        metric = study.metric()
+        if kind == 'standard_grids':
+            rows = [('GRID_ID', 'I', 'J', 'X', 'Y', metric)]
+            for gid, i, j, x, y in self._grid_points(('Standard',)):
+                rows.append((gid, i, j, '%.4f' % x, '%.4f' % y,
+                             '%.2f' % study.level(x, y)))
+            return rows
+        if kind == 'detailed_grids':
+            rows = [('GRID_ID', 'I', 'J', 'X', 'Y', 'FLIGHT', metric)]
+            for gid, i, j, x, y in self._grid_points(('Detailed',)):
+                for flight, offset, delta in SIM_FLIGHTS:
+                    rows.append((gid, i, j, '%.4f' % x, '%.4f' % y, flight,
+                                 '%.2f' % study.level(x, y, offset, delta)))
+            return rows
+        if kind in ('loc_points', 'pop_points'):
+            header = ['NAME', 'X', 'Y', metric]
+            if kind == 'pop_points':
+                header.insert(3, 'POP')
+            rows = [tuple(header)]
+            for k in range(10):
+                x, y = -4.0 + k, 0.5 * (k % 4) - 0.75
+                row = ['P%02d' % (k + 1), '%.4f' % x, '%.4f' % y]
+                if kind == 'pop_points':
+                    row.append(str(100 * (k + 1)))
+                row.append('%.2f' % study.level(x, y))
+                rows.append(tuple(row))
+            return rows
+        if kind in ('contour_points', 'graphics'):
+            rows = [('LEVEL', 'CONTOUR', 'POINT', 'X', 'Y')]
+            for n, level in enumerate((65.0, 75.0, 85.0)):
+                r = 0.25 * 10 ** ((90.0 + study.level_offset - level) / 20.0)
+                for k in range(36):
+                    a = 2 * math.pi * k / 36
+                    rows.append(('%.1f' % level, n + 1, k + 1,
+                                 '%.4f' % (2 * r * math.cos(a)),
+                                 '%.4f' % (r * math.sin(a))))
+            return rows
+        if kind in ('contour_area_and_pop', 'area_contour_coverage'):
+            rows = [('LEVEL', 'AREA', 'POP')]
+            for level in (65.0, 75.0, 85.0):
+                r = 0.25 * 10 ** ((90.0 + study.level_offset - level) / 20.0)
+                rows.append(('%.1f' % level, '%.4f' % (2 * math.pi * r * r),
+                             '0'))
+            return rows
+        return [('STUDY', 'METRIC'), (study.folder, metric)]
+
+
+MENU_ITEMS = (
+    'File->Open Study...', 'File->Close Study', 'File->Exit',
+    'File->Export As...', 'File->Export as ShapeFile...',
+    'Edit->Add Record', 'Edit->Delete Records',
+    'Window->Cascade', 'Window->Close All',
+    'Run->Grid Setup...', 'Run->Run Options', 'Run->Run Start...',
+    'Output->Output Setup') + tuple(OUTPUT_MENUS)
+
+
+class SimApplication(object):
+    """
+    pywinauto-like Application bound to a SimulatedBackend.
+
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def start(self, cmd_line):
+        self.backend.call('start', 'start')
+        self.backend.kill_inm()
+        self.backend.inm = SimulatedINM(self.backend)
+        self.backend.starts += 1
+
+    def kill_(self):
+        self.backend.call('kill_', 'menu')
+        self.backend.kill_inm()
+
+    @property
+    def process(self):
+        return None if self.backend.inm is None else id(self.backend.inm)
+
+    def window_(self, title=None, title_re=None):
+        return SimWindowSpec(self.backend, title=title, title_re=title_re)
+
+    def top_window_(self):
+        self.backend.call('top_window_', 'query')
+        inm = self.backend.get_inm()
+        with inm.lock:
+            if inm.dialogs:
+                window = inm.dialogs[-1]
+                on_shown, window.on_shown = window.on_shown, None
+            else:
+                window, on_shown = None, None
+        if on_shown:
+            on_shown()
+        return SimWindowSpec(self.backend, window=window)
+
+    def __getitem__(self, key):
+        return SimWindowSpec(self.backend, title_re=key, loose=True)
+
+
+class SimWindowSpec(object):
+    """
+    pywinauto-like window specification: the window is looked up again on
+    every call, so a specification outlives title changes.
+
+    """
+    def __init__(self, backend, title=None, title_re=None, window=None,
+                 loose=False):
+        self.backend = backend
+        self.title = title
+        self.title_re = title_re
+        self.window = window
+        self.loose = loose
+        self.is_main = window is None and title is None and title_re is None
+
+    def resolve(self):
+        """
+        Returns the SimWindow designated by the specification, or None for
+        the main window.
+
+        """
+        inm = self.backend.get_inm()
+        if self.window is not None:
+            if self.window not in inm.dialogs:
+                raise SimulatedGUIError("Window '%s' was closed"
+                                        % self.window.title)
+            return self.window
+        if self.is_main or self._matches(inm.title):
+            return None
+        with inm.lock:
+            candidates = list(reversed(inm.dialogs))
+        for window in candidates:
+            if self._matches(window.title):
+                return window
+        raise SimulatedGUIError("No window matching '%s'"
+                                % (self.title or self.title_re))
+
+    def _matches(self, title):
+        if self.title is not None:
+            return title == self.title
+        if self.loose:
+            return _title_matches(self.title_re, title)
+        return re.match(self.title_re, title) is not None
+
+    def _control_window(self, name):
+        window = self.resolve()
+        if window is None:
+            window = self.backend.get_inm().find_control_window(name)
+            if window is None:
+                raise SimulatedGUIError("No control '%s'" % name)
+        return window
+
+    def __getitem__(self, name):
+        return SimControlSpec(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return SimControlSpec(self, name)
+
+    # window methods
+    def Exists(self, timeout=0, retry_interval=0):
+        self.backend.call('Exists')
+        try:
+            self.resolve()
+            return True
+        except SimulatedGUIError:
+            return False
+
+    def WindowText(self):
+        self.backend.call('WindowText')
+        window = self.resolve()
+        return self.backend.get_inm().title if window is None \
+            else window.title
+
+    def IsVisible(self):
+        self.backend.call('IsVisible')
+        self.resolve()
+        return True
+
+    def IsEnabled(self):
+        self.backend.call('IsEnabled')
+        window = self.resolve()
+        if window is None:
+            return self.backend.get_inm().is_ready()
+        return True
+
+    def _is_ready(self):
+        window = self.resolve()
+        return window is not None or self.backend.get_inm().is_ready()
+
+    def Wait(self, wait_for, timeout=5, retry_interval=0.09):
+        self.backend.call('Wait', 'query')
+        inm = self.backend.get_inm()
+        deadline = time.time() + timeout
+        while not self._is_ready():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SimulatedTimeoutError("Timed out waiting for '%s'"
+                                            % wait_for)
+            if not inm.run_done.is_set():
+                inm.run_done.wait(remaining)
+            else:
+                time.sleep(min(retry_interval, remaining))
+        return self
+
+    def WaitNot(self, wait_for_not, timeout=5, retry_interval=0.09):
+        """
+        Nothing but a dialog or a run can make the main window busy, so
+        this does not wait.
+
+        """
+        self.backend.call('WaitNot', 'query')
+        if self._is_ready():
+            raise SimulatedTimeoutError("Timed out waiting for not '%s'"
+                                        % wait_for_not)
+        return self
+
+    def Maximize(self):
+        self.backend.call('Maximize')
+        self.resolve()
+
+    def SetFocus(self):
+        self.backend.call('SetFocus')
+        self.resolve()
+
+    def TypeKeys(self, keys, **kwargs):
+        self.backend.call('TypeKeys')
+        window = self.resolve()
+        if window is None:
+            window = self.backend.get_inm().active_window()
+        if window is not None:
+            window.on_keys(keys)
+
+    def MenuItem(self, path):
+        return SimMenuItem(self, path)
+
+    def ChildWindow(self, title_re=None, class_name=None, **kwargs):
+        return SimChildSpec(self, title_re, class_name)
+
+
+class SimChildSpec(object):
+    """
+    Child (MDI) window of the main window, found by title and class.
+
+    """
+    def __init__(self, parent, title_re, class_name):
+        self.parent = parent
+        self.title_re = title_re
+        self.class_name = class_name
+
+    def Exists(self, timeout=0, retry_interval=0):
+        backend = self.parent.backend
+        backend.call('Exists')
+        inm = backend.get_inm()
+        now = time.time()
+        with inm.lock:
+            windows = list(inm.mdi_windows)
+        for window in windows:
+            if (re.match(self.title_re or '.*', window.title) and
+                    (self.class_name is None or
+                     window.class_name == self.class_name) and
+                    window.visible_at <= now):
+                return True
+        return False
+
+
+class SimMenuItem(object):
+    def __init__(self, window_spec, path):
+        self.window_spec = window_spec
+        self.path = path
+
+    def Text(self):
+        self.window_spec.backend.call('Text')
+        return self.path.split('->')[-1]
+
+    def IsEnabled(self):
+        self.window_spec.backend.call('IsEnabled')
+        return self.window_spec.backend.get_inm().menu_enabled(self.path)
+
+    def Click(self):
+        self.window_spec.backend.call('Click', 'menu')
+        self.window_spec.backend.get_inm().click_menu(self.path)
+
+
+class SimControlSpec(object):
+    """
+    pywinauto-like control specification.
+
+    """
+    def __init__(self, window_spec, name):
+        self.window_spec = window_spec
+        self.backend = window_spec.backend
+        self.name = name
+
+    def _resolve(self):
+        window = self.window_spec._control_window(self.name)
+        return window, window.get_control(self.name)
+
+    def _act(self, action, arg=None):
+        self.backend.call(action)
+        inm = self.backend.get_inm()
+        with inm.lock:
+            window, control = self._resolve()
+            if action == 'Click' and self.name.endswith('CheckBox'):
+                control.checked = not control.checked
+            elif action == 'Click' and self.name.endswith('RadioButton'):
+                control.checked = True
+            elif action == 'Check':
+                control.checked = True
+            elif action == 'UnCheck':
+                control.checked = False
+            elif action == 'Select' and control.free:
+                control.text = str(arg)
+            elif action == 'Select':
+                control.selected = self._index(control, arg)
+                control.text = control.items[control.selected]
+            elif action == 'SetEditText':
+                control.text = str(arg)
+            window.on_action(control, action, arg)
+            if window.title == 'Output Setup' and action == 'Select':
+                inm.set_output_metric(control.text)
+
+    @staticmethod
+    def _index(control, item):
+        if isinstance(item, int):
+            if not 0 <= item < len(control.items):
+                raise SimulatedGUIError("Index %d out of range" % item)
+            return item
+        texts = [t.lower().strip() for t in control.items]
+        key = str(item).lower().strip()
+        if key not in texts:
+            raise SimulatedGUIError("No item '%s' in %s"
+                                    % (item, control.name))
+        return texts.index(key)
+
+    def Exists(self, timeout=0, retry_interval=0):
+        self.backend.call('Exists')
+        try:
+            self._resolve()
+            return True
+        except SimulatedGUIError:
+            return False
+
+    def Click(self):
+        self._act('Click')
+
+    def Check(self):
+        self._act('Check')
+
+    def UnCheck(self):
+        self._act('UnCheck')
+
+    def Select(self, item):
+        self._act('Select', item)
+
+    def SetEditText(self, text):
+        self._act('SetEditText', text)
+
+    def SetFocus(self):
+        self._act('SetFocus')
+
+    def Texts(self):
+        self.backend.call('Texts')
+        window, control = self._resolve()
+        return [control.text] + list(control.items)
+
+    def ItemTexts(self):
+        self.backend.call('ItemTexts')
+        window, control = self._resolve()
+        return list(control.items)
+
+    def ItemCount(self):
+        self.backend.call('ItemCount')
+        window, control = self._resolve()
+        return len(control.items)
+
+    def GetItemFocus(self):
+        self.backend.call('GetItemFocus')
+        window, control = self._resolve()
+        return control.selected
+
+    def GetCheckState(self):
+        self.backend.call('GetCheckState')
+        window, control = self._resolve()
+        return 1 if control.checked else 0
+
+    def WindowText(self):
+        self.backend.call('WindowText')
+        window, control = self._resolve()
+        return control.text
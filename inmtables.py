@@ -0,0 +1,265 @@
+# File-level access to the INM study tables that are otherwise edited
+# through the GUI dialogs.
+#
+# The tables are written before INM is launched so that the corresponding
+# dialogs do not need to be driven at all. Each table is described by a list
+# of (option name, DBFField) pairs mapping the parameters of a StudyOptions
+# object onto the columns of the table.
+#
+# An existing table keeps its own layout: the records are written onto the
+# fields of the table, the columns that are not mapped keep their values
+# and a mapped column missing from the table is an error. The fields of the
+# mapping only describe the layout of a table the study does not have yet.
+#
+# The column names of GRID_FIELDS and RUN_OPTIONS_FIELDS are provisional:
+# they have not been checked against the tables of a real INM 7 study.
+# Against a study whose table names its columns otherwise, writing the
+# options raises DBFError listing the missing columns and the columns of
+# the table. The mapping is then given to the functions below (mapping
+# argument) or the list is edited to match.
+#
+# A study with several case directories may have one grid table per case.
+# The table to use is then given through the case argument; a study with
+# several matching tables and no case raises DBFError rather than picking
+# one of them.
+#
+# Tables are replaced atomically (written to a temporary file then renamed)
+# so a study cloned with hard links never writes through to Reference.
+
+import fnmatch
+import os
+
+from inmdbf import DBFError, DBFField, DBFReader, DBFWriter, read_fields
+
+__author__ = 'Thomas Vandenhede'
+
+GRID_TABLE = 'GRID.DBF'
+
+# GridSetup parameter -> column of the grid table (provisional column
+# names, see above)
+GRID_FIELDS = [
+    ('grid_id', DBFField('GRID_ID', 'C', 8)),
+    ('grid_type', DBFField('GRID_TYPE', 'C', 10)),
+    ('coordinates', DBFField('COORD', 'C', 8)),
+    ('x', DBFField('X_COORD', 'N', 12, 4)),
+    ('y', DBFField('Y_COORD', 'N', 12, 4)),
+    ('i', DBFField('I_DIST', 'N', 12, 4)),
+    ('j', DBFField('J_DIST', 'N', 12, 4)),
+    ('nb_pts_i', DBFField('I_COUNT', 'N', 6)),
+    ('nb_pts_j', DBFField('J_COUNT', 'N', 6)),
+    ('grid_rotation_angle', DBFField('ANGLE', 'N', 8, 2)),
+    ('fixed_threshold', DBFField('THRESHOLD', 'N', 8, 2)),
+    ('relative_threshold', DBFField('AMB_DELTA', 'N', 8, 2)),
+    ('do_percent_of_time', DBFField('PCT_TIME', 'N', 8, 2)),
+]
+
+RUN_OPTIONS_TABLE = 'RUN_OPT.DBF'
+
+# RunOptions parameter -> column of the run options table (one record,
+# provisional column names, see above)
+RUN_OPTIONS_FIELDS = [
+    ('run_type', DBFField('RUN_TYPE', 'C', 16)),
+    ('noise_metric', DBFField('METRIC', 'C', 6)),
+    ('do_terrain', DBFField('TERRAIN', 'L', 1)),
+    ('lateral_attenuation', DBFField('LAT_ATTEN', 'C', 24)),
+    ('use_bank_angle', DBFField('BANK_ANGLE', 'L', 1)),
+    ('do_contours', DBFField('DO_CONTOUR', 'L', 1)),
+    ('use_boundary_file', DBFField('BOUNDARY', 'L', 1)),
+    ('refinement', DBFField('REFINEMENT', 'N', 3)),
+    ('low_cutoff', DBFField('LOW_CUTOFF', 'N', 8, 2)),
+    ('tolerance', DBFField('TOLERANCE', 'N', 8, 3)),
+    ('high_cutoff', DBFField('HI_CUTOFF', 'N', 8, 2)),
+    ('fixed_grid', DBFField('FIXED_GRID', 'L', 1)),
+    ('fixed_spacing', DBFField('FIXED_SPAC', 'L', 1)),
+    ('spacing', DBFField('SPACING', 'N', 10, 1)),
+    ('do_population_points', DBFField('DO_POP', 'L', 1)),
+    ('do_location_points', DBFField('DO_LOC', 'L', 1)),
+    ('do_standard_grids', DBFField('DO_STD', 'L', 1)),
+    ('do_detailed_grids', DBFField('DO_DETAIL', 'L', 1)),
+    ('save_all_flights', DBFField('SAVE_FLTS', 'L', 1)),
+] + [(metric, DBFField(metric.upper(), 'L', 1)) for metric in (
+    'dnl', 'cnel', 'laeq', 'laeqd', 'laeqn', 'sel', 'lamax', 'tala', 'nef',
+    'wecpnl', 'epnl', 'pnltm', 'tapnl', 'cexp', 'lcmax', 'talc')]
+
+# Directories of a study that only hold INM results
+OUTPUT_DIRS = ['output*']
+
+
+def find_study_table(path_to_study, table_name, case=None):
+    """
+    Returns the path of a table of the study (matched ignoring case): the
+    table of the case directory case if given, else the only table of that
+    name in the study directory and its sub-directories. If there is no
+    such table, the path it would have in the case (or study) directory is
+    returned.
+
+    :param path_to_study: the study directory
+    :param table_name: the file name of the table
+    :param case: case directory of the study holding the table (relative
+    to the study directory)
+    :return:
+    """
+    if case is not None:
+        directory = os.path.join(path_to_study, case)
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        matches = [os.path.join(directory, name) for name in sorted(names)
+                   if name.lower() == table_name.lower()]
+        return matches[0] if matches else os.path.join(directory, table_name)
+
+    matches = []
+    for root, dirs, files in os.walk(path_to_study):
+        dirs[:] = sorted(d for d in dirs if not any(
+            fnmatch.fnmatch(d.lower(), p) for p in OUTPUT_DIRS))
+        matches += [os.path.join(root, name) for name in sorted(files)
+                    if name.lower() == table_name.lower()]
+    if len(matches) > 1:
+        raise DBFError("Study %s has several %s tables (%s): give the case"
+                       % (path_to_study, table_name, ', '.join(
+                           os.path.relpath(p, path_to_study)
+                           for p in matches)))
+    return matches[0] if matches else os.path.join(path_to_study, table_name)
+
+
+def check_columns(path, fields, mapping):
+    """
+    Raises DBFError if a column of mapping is missing from a table.
+
+    :param path: path to the table
+    :param fields: the fields of the table
+    :param mapping: list of (option name, DBFField)
+    :return:
+    """
+    names = set(f.name for f in fields)
+    missing = [field.name for name, field in mapping
+               if field.name not in names]
+    if missing:
+        raise DBFError("Table %s has no column %s (its columns: %s)"
+                       % (path, ', '.join(missing),
+                          ', '.join(f.name for f in fields)))
+
+
+def write_options_table(path, mapping, params_list):
+    """
+    Atomically writes one record per parameter dictionary. If the table
+    exists, its fields are kept and the columns that are not in mapping keep
+    the values of the existing record of the same rank (of the first one for
+    additional records).
+
+    :param path: path to the table
+    :param mapping: list of (option name, DBFField)
+    :param params_list: list of parameter dictionaries
+    :return: number of records written
+    """
+    if os.path.exists(path):
+        fields = read_fields(path)
+        check_columns(path, fields, mapping)
+        with DBFReader(path) as table:
+            existing = list(table)
+    else:
+        fields = [field for name, field in mapping]
+        existing = []
+
+    tmp_path = path + '.tmp'
+    with DBFWriter(tmp_path, fields) as table:
+        for k, params in enumerate(params_list):
+            record = dict(existing[min(k, len(existing) - 1)]) \
+                if existing else {}
+            for name, field in mapping:
+                record[field.name] = params.get(name)
+            table.write_record(record)
+        count = table.header.record_count
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_options_table(path, mapping):
+    """
+    Reads back the parameter dictionaries stored in a table. Blank fields
+    are read as None, columns of the table that are not in mapping are
+    ignored and a column of mapping missing from the table raises DBFError.
+
+    :param path: path to the table
+    :param mapping: list of (option name, DBFField)
+    :return: list of parameter dictionaries
+    """
+    result = []
+    with DBFReader(path) as table:
+        check_columns(path, table.fields, mapping)
+        for record in table:
+            params = {}
+            for name, field in mapping:
+                value = record.get(field.name)
+                params[name] = None if value == '' else value
+            result.append(params)
+    return result
+
+
+def write_grid_table(path_to_study, grids, case=None, mapping=None):
+    """
+    Replaces the grids of the study with a list of GridSetup objects.
+
+    :param path_to_study: the study directory
+    :param grids: list of GridSetup
+    :param case: case directory holding the grid table (see
+    find_study_table)
+    :param mapping: columns of the grid table (GRID_FIELDS if None)
+    :return: path to the grid table
+    """
+    path = find_study_table(path_to_study, GRID_TABLE, case)
+    write_options_table(path, mapping or GRID_FIELDS,
+                        [g.get_grid_setup_dict() for g in grids])
+    return path
+
+
+def read_grid_table(path_to_study, case=None, mapping=None):
+    """
+    Returns the grids of the study as GridSetup parameter dictionaries.
+
+    :param path_to_study: the study directory
+    :param case: case directory holding the grid table (see
+    find_study_table)
+    :param mapping: columns of the grid table (GRID_FIELDS if None)
+    :return:
+    """
+    return read_options_table(
+        find_study_table(path_to_study, GRID_TABLE, case),
+        mapping or GRID_FIELDS)
+
+
+def write_run_options_table(path_to_study, run_options, case=None,
+                            mapping=None):
+    """
+    Replaces the run options of the study with a RunOptions object.
+
+    :param path_to_study: the study directory
+    :param run_options: RunOptions
+    :param case: case directory holding the run options table (see
+    find_study_table)
+    :param mapping: columns of the run options table (RUN_OPTIONS_FIELDS if
+    None)
+    :return: path to the run options table
+    """
+    params = dict(run_options.get_run_options_dict())
+    params['noise_metric'] = params['noise_metric'].strip().upper()
+    path = find_study_table(path_to_study, RUN_OPTIONS_TABLE, case)
+    write_options_table(path, mapping or RUN_OPTIONS_FIELDS, [params])
+    return path
+
+
+def read_run_options_table(path_to_study, case=None, mapping=None):
+    """
+    Returns the run options of the study as a RunOptions parameter
+    dictionary.
+
+    :param path_to_study: the study directory
+    :param case: case directory holding the run options table (see
+    find_study_table)
+    :param mapping: columns of the run options table (RUN_OPTIONS_FIELDS if
+    None)
+    :return:
+    """
+    path = find_study_table(path_to_study, RUN_OPTIONS_TABLE, case)
+    records = read_options_table(path, mapping or RUN_OPTIONS_FIELDS)
+    if not records:
+        raise IOError("Run options table %s is empty" % path)
+    return records[0]
@@ -0,0 +1,102 @@
+# Polling primitive shared by every wait of INMAuto.
+#
+# wait_until() polls a condition with an exponentially growing interval
+# (starting short so fast GUI transitions are caught quickly, growing so a
+# long wait does not keep a CPU busy next to INM) until it holds or a
+# deadline passes. Every wait is accounted for in a WaitStats object: number
+# of waits, polls, timeouts and time spent, per wait name.
+
+import collections
+import time
+
+__author__ = 'Thomas Vandenhede'
+
+
+class WaitTimeoutError(Exception):
+    """
+    Raised when the condition of a wait still does not hold at its deadline.
+
+    """
+    def __init__(self, name, timeout, polls):
+        Exception.__init__(self, "Timed out after %.1f s (%d polls) waiting "
+                                 "for %s" % (timeout, polls, name))
+        self.name = name
+        self.timeout = timeout
+        self.polls = polls
+
+
+class WaitStats(object):
+    """
+    Counters of the waits made with wait_until, per wait name.
+
+    """
+    def __init__(self):
+        self.waits = collections.Counter()
+        self.polls = collections.Counter()
+        self.timeouts = collections.Counter()
+        self.time = collections.Counter()
+        self.max_polls = collections.Counter()
+
+    def record(self, name, polls, elapsed, timed_out):
+        self.waits[name] += 1
+        self.polls[name] += polls
+        self.time[name] += elapsed
+        self.max_polls[name] = max(self.max_polls[name], polls)
+        if timed_out:
+            self.timeouts[name] += 1
+
+    def as_dict(self):
+        """
+        Returns {wait name: {waits, polls, max_polls, timeouts, time_s}}.
+
+        :return:
+        """
+        return dict((name, {'waits': self.waits[name],
+                            'polls': self.polls[name],
+                            'max_polls': self.max_polls[name],
+                            'timeouts': self.timeouts[name],
+                            'time_s': self.time[name]})
+                    for name in self.waits)
+
+    def reset(self):
+        self.__init__()
+
+
+def wait_until(condition, timeout, name='condition', stats=None,
+               interval=0.001, max_interval=0.25, backoff=2.0, ignore=()):
+    """
+    Calls condition until it returns a true value, sleeping between polls
+    for interval seconds, multiplied by backoff after each poll up to
+    max_interval. The condition is polled one last time at the deadline.
+
+    :param condition: callable without argument
+    :param timeout: maximum time to wait (s)
+    :param name: name of the wait, used in the statistics and errors
+    :param stats: WaitStats recording the wait (none if None)
+    :param interval: first polling interval (s)
+    :param max_interval: maximum polling interval (s)
+    :param backoff: growth factor of the polling interval
+    :param ignore: exceptions of the condition that count as false
+    :return: the value returned by condition
+    :raises WaitTimeoutError: if the condition does not hold at the deadline
+    """
+    start = time.time()
+    deadline = start + timeout
+    polls = 0
+    while True:
+        polls += 1
+        try:
+            result = condition()
+        except ignore:
+            result = None
+        if result:
+            if stats is not None:
+                stats.record(name, polls, time.time() - start, False)
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            if stats is not None:
+                stats.record(name, polls, time.time() - start, True)
+            raise WaitTimeoutError(name, timeout, polls)
+        time.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
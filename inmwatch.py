@@ -0,0 +1,255 @@
+# Detection of the end of an INM run from the files it writes.
+#
+# An OutputWatcher is started just before a run and waits until every
+# expected result file of the study's output directory has been written
+# after that point and has stopped changing for settle_time seconds. A file
+# counts as written when it did not exist at the start or its size or
+# modification time has changed since: the modification time is not
+# compared with the start time, since file systems with a coarse time
+# resolution (FAT, SMB shares: 2 s) can date a fresh file before it. On
+# Linux the watcher sleeps on inotify events of the directory (through
+# ctypes, no extra dependency); elsewhere, or if inotify is unavailable, it
+# polls the size and modification time of the files with
+# inmwait.wait_until.
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+
+from inmwait import WaitTimeoutError, wait_until
+
+__author__ = 'Thomas Vandenhede'
+
+# Output directory of a run. The names of the result files a run writes
+# into it depend on the INM installation and are given to each
+# OutputWatcher (see INMAuto.run_output_files).
+RUN_OUTPUT_DIR = 'OUTPUT1'
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify(object):
+    """
+    Minimal inotify binding: watches directories and blocks until one of
+    them changes.
+
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.events = 0
+
+    def add_watch(self, directory):
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self._add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                          directory)
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for events and consumes them.
+
+        :return: True if events were received
+        """
+        readable = select.select([self.fd], [], [], max(timeout, 0))[0]
+        if not readable:
+            return False
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    length = IN_EVENT_HEADER.unpack_from(data, offset)[3]
+                    offset += IN_EVENT_HEADER.size + length
+                    self.events += 1
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class OutputWatcher(object):
+    """
+    Waits for the result files of a run to be complete.
+
+    :param directory: the output directory (may not exist yet)
+    :param patterns: file name patterns (case insensitive), each of which
+    must match a file written during the run (required: there is no
+    default list of the result files of INM)
+    :param settle_time: time (s) the files must stay unchanged
+    :param use_inotify: use inotify when available (Linux)
+    :param poll_interval: longest interval between two polls (s)
+    """
+    def __init__(self, directory, patterns, settle_time=0.5,
+                 use_inotify=True, poll_interval=0.25):
+        if not patterns:
+            raise ValueError('No result file patterns to watch')
+        self.directory = directory
+        self.patterns = [p.lower() for p in patterns]
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and sys.platform.startswith('linux')
+        self.start_time = None
+        self._before = {}
+        self._inotify = None
+        self._watching_directory = False
+        self._snapshot = None
+        self._changed_at = None
+        self._last_write = None
+        self._settling = False
+        self.checks = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """
+        Marks the start of the run: the files already there are ignored
+        until they change.
+
+        """
+        self.start_time = time.time()
+        self._before = self.scan()
+        if self.use_inotify:
+            try:
+                self._inotify = _Inotify()
+                # the output directory is created by the run
+                parent = os.path.dirname(os.path.abspath(self.directory))
+                self._inotify.add_watch(parent)
+                self._watch_directory()
+            except (OSError, AttributeError) as err:
+                print('inotify unavailable (%s), polling outputs' % err)
+                self.close()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    @property
+    def method(self):
+        return 'inotify' if self._inotify is not None else 'polling'
+
+    def _watch_directory(self):
+        if not self._watching_directory and os.path.isdir(self.directory):
+            self._inotify.add_watch(self.directory)
+            self._watching_directory = True
+
+    def scan(self):
+        """
+        Returns {file name: (size, modification time)} of the files of the
+        output directory that match the expected patterns.
+
+        :return:
+        """
+        snapshot = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return snapshot
+        for name in names:
+            if any(fnmatch.fnmatch(name.lower(), p) for p in self.patterns):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                snapshot[name] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def is_complete(self):
+        """
+        Checks the output files once. The run is complete when every
+        pattern matches a file created or changed since start() and no file
+        has changed for settle_time seconds.
+
+        :return:
+        """
+        self.checks += 1
+        now = time.time()
+        snapshot = self.scan()
+        self._settling = False
+        if snapshot != self._snapshot:
+            self._snapshot = snapshot
+            self._changed_at = now
+            return False
+        written = [name for name, stamp in snapshot.items()
+                   if self._before.get(name) != stamp]
+        for pattern in self.patterns:
+            if not any(fnmatch.fnmatch(name.lower(), pattern)
+                       for name in written):
+                return False
+        self._last_write = max(mtime for size, mtime in snapshot.values())
+        self._settling = now - self._changed_at < self.settle_time
+        return not self._settling
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the run is complete.
+
+        :param timeout: maximum time to wait from now (s), None for no limit
+        :return: {'directory', 'method', 'duration_s' (start to last write),
+        'detected_s' (start to detection), 'checks', 'files' {name: size},
+        'total_bytes'}
+        :raises inmwait.WaitTimeoutError:
+        """
+        if self.start_time is None:
+            self.start()
+        if self._inotify is not None:
+            self._wait_inotify(timeout)
+        else:
+            wait_until(self.is_complete,
+                       float('inf') if timeout is None else timeout,
+                       'outputs in %s' % self.directory,
+                       interval=min(0.01, self.poll_interval),
+                       max_interval=self.poll_interval)
+        files = dict((name, size)
+                     for name, (size, mtime) in self._snapshot.items())
+        return {
+            'directory': self.directory,
+            'method': self.method,
+            # the modification times may be coarser than the start time
+            'duration_s': max(0.0, self._last_write - self.start_time),
+            'detected_s': time.time() - self.start_time,
+            'checks': self.checks,
+            'files': files,
+            'total_bytes': sum(files.values()),
+        }
+
+    def _wait_inotify(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.is_complete():
+            # wake up on file events, or when the files may have settled
+            delay = self.poll_interval
+            if self._settling:
+                delay = min(delay, max(0.0, self._changed_at +
+                                       self.settle_time - time.time()))
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WaitTimeoutError('outputs in %s' % self.directory,
+                                           timeout, self.checks)
+                delay = min(delay, remaining)
+            self._inotify.wait(delay)
+            self._watch_directory()
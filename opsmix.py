@@ -0,0 +1,216 @@
+# Cumulative metrics of an operations mix recombined from per-flight SEL.
+#
+# DNL, CNEL, LAEQ, LAEQD and LAEQN are energy sums of the SEL of every
+# operation, weighted by the time period of the operation and averaged over
+# a time T:
+#   L = 10 log10(sum over flights of w(period) N(period) 10^(SEL / 10) / T)
+# with the periods day (07-19), evening (19-22) and night (22-07):
+#
+#   metric  day  evening  night     T (s)
+#   DNL      1      1       10     86400
+#   CNEL     1      3       10     86400
+#   LAEQ     1      1        1     86400
+#   LAEQD    1      1        0     54000   (07-22)
+#   LAEQN    0      0        1     32400   (22-07)
+#
+# Given the SEL of each flight at a set of receptors (grid or points, e.g.
+# from flightstats.load_flight_results or gridstore.DetailedGridStore) and
+# the number of operations of each flight per period, the metrics are
+# computed with a matrix product instead of editing the case tables and
+# running INM again for every operations mix.
+#
+# Example:
+#   mix = OpsMix(results.flights, results.levels)
+#   levels = mix.compute({'CS-TNN_2016-01-05_TP842': (12, 2, 1)}, 'DNL')
+#
+# Usage:
+#   python opsmix.py ops.csv [--metric DNL --metric CNEL] [--by procedure]
+#                            [--kind loc_points] [-o levels.csv]
+
+import argparse
+
+import numpy as np
+
+import flightstats
+from CreateINMStudy import get_immediate_subdirectories
+
+__author__ = 'Thomas Vandenhede'
+
+PERIODS = ('day', 'evening', 'night')
+# metric -> (weights of the day, evening and night operations, T in s)
+CUMULATIVE_METRICS = {
+    'DNL': ((1.0, 1.0, 10.0), 86400.0),
+    'CNEL': ((1.0, 3.0, 10.0), 86400.0),
+    'LAEQ': ((1.0, 1.0, 1.0), 86400.0),
+    'LAEQD': ((1.0, 1.0, 0.0), 54000.0),
+    'LAEQN': ((0.0, 0.0, 1.0), 32400.0),
+}
+
+
+def read_ops_table(path):
+    """
+    Reads a table of operations from a .csv file with the columns NAME
+    (flight, or tail/date/procedure value), DAY, EVENING and NIGHT.
+
+    :param path: the .csv file
+    :return: {name: (day, evening, night)}
+    """
+    ops = {}
+    with open(path) as f:
+        header = [name.strip().upper() for name in f.readline().split(',')]
+        columns = [header.index(name) for name in
+                   ('NAME', 'DAY', 'EVENING', 'NIGHT')]
+        for line in f:
+            values = [v.strip() for v in line.split(',')]
+            if len(values) == len(header):
+                ops[values[columns[0]]] = tuple(
+                    float(values[k] or 0) for k in columns[1:])
+    return ops
+
+
+def ops_for_groups(flights, group_ops, key):
+    """
+    Spreads the operations of each tail number, date or procedure evenly
+    over its flights.
+
+    :param flights: list of flight names
+    :param group_ops: {group value: (day, evening, night)}
+    :param key: one of flightstats.GROUP_KEYS
+    :return: {flight: (day, evening, night)}
+    """
+    values = [flightstats.parse_flight_name(f)[key] for f in flights]
+    counts = dict((v, values.count(v)) for v in set(values))
+    return dict((f, tuple(n / counts[v] for n in group_ops[v]))
+                for f, v in zip(flights, values) if v in group_ops)
+
+
+class OpsMix(object):
+    """
+    Per-flight SEL at a set of receptors, recombined into cumulative
+    metrics for any operations mix.
+
+    :param flights: list of flight names
+    :param sel: (flights x receptors) array of SEL (dB), NaN where a flight
+    has no level (no contribution)
+    """
+    def __init__(self, flights, sel):
+        self.flights = list(flights)
+        sel = np.asarray(sel, np.float64)
+        if sel.shape[0] != len(self.flights):
+            raise ValueError('%d flights but %d rows of SEL'
+                             % (len(self.flights), sel.shape[0]))
+        # the energies are computed once, each mix is then a matrix product
+        self.energy = np.nan_to_num(10 ** (sel / 10.0), nan=0.0)
+
+    def ops_matrix(self, ops):
+        """
+        Converts operations into a (flights x periods) array.
+
+        :param ops: {flight: (day, evening, night)} (flights not listed
+        have no operations), or an array of shape (flights, 3) or
+        (scenarios, flights, 3)
+        :return: array of shape (flights, 3) or (scenarios, flights, 3)
+        """
+        if isinstance(ops, dict):
+            unknown = set(ops) - set(self.flights)
+            if unknown:
+                raise KeyError('Unknown flights: %s'
+                               % ', '.join(sorted(unknown)))
+            return np.array([ops.get(f, (0.0, 0.0, 0.0))
+                             for f in self.flights], np.float64)
+        ops = np.asarray(ops, np.float64)
+        if ops.shape[-2:] != (len(self.flights), len(PERIODS)):
+            raise ValueError('Operations of shape %s, expected (..., %d, %d)'
+                             % (ops.shape, len(self.flights), len(PERIODS)))
+        return ops
+
+    def compute(self, ops, metrics=('DNL',)):
+        """
+        Computes cumulative metrics for one or several operations mixes.
+
+        :param ops: operations (see ops_matrix)
+        :param metrics: a name or list of names of CUMULATIVE_METRICS
+        :return: {metric: levels (dB)}: levels has one value per receptor,
+        or shape (scenarios, receptors) for several mixes; -inf where no
+        operation contributes
+        """
+        single = isinstance(metrics, str)
+        if single:
+            metrics = [metrics]
+        ops = self.ops_matrix(ops)
+        # weighted number of operations of each flight, for each metric
+        weights = np.array([CUMULATIVE_METRICS[m][0] for m in metrics])
+        times = np.array([CUMULATIVE_METRICS[m][1] for m in metrics])
+        weighted = np.einsum('...fp,mp->...mf', ops, weights) / \
+            times[:, None]
+        with np.errstate(divide='ignore'):
+            levels = 10 * np.log10(np.matmul(weighted, self.energy))
+        result = dict((m, levels[..., k, :]) for k, m in enumerate(metrics))
+        return result[metrics[0]] if single else result
+
+
+def write_levels_csv(path, receptors, levels):
+    """
+    Writes cumulative levels of every receptor into a .csv file.
+
+    :param path: the .csv file
+    :param receptors: structured array of the receptors
+    :param levels: {metric: levels}
+    """
+    metrics = sorted(levels)
+    with open(path, 'w') as f:
+        f.write(','.join(list(receptors.dtype.names) + metrics) + '\n')
+        for k, receptor in enumerate(receptors.tolist()):
+            f.write(','.join([str(v) for v in receptor] + [
+                '%.2f' % levels[m][k] for m in metrics]) + '\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Cumulative metrics of an operations mix from the SEL '
+                    'exported for each flight.')
+    parser.add_argument('ops', help='operations table (.csv: NAME, DAY, '
+                                    'EVENING, NIGHT)')
+    parser.add_argument('--metric', action='append',
+                        choices=sorted(CUMULATIVE_METRICS),
+                        help='metric to compute (default: DNL)')
+    parser.add_argument('--by', choices=flightstats.GROUP_KEYS,
+                        help='the NAME column holds tail numbers, dates or '
+                             'procedures instead of flights')
+    parser.add_argument('--studies-path', default='INM Studies')
+    parser.add_argument('--kind', choices=sorted(flightstats.RECEPTOR_FIELDS),
+                        default='standard_grids')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of parsing processes (0: one per CPU)')
+    parser.add_argument('-o', '--output', help='write the levels of every '
+                                               'receptor to a .csv')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    metrics = args.metric or ['DNL']
+    flights = sorted(d for d in get_immediate_subdirectories(
+        args.studies_path) if d != 'Reference')
+    results = flightstats.load_flight_results(
+        args.studies_path, flights, 'SEL', args.kind, args.jobs or None)
+    for flight, error in sorted(results.errors.items()):
+        print('%s skipped: %s' % (flight, error))
+
+    ops = read_ops_table(args.ops)
+    if args.by:
+        ops = ops_for_groups(results.flights, ops, args.by)
+    for name in sorted(set(ops) - set(results.flights)):
+        print('%s: no results, operations ignored' % name)
+        del ops[name]
+    levels = OpsMix(results.flights, results.levels).compute(ops, metrics)
+    for metric in metrics:
+        print('%-6s max %6.2f dB over %d receptors'
+              % (metric, levels[metric].max(), len(levels[metric])))
+    if args.output:
+        write_levels_csv(args.output, results.receptors, levels)
+        print('Levels written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Contours traced by gridcontours and their areas computed by contourarea,
+# checked against shapes of known area.
+
+import numpy as np
+import pytest
+
+import contourarea
+import gridcontours
+import inmoutputs
+
+__author__ = 'Thomas Vandenhede'
+
+
+def radial_grid(size=201, extent=2.0):
+    geometry = gridcontours.GridGeometry(-extent, -extent,
+                                         2 * extent / (size - 1),
+                                         2 * extent / (size - 1), size, size)
+    u = np.arange(size, dtype=np.float64)
+    xy = geometry.to_xy(*np.meshgrid(u, u))
+    return np.hypot(xy[..., 0], xy[..., 1]), geometry
+
+
+def level_area(contour_points, level):
+    areas = contourarea.contour_area_and_pop(contour_points)
+    return areas['AREA'][areas['LEVEL'] == level][0]
+
+
+def assert_no_repeated_points(contour_points):
+    for level, contour, ring in inmoutputs.contour_rings(contour_points):
+        following = np.roll(ring, -1, axis=0)
+        assert len(ring) == 1 or not (ring == following).all(axis=1).any()
+
+
+def test_circle_area():
+    distance, geometry = radial_grid()
+    # levels decrease away from the centre: the contour of level -1 is the
+    # circle of radius 1
+    points = gridcontours.trace_contours(-distance, [-1.0], geometry)
+    assert set(points['CONTOUR']) == {1}
+    assert level_area(points, -1.0) == pytest.approx(np.pi, rel=1e-3)
+
+
+def test_annulus_area():
+    distance, geometry = radial_grid()
+    # levels peak on the circle of radius 1: the contour of level -0.5 is
+    # the annulus between radii 0.5 and 1.5
+    points = gridcontours.trace_contours(-np.abs(distance - 1.0), [-0.5],
+                                         geometry)
+    assert set(points['CONTOUR']) == {1, 2}
+    assert level_area(points, -0.5) == pytest.approx(2 * np.pi, rel=1e-3)
+
+
+def test_points_in_annulus():
+    distance, geometry = radial_grid()
+    points = gridcontours.trace_contours(-np.abs(distance - 1.0), [-0.5],
+                                         geometry)
+    rings = [xy for level, contour, xy in inmoutputs.contour_rings(points)]
+    inside = contourarea.points_in_rings(
+        [(0.0, 0.0), (1.0, 0.0), (0.0, -1.2), (1.8, 0.0)], rings)
+    assert inside.tolist() == [False, True, True, False]
+
+
+def test_border_contours():
+    # the high levels reach the border of the grid, whose crossings snap to
+    # the grid points
+    levels = np.array([[3.0, 3.0, 1.0],
+                       [3.0, 1.0, 1.0],
+                       [1.0, 1.0, 1.0]])
+    points = gridcontours.trace_contours(levels, [2.0])
+    assert_no_repeated_points(points)
+    assert list(points['POINT']) == list(range(1, len(points) + 1))
+    assert level_area(points, 2.0) == pytest.approx(1.125)
+
+
+def test_level_on_grid_values():
+    # a level equal to grid values puts crossings on the grid points
+    levels = np.array([[0.0, 0.0, 0.0, 0.0],
+                       [0.0, 1.0, 2.0, 0.0],
+                       [0.0, 2.0, 1.0, 0.0],
+                       [0.0, 0.0, 0.0, 0.0]])
+    points = gridcontours.trace_contours(levels, [1.0, 2.0])
+    assert_no_repeated_points(points)
+
+
+def test_no_contour():
+    points = gridcontours.trace_contours(np.zeros((3, 3)), [1.0])
+    assert len(points) == 0
@@ -0,0 +1,109 @@
+# Incremental sync of the study directories (sync_inm_study_directories),
+# starting from directories made before manifests existed.
+
+import os
+import shutil
+
+import pytest
+
+import CreateINMStudy
+
+__author__ = 'Thomas Vandenhede'
+
+
+def write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def paths(tmp_path):
+    data_path = str(tmp_path / 'data')
+    studies_path = str(tmp_path / 'studies')
+    reference = os.path.join(studies_path, 'Reference')
+    write(os.path.join(reference, 'AIRPORT.DBF'), 'airport')
+    write(os.path.join(reference, 'FLIGHT.DBF'), 'reference flight')
+    write(os.path.join(reference, 'CASE1', 'GRID.DBF'), 'grid')
+    write(os.path.join(reference, 'STUDY.INM'), 'study')
+    for d in ('F1', 'F2'):
+        write(os.path.join(data_path, d, 'FLIGHT.DBF'), 'flight %s' % d)
+    return data_path, studies_path
+
+
+def make_unmanaged_study(data_path, studies_path, d):
+    # what the baseline made: Reference copied over, then the flight files,
+    # and the results of a run
+    study_dir = os.path.join(studies_path, d)
+    shutil.copytree(os.path.join(studies_path, 'Reference'), study_dir)
+    shutil.copy2(os.path.join(data_path, d, 'FLIGHT.DBF'), study_dir)
+    write(os.path.join(study_dir, 'CASE1', 'GRID.DBF'), 'grid set by INM')
+    write(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT'), 'results')
+    return study_dir
+
+
+def sync(data_path, studies_path):
+    return CreateINMStudy.sync_inm_study_directories(
+        data_path, studies_path, ['F1', 'F2'])
+
+
+def test_new_studies(paths):
+    result = sync(*paths)
+    assert result['created'] == ['F1', 'F2']
+    study_dir = os.path.join(paths[1], 'F1')
+    assert read(os.path.join(study_dir, 'FLIGHT.DBF')) == 'flight F1'
+    assert sync(*paths)['unchanged'] == ['F1', 'F2']
+
+
+def test_unmanaged_study_adopted(paths):
+    study_dir = make_unmanaged_study(paths[0], paths[1], 'F1')
+    result = sync(*paths)
+    assert result['adopted'] == ['F1']
+    assert result['created'] == ['F2']
+    assert read(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT')) == 'results'
+    assert read(os.path.join(study_dir, 'CASE1', 'GRID.DBF')) == \
+        'grid set by INM'
+    assert sync(*paths)['unchanged'] == ['F1', 'F2']
+
+
+def test_unmanaged_study_rebuilt_with_outputs(paths):
+    study_dir = make_unmanaged_study(paths[0], paths[1], 'F1')
+    write(os.path.join(study_dir, 'AIRPORT.DBF'), 'older airport')
+    result = sync(*paths)
+    assert result['updated'] == ['F1']
+    assert read(os.path.join(study_dir, 'AIRPORT.DBF')) == 'airport'
+    assert read(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT')) == 'results'
+
+
+def test_updated_study_keeps_outputs(paths):
+    sync(*paths)
+    study_dir = os.path.join(paths[1], 'F1')
+    write(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT'), 'results')
+    write(os.path.join(paths[0], 'F1', 'FLIGHT.DBF'), 'new flight F1')
+    result = sync(*paths)
+    assert result['updated'] == ['F1']
+    assert read(os.path.join(study_dir, 'FLIGHT.DBF')) == 'new flight F1'
+    assert read(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT')) == 'results'
+    assert sorted(os.listdir(paths[1])) == ['F1', 'F2', 'Reference']
+
+
+def test_failed_rebuild_keeps_study(paths, monkeypatch):
+    sync(*paths)
+    study_dir = os.path.join(paths[1], 'F1')
+    write(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT'), 'results')
+    write(os.path.join(paths[0], 'F1', 'FLIGHT.DBF'), 'new flight F1')
+
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(CreateINMStudy, 'clone_file', fail)
+    result = CreateINMStudy.sync_inm_study_directories(paths[0], paths[1],
+                                                       ['F1'])
+    assert list(result['failed']) == ['F1']
+    assert read(os.path.join(study_dir, 'FLIGHT.DBF')) == 'flight F1'
+    assert read(os.path.join(study_dir, 'OUTPUT1', 'NOISE.OUT')) == 'results'
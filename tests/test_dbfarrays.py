@@ -0,0 +1,79 @@
+# Round trips of dBase tables through the columnar loader of dbfarrays.
+
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+import dbfarrays
+from inmdbf import DBFField, DBFTable, write_records
+
+__author__ = 'Thomas Vandenhede'
+
+FIELDS = [
+    DBFField('TRACK_ID', 'C', 8),
+    DBFField('SEG_NUM', 'N', 4),
+    DBFField('DISTANCE', 'N', 12, 4),
+    DBFField('FLAG', 'N', 1),
+    DBFField('ACTIVE', 'L', 1),
+    DBFField('UPDATED', 'D', 8),
+]
+
+RECORDS = [
+    {'TRACK_ID': 'DEP1', 'SEG_NUM': 1, 'DISTANCE': 1.25, 'FLAG': 1,
+     'ACTIVE': True, 'UPDATED': datetime.date(2016, 3, 1)},
+    {'TRACK_ID': 'DÉP 2', 'SEG_NUM': 2, 'DISTANCE': None, 'FLAG': None,
+     'ACTIVE': False, 'UPDATED': None},
+    {'TRACK_ID': '', 'SEG_NUM': 12, 'DISTANCE': -0.5, 'FLAG': 7,
+     'ACTIVE': None, 'UPDATED': datetime.date(2000, 12, 31)},
+]
+
+
+@pytest.fixture
+def table(tmp_path):
+    path = str(tmp_path / 'TRK_SEGS.DBF')
+    write_records(path, FIELDS, RECORDS)
+    return path
+
+
+def test_columns_round_trip(table):
+    columns = dbfarrays.load_dbf_columns(table)
+    assert list(columns['TRACK_ID']) == ['DEP1', 'DÉP 2', '']
+    assert columns['SEG_NUM'].dtype == np.int64
+    assert list(columns['SEG_NUM']) == [1, 2, 12]
+    assert columns['DISTANCE'][0] == 1.25
+    assert np.isnan(columns['DISTANCE'][1])
+    assert columns['DISTANCE'][2] == -0.5
+    assert list(columns['ACTIVE']) == [True, False, False]
+    assert columns['UPDATED'][0] == np.datetime64('2016-03-01')
+    assert np.isnat(columns['UPDATED'][1])
+    assert columns['UPDATED'][2] == np.datetime64('2000-12-31')
+
+
+def test_narrow_numeric_blanks(table):
+    # a one character field cannot hold the text 'nan'
+    flag = dbfarrays.load_dbf_columns(table, ['FLAG'])['FLAG']
+    assert flag[0] == 1.0 and flag[2] == 7.0
+    assert np.isnan(flag[1])
+
+
+def test_columns_skip_deleted(table):
+    with DBFTable(table, writable=True) as t:
+        t.set_deleted(1)
+    columns = dbfarrays.load_dbf_columns(table, ['SEG_NUM'])
+    assert list(columns['SEG_NUM']) == [1, 12]
+
+
+def test_columns_cache(table, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    first = dbfarrays.load_dbf_columns(table, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    cached = dbfarrays.load_dbf_columns(table, cache_dir=cache_dir)
+    assert cached.dtype == first.dtype
+    assert list(cached['SEG_NUM']) == list(first['SEG_NUM'])
+    with DBFTable(table, writable=True) as t:
+        t.update_field(0, 'SEG_NUM', 5)
+    changed = dbfarrays.load_dbf_columns(table, cache_dir=cache_dir)
+    assert changed['SEG_NUM'][0] == 5
+    assert len(os.listdir(cache_dir)) == 2
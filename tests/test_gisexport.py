@@ -0,0 +1,151 @@
+# Contour layers written by gisexport, read back from the GeoJSON and
+# shapefile files.
+
+import json
+import os
+import struct
+
+import numpy as np
+import pytest
+
+import gisexport
+from inmdbf import read_records
+
+__author__ = 'Thomas Vandenhede'
+
+
+def square(x, y, size):
+    return [(x, y), (x + size, y), (x + size, y + size), (x, y + size)]
+
+
+def contour_points(*contours):
+    """
+    'contour_points' array of (level, list of x, y) contours.
+
+    """
+    rows = []
+    number = {}
+    for level, ring in contours:
+        number[level] = number.get(level, 0) + 1
+        rows += [(level, number[level], k + 1, x, y)
+                 for k, (x, y) in enumerate(ring)]
+    return np.array(rows, dtype=[('LEVEL', np.float64),
+                                 ('CONTOUR', np.int64), ('POINT', np.int64),
+                                 ('X', np.float64), ('Y', np.float64)])
+
+
+# level 65: a square with a square hole; level 70: two separate squares,
+# one of them clockwise
+POINTS = contour_points(
+    (65.0, square(0.0, 0.0, 4.0)),
+    (65.0, square(1.0, 1.0, 2.0)[::-1]),
+    (70.0, square(1.5, 1.5, 1.0)),
+    (70.0, square(5.0, 0.0, 1.0)[::-1]),
+)
+
+
+def test_orient_rings():
+    outer, hole = square(0.0, 0.0, 4.0), square(1.0, 1.0, 2.0)
+    rings = gisexport.orient_rings([np.array(outer[::-1], float),
+                                    np.array(hole, float)])
+    assert list(np.sign(gisexport.contourarea.ring_areas(rings))) == [1, -1]
+    polygons = gisexport.group_polygons(rings)
+    assert [len(p) for p in polygons] == [2]
+
+
+def test_geojson(tmp_path):
+    path = str(tmp_path / 'SEL.geojson')
+    assert gisexport.write_contours(path, POINTS) == 2
+    with open(path) as f:
+        features = json.load(f)['features']
+    assert [f['properties'] for f in features] == [
+        {'LEVEL': 65.0, 'AREA': 12.0}, {'LEVEL': 70.0, 'AREA': 2.0}]
+    polygons = features[0]['geometry']['coordinates']
+    assert len(polygons) == 1 and len(polygons[0]) == 2
+    outer = polygons[0][0]
+    assert outer[0] == outer[-1] and len(outer) == 5
+    assert len(features[1]['geometry']['coordinates']) == 2
+
+
+def test_geojson_lon_lat(tmp_path):
+    path = str(tmp_path / 'SEL.geojson')
+    gisexport.write_contours(path, POINTS, origin=(0.0, 10.0))
+    with open(path) as f:
+        features = json.load(f)['features']
+    outer = np.array(features[0]['geometry']['coordinates'][0][0])
+    # 1 nmi is about one minute of arc
+    assert outer[0] == pytest.approx([10.0, 0.0])
+    assert outer[2] == pytest.approx([10.0 + 4 / 60.0, 4 / 60.0], rel=1e-3)
+    assert gisexport.contourarea.ring_areas([outer[:-1]])[0] > 0
+    assert features[0]['properties']['AREA'] == 12.0
+
+
+def test_geojson_projection(tmp_path):
+    projection = gisexport.local_projection(38.5, -9.0)
+    with pytest.raises(ValueError):
+        gisexport.write_contours(str(tmp_path / 'SEL.geojson'), POINTS,
+                                 projection=projection)
+
+
+def read_shapefile(base):
+    with open(base + '.shp', 'rb') as f:
+        data = f.read()
+    code, length = struct.unpack('>i20xi', data[:28])
+    version, shape_type = struct.unpack('<2i', data[28:36])
+    bbox = struct.unpack('<4d', data[36:68])
+    assert (code, version, shape_type) == (9994, 1000, 5)
+    assert length * 2 == len(data)
+    shapes = []
+    offset = 100
+    while offset < len(data):
+        number, words = struct.unpack('>2i', data[offset:offset + 8])
+        content = data[offset + 8:offset + 8 + words * 2]
+        parts, count = struct.unpack('<2i', content[36:44])
+        starts = np.frombuffer(content, '<i4', parts, 44)
+        points = np.frombuffer(content, '<f8', 2 * count,
+                               44 + 4 * parts).reshape(-1, 2)
+        shapes.append(np.split(points, starts[1:]))
+        offset += 8 + words * 2
+    with open(base + '.shx', 'rb') as f:
+        index = f.read()
+    assert len(index) == 100 + 8 * len(shapes)
+    return bbox, shapes
+
+
+def test_shapefile(tmp_path):
+    base = str(tmp_path / 'CONTOURS_S1')
+    projection = gisexport.local_projection(38.5, -9.0, 'feet')
+    assert gisexport.write_contours(base + '.shp', POINTS, 'feet',
+                                    projection) == 2
+    bbox, shapes = read_shapefile(base)
+    feet = 1852.0 / 0.3048
+    assert bbox == pytest.approx((0.0, 0.0, 6.0 * feet, 4.0 * feet))
+    assert [len(parts) for parts in shapes] == [2, 2]
+    # outer rings are clockwise, holes counter-clockwise
+    areas = gisexport.contourarea.ring_areas(
+        [part[:-1] for part in shapes[0]])
+    assert areas[0] < 0 < areas[1]
+    records = read_records(base + '.dbf')
+    assert [r['LEVEL'] for r in records] == [65.0, 70.0]
+    assert records[1]['AREA'] == pytest.approx(2.0 * feet ** 2)
+    with open(base + '.prj') as f:
+        assert 'Azimuthal_Equidistant' in f.read()
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        gisexport.write_contours(str(tmp_path / 'SEL.kml'), POINTS)
+
+
+def test_study_graphics(tmp_path):
+    output_dir = tmp_path / 'S1' / 'OUTPUT1' / 'SEL'
+    output_dir.mkdir(parents=True)
+    with open(str(output_dir / 'CNTPTS_S1.csv'), 'w') as f:
+        f.write('LEVEL,CONTOUR,POINT,X,Y\n')
+        for row in POINTS.tolist():
+            f.write('%.2f,%d,%d,%.6f,%.6f\n' % row)
+    paths, error = gisexport.study_graphics(str(tmp_path / 'S1'), 'SEL   ',
+                                            ('shp', 'geojson'))
+    assert error is None
+    assert sorted(os.path.basename(p) for p in paths) == [
+        'CONTOURS_S1.geojson', 'CONTOURS_S1.shp']
@@ -0,0 +1,79 @@
+# ResultCache in front of a stand-in for INMStudy that writes its outputs
+# like INMAuto does (OUTPUT1/<metric>/<output>_<study folder>).
+
+import os
+
+import pytest
+
+import inmauto
+import inmcache
+
+__author__ = 'Thomas Vandenhede'
+
+
+class FakeStudy(object):
+    def __init__(self, studies_path, study_folder):
+        self.study_folder = study_folder
+        self.path_to_study = os.path.join(studies_path, study_folder)
+        self.runs = 0
+        os.makedirs(os.path.join(self.path_to_study, 'CASE1'))
+        for name in ('FLIGHT.DBF', 'CASE1/CASE.DBF', 'CASE1/GRID.DBF'):
+            self.write(name, name)
+
+    def write(self, rel_path, content):
+        with open(os.path.join(self.path_to_study, rel_path), 'w') as f:
+            f.write(content)
+
+    def outputs(self):
+        output_dir = os.path.join(self.path_to_study, 'OUTPUT1', 'SEL')
+        return sorted(os.listdir(output_dir))
+
+    def run_scenario(self, grids, run_options, export_options=None):
+        self.runs += 1
+        output_dir = os.path.join(self.path_to_study, 'OUTPUT1', 'SEL')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.write('OUTPUT1/NOISE.OUT', 'run %d' % self.runs)
+        self.write('OUTPUT1/SEL/STDGRID_%s.csv' % self.study_folder, 'grid')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return inmcache.ResultCache(str(tmp_path / 'cache'))
+
+
+def run(cache, study):
+    return cache.run_scenario(study, [inmauto.GridSetup()],
+                              inmauto.RunOptions())
+
+
+def test_hit_renames_study_files(cache, tmp_path):
+    first = FakeStudy(str(tmp_path), 'S1')
+    second = FakeStudy(str(tmp_path), 'S2')
+    assert not run(cache, first)
+    assert run(cache, second)
+    assert second.runs == 0
+    assert second.outputs() == ['STDGRID_S2.csv']
+
+
+def test_case_tables_are_inputs(cache, tmp_path):
+    study = FakeStudy(str(tmp_path), 'S1')
+    assert not run(cache, study)
+    study.write('CASE1/CASE.DBF', 'other case')
+    assert not run(cache, study)
+    # the grid table is hashed through the grids
+    study.write('CASE1/GRID.DBF', 'other grid')
+    assert run(cache, study)
+    assert study.runs == 2
+
+
+def test_earlier_outputs_not_stored(cache, tmp_path):
+    study = FakeStudy(str(tmp_path), 'S1')
+    os.makedirs(os.path.join(study.path_to_study, 'OUTPUT1', 'SEL'))
+    study.write('OUTPUT1/SEL/CNTPTS_S1.csv', 'earlier run')
+    assert not run(cache, study)
+    other = FakeStudy(str(tmp_path), 'S2')
+    assert run(cache, other)
+    assert other.outputs() == ['STDGRID_S2.csv']
+    assert os.path.exists(os.path.join(other.path_to_study, 'OUTPUT1',
+                                       'NOISE.OUT'))
@@ -0,0 +1,86 @@
+# Round trips of dBase tables through inmdbf: records, in-place updates and
+# hard-linked tables.
+
+import datetime
+import os
+
+import pytest
+
+from inmdbf import DBFError, DBFField, DBFReader, DBFTable, read_fields, \
+    read_records, write_records
+
+__author__ = 'Thomas Vandenhede'
+
+FIELDS = [
+    DBFField('TRACK_ID', 'C', 8),
+    DBFField('SEG_NUM', 'N', 4),
+    DBFField('DISTANCE', 'N', 12, 4),
+    DBFField('FLAG', 'N', 1),
+    DBFField('ACTIVE', 'L', 1),
+    DBFField('UPDATED', 'D', 8),
+]
+
+RECORDS = [
+    {'TRACK_ID': 'DEP1', 'SEG_NUM': 1, 'DISTANCE': 1.25, 'FLAG': 1,
+     'ACTIVE': True, 'UPDATED': datetime.date(2016, 3, 1)},
+    {'TRACK_ID': 'DÉP 2', 'SEG_NUM': 2, 'DISTANCE': None, 'FLAG': None,
+     'ACTIVE': False, 'UPDATED': None},
+    {'TRACK_ID': '', 'SEG_NUM': 12, 'DISTANCE': -0.5, 'FLAG': 7,
+     'ACTIVE': None, 'UPDATED': datetime.date(2000, 12, 31)},
+]
+
+
+@pytest.fixture
+def table(tmp_path):
+    path = str(tmp_path / 'TRK_SEGS.DBF')
+    write_records(path, FIELDS, RECORDS)
+    return path
+
+
+def test_records_round_trip(table):
+    assert read_records(table) == RECORDS
+    assert [(f.name, f.type, f.length, f.decimal_count)
+            for f in read_fields(table)] == \
+        [(f.name, f.type, f.length, f.decimal_count) for f in FIELDS]
+
+
+def test_value_too_long(tmp_path):
+    with pytest.raises(DBFError):
+        write_records(str(tmp_path / 'T.DBF'), FIELDS,
+                      [{'TRACK_ID': 'TOO LONG ID'}])
+
+
+def test_update_in_place(table):
+    with DBFTable(table, writable=True) as t:
+        t.update_field(1, 'DISTANCE', 3.5)
+        t.set_deleted(0)
+        assert t.get_field(1, 'DISTANCE') == 3.5
+    records = read_records(table)
+    assert [r['TRACK_ID'] for r in records] == ['DÉP 2', '']
+    assert records[0]['DISTANCE'] == 3.5
+    assert len(read_records(table, include_deleted=True)) == 3
+
+
+def test_read_only_table(table):
+    with DBFTable(table) as t:
+        assert t[-1]['SEG_NUM'] == 12
+        with pytest.raises(DBFError):
+            t.update_field(0, 'SEG_NUM', 3)
+
+
+def test_update_does_not_reach_links(table, tmp_path):
+    link = str(tmp_path / 'LINK.DBF')
+    os.link(table, link)
+    with DBFTable(link, writable=True) as t:
+        t.update_field(0, 'TRACK_ID', 'NEW')
+    assert read_records(table)[0]['TRACK_ID'] == 'DEP1'
+    assert read_records(link)[0]['TRACK_ID'] == 'NEW'
+
+
+def test_truncated_table(table):
+    with open(table, 'rb') as f:
+        data = f.read()
+    with open(table, 'wb') as f:
+        f.write(data[:-20])
+    with DBFReader(table) as t:
+        assert len(list(t)) == 2
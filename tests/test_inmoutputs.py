@@ -0,0 +1,134 @@
+# Parsing of the outputs exported by INMAuto, in both the comma delimited
+# and the space aligned layouts.
+
+import numpy as np
+import pytest
+
+import inmoutputs
+
+__author__ = 'Thomas Vandenhede'
+
+GRID_CSV = (b'GRID_ID,I,J,X,Y,SEL\r\n'
+            b'G1,1,1,-4.0000,-4.0000,81.25\r\n'
+            b'G1,2,1,-3.5000,-4.0000,\r\n')
+
+GRID_TXT = (b'   GRID_ID          I          J          X          Y'
+            b'        SEL\n'
+            b'        G1          1          1    -4.0000    -4.0000'
+            b'      81.25\n'
+            b'        G1          2          1    -3.5000    -4.0000'
+            b'      82.50\n')
+
+
+def test_csv_grid():
+    kind, grid = inmoutputs.parse_output_buffer(GRID_CSV)
+    assert kind == 'standard_grids'
+    assert grid.dtype.names == ('GRID_ID', 'I', 'J', 'X', 'Y', 'SEL')
+    assert list(grid['I']) == [1, 2]
+    assert grid['X'][1] == -3.5
+    assert grid['SEL'][0] == 81.25
+    assert np.isnan(grid['SEL'][1])
+    assert inmoutputs.level_field(grid) == 'SEL'
+
+
+def test_txt_grid():
+    kind, grid = inmoutputs.parse_output_buffer(GRID_TXT)
+    assert kind == 'standard_grids'
+    assert list(grid['GRID_ID']) == ['G1', 'G1']
+    assert list(grid['SEL']) == [81.25, 82.5]
+
+
+def test_csv_quoted_names():
+    data = (b'NAME,X,Y,DNL\n'
+            b'"SITE 1, NORTH",1.5,2.0,55.1\n'
+            b'SITE 2,-1.0,0.5,60.0\n')
+    kind, points = inmoutputs.parse_output_buffer(data)
+    assert kind == 'loc_points'
+    assert list(points['NAME']) == ['SITE 1, NORTH', 'SITE 2']
+    assert list(points['X']) == [1.5, -1.0]
+
+
+def test_txt_names_with_spaces():
+    data = (b'NAME                X          Y        DNL\n'
+            b'SITE 1         1.5000     2.0000      55.10\n'
+            b'CHURCH ST     -1.0000     0.5000      60.00\n')
+    kind, points = inmoutputs.parse_output_buffer(data)
+    assert kind == 'loc_points'
+    assert list(points['NAME']) == ['SITE 1', 'CHURCH ST']
+    assert list(points['Y']) == [2.0, 0.5]
+    assert list(points['DNL']) == [55.1, 60.0]
+
+
+def test_txt_not_aligned():
+    # values wider than their column shift the following ones
+    data = (b'LEVEL       AREA        POP\n'
+            b'65.0  1234567.890 12\n'
+            b'70.0      2.5000 3\n')
+    kind, areas = inmoutputs.parse_output_buffer(data)
+    assert kind == 'contour_areas'
+    assert list(areas['AREA']) == [1234567.89, 2.5]
+    assert list(areas['POP']) == [12, 3]
+
+
+@pytest.mark.parametrize('data', [
+    b'LEVEL,AREA,POP\n65.0,1.5,12\n70.0,2.5\n',
+    b'LEVEL,AREA,POP\n65.0,1.5,12,4\n',
+    b'LEVEL       AREA        POP\n'
+    b' 65.0     1.5000         12\n'
+    b' 70.0     2.5000\n',
+])
+def test_wrong_column_count(data):
+    with pytest.raises(ValueError):
+        inmoutputs.parse_output_buffer(data)
+
+
+def test_unknown_header():
+    kind, table = inmoutputs.parse_output_buffer(b'A,B\n1,2\n')
+    assert kind is None
+    assert list(table['B']) == [2]
+
+
+def test_empty_output():
+    kind, points = inmoutputs.parse_output_buffer(
+        b'LEVEL,CONTOUR,POINT,X,Y\n')
+    assert kind == 'contour_points'
+    assert len(points) == 0
+
+
+def test_read_study_outputs(tmp_path, capsys):
+    output_dir = tmp_path / 'OUTPUT1' / 'SEL'
+    output_dir.mkdir(parents=True)
+    (output_dir / 'STDGRID_S1.csv').write_bytes(GRID_CSV)
+    (output_dir / 'STDGRID_S2.txt').write_bytes(GRID_TXT)
+    (output_dir / 'OTHER_S1.csv').write_bytes(b'A,B\n1,2\n')
+
+    outputs = inmoutputs.read_study_outputs(str(tmp_path), 'SEL   ')
+    assert list(outputs) == ['standard_grids']
+    # the first file in name order
+    assert np.isnan(outputs['standard_grids']['SEL'][1])
+    assert 'OTHER_S1.csv' in capsys.readouterr().out
+
+
+def test_contour_rings():
+    data = (b'LEVEL,CONTOUR,POINT,X,Y\n'
+            b'70,1,2,1.0,0.0\n'
+            b'65,1,1,0.0,0.0\n'
+            b'70,1,1,0.0,0.0\n'
+            b'65,1,2,2.0,0.0\n'
+            b'65,1,3,2.0,2.0\n')
+    rings = inmoutputs.contour_rings(inmoutputs.parse_output_buffer(data)[1])
+    assert [(level, contour, len(ring)) for level, contour, ring in rings] \
+        == [(65, 1, 3), (70, 1, 2)]
+    assert rings[0][2].tolist() == [[0, 0], [2, 0], [2, 2]]
+
+
+def test_preamble_skipped(tmp_path):
+    data = (b'INM 7.0d  Standard Grid Output\r\n'
+            b'Study: S1, Case: BASELINE\r\n'
+            b'\r\n' + GRID_CSV)
+    kind, grid = inmoutputs.parse_output_buffer(data)
+    assert kind == 'standard_grids'
+    assert list(grid['I']) == [1, 2]
+    path = tmp_path / 'STDGRID_S1.csv'
+    path.write_bytes(data)
+    assert inmoutputs.read_header_kind(str(path)) == 'standard_grids'
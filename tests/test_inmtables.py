@@ -0,0 +1,172 @@
+# Round trips of the study tables written by inmtables, on tables whose
+# layout differs from the mapping (columns in another order, other widths,
+# extra columns). The column names are those of the provisional mappings of
+# inmtables, not checked against a real INM 7 study.
+
+import pytest
+
+import inmauto
+import inmtables
+from inmdbf import DBFError, DBFField, read_fields, read_records, \
+    write_records
+
+__author__ = 'Thomas Vandenhede'
+
+STUDY_GRID_FIELDS = [
+    DBFField('GRID_ID', 'C', 12),
+    DBFField('GRID_TYPE', 'C', 12),
+    DBFField('X_COORD', 'N', 14, 6),
+    DBFField('Y_COORD', 'N', 14, 6),
+    DBFField('I_DIST', 'N', 14, 6),
+    DBFField('J_DIST', 'N', 14, 6),
+    DBFField('I_COUNT', 'N', 8),
+    DBFField('J_COUNT', 'N', 8),
+    DBFField('ANGLE', 'N', 10, 3),
+    DBFField('THRESHOLD', 'N', 10, 3),
+    DBFField('AMB_DELTA', 'N', 10, 3),
+    DBFField('PCT_TIME', 'N', 10, 3),
+    DBFField('COORD', 'C', 8),
+    DBFField('LAT_ORIGIN', 'N', 12, 6),
+    DBFField('REMARK', 'C', 20),
+]
+
+
+def layout(fields):
+    return [(f.name, f.type, f.length, f.decimal_count) for f in fields]
+
+
+def make_grid(grid_id, x, nb_pts):
+    grid = inmauto.GridSetup()
+    grid.grid_id = grid_id
+    grid.grid_type = 'Standard'
+    grid.x = x
+    grid.nb_pts_i = nb_pts
+    grid.nb_pts_j = nb_pts
+    return grid
+
+
+@pytest.fixture
+def study(tmp_path):
+    write_records(str(tmp_path / 'GRID.DBF'), STUDY_GRID_FIELDS, [
+        {'GRID_ID': 'OLD', 'GRID_TYPE': 'Location', 'I_COUNT': 2,
+         'J_COUNT': 2, 'LAT_ORIGIN': 38.5, 'REMARK': 'kept'}])
+    return str(tmp_path)
+
+
+def test_grid_table_round_trip(study):
+    grids = [make_grid('G1', -4.5, 21), make_grid('G2', 1.25, 5)]
+    inmtables.write_grid_table(study, grids)
+
+    params = inmtables.read_grid_table(study)
+    assert [p['grid_id'] for p in params] == ['G1', 'G2']
+    assert [p['x'] for p in params] == [-4.5, 1.25]
+    assert [p['nb_pts_i'] for p in params] == [21, 5]
+    assert params[0]['grid_type'] == 'Standard'
+    assert params[0]['fixed_threshold'] == 85.0
+
+
+def test_grid_table_keeps_the_study_layout(study):
+    path = inmtables.write_grid_table(study, [make_grid('G1', 0.0, 3),
+                                              make_grid('G2', 0.0, 3)])
+
+    assert layout(read_fields(path)) == layout(STUDY_GRID_FIELDS)
+    records = read_records(path)
+    # columns unknown to inmtables keep their values
+    assert [r['LAT_ORIGIN'] for r in records] == [38.5, 38.5]
+    assert [r['REMARK'] for r in records] == ['kept', 'kept']
+
+
+def test_grid_table_missing_column(tmp_path):
+    fields = [f for f in STUDY_GRID_FIELDS if f.name != 'ANGLE']
+    write_records(str(tmp_path / 'grid.dbf'), fields, [])
+    with pytest.raises(DBFError, match='ANGLE'):
+        inmtables.write_grid_table(str(tmp_path), [make_grid('G', 0.0, 2)])
+
+
+def test_grid_table_created_when_missing(tmp_path):
+    inmtables.write_grid_table(str(tmp_path), [make_grid('G', 2.0, 4)])
+    params = inmtables.read_grid_table(str(tmp_path))
+    assert len(params) == 1 and params[0]['x'] == 2.0
+
+
+def test_grid_table_other_mapping(tmp_path):
+    mapping = [(name, DBFField('G_' + field.name[:8], field.type,
+                               field.length, field.decimal_count))
+               for name, field in inmtables.GRID_FIELDS]
+    write_records(str(tmp_path / 'GRID.DBF'), [f for n, f in mapping], [])
+    with pytest.raises(DBFError, match='its columns: G_GRID_ID'):
+        inmtables.write_grid_table(str(tmp_path), [make_grid('G', 2.0, 4)])
+    inmtables.write_grid_table(str(tmp_path), [make_grid('G', 2.0, 4)],
+                               mapping=mapping)
+    params = inmtables.read_grid_table(str(tmp_path), mapping=mapping)
+    assert params[0]['x'] == 2.0
+
+
+def test_grid_table_of_a_case(tmp_path):
+    for case in ('CASE1', 'CASE2'):
+        (tmp_path / case).mkdir()
+        write_records(str(tmp_path / case / 'GRID.DBF'), STUDY_GRID_FIELDS,
+                      [])
+    with pytest.raises(DBFError, match='several'):
+        inmtables.write_grid_table(str(tmp_path), [make_grid('G', 2.0, 4)])
+    path = inmtables.write_grid_table(str(tmp_path),
+                                      [make_grid('G', 2.0, 4)], 'CASE2')
+    assert path == str(tmp_path / 'CASE2' / 'GRID.DBF')
+    assert read_records(str(tmp_path / 'CASE1' / 'GRID.DBF')) == []
+    assert len(inmtables.read_grid_table(str(tmp_path), 'CASE2')) == 1
+
+
+def study_run_options_fields():
+    # a layout other than the mapping's: the mapped columns in reverse
+    # order and wider, and columns inmtables does not know about
+    fields = [DBFField('CASE_ID', 'C', 20)]
+    for name, field in reversed(inmtables.RUN_OPTIONS_FIELDS):
+        length = field.length + 4 if field.type in 'CN' else field.length
+        fields.append(DBFField(field.name, field.type, length,
+                               field.decimal_count))
+    return fields + [DBFField('NEW_OPTION', 'L', 1)]
+
+
+@pytest.fixture
+def run_options_study(tmp_path):
+    write_records(str(tmp_path / 'RUN_OPT.DBF'), study_run_options_fields(),
+                  [{'CASE_ID': 'BASELINE', 'METRIC': 'DNL',
+                    'NEW_OPTION': True}])
+    return str(tmp_path)
+
+
+def test_run_options_table_round_trip(run_options_study):
+    run_options = inmauto.RunOptions()
+    run_options.noise_metric = 'sel'
+    run_options.do_standard_grids = True
+    run_options.refinement = 6
+    run_options.tolerance = 0.125
+    path = inmtables.write_run_options_table(run_options_study, run_options)
+
+    params = inmtables.read_run_options_table(run_options_study)
+    expected = dict(run_options.get_run_options_dict(), noise_metric='SEL')
+    assert params == expected
+    assert layout(read_fields(path)) == layout(study_run_options_fields())
+    record = read_records(path)[0]
+    assert record['CASE_ID'] == 'BASELINE' and record['NEW_OPTION'] is True
+
+
+def test_run_options_table_missing_column(tmp_path):
+    fields = [f for f in study_run_options_fields() if f.name != 'DO_STD']
+    write_records(str(tmp_path / 'RUN_OPT.DBF'), fields, [{'METRIC': 'DNL'}])
+    with pytest.raises(DBFError, match='DO_STD'):
+        inmtables.write_run_options_table(str(tmp_path),
+                                          inmauto.RunOptions())
+    with pytest.raises(DBFError, match='DO_STD'):
+        inmtables.read_run_options_table(str(tmp_path))
+
+
+def test_run_options_table_of_a_case(tmp_path):
+    for case in ('CASE1', 'CASE2'):
+        (tmp_path / case).mkdir()
+        write_records(str(tmp_path / case / 'RUN_OPT.DBF'),
+                      study_run_options_fields(), [{'METRIC': case[-1]}])
+    with pytest.raises(DBFError, match='several'):
+        inmtables.read_run_options_table(str(tmp_path))
+    params = inmtables.read_run_options_table(str(tmp_path), 'CASE2')
+    assert params['noise_metric'] == '2'
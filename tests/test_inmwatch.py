@@ -0,0 +1,51 @@
+# End of run detection by OutputWatcher (polling), with files whose
+# modification time is coarser than the start of the run.
+
+import os
+import time
+
+import pytest
+
+from inmwait import WaitTimeoutError
+from inmwatch import OutputWatcher
+
+__author__ = 'Thomas Vandenhede'
+
+
+def write(path, content, mtime=None):
+    with open(path, 'w') as f:
+        f.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def watcher(directory):
+    return OutputWatcher(str(directory), ['noise.out', '*.grd'],
+                         settle_time=0.0, use_inotify=False,
+                         poll_interval=0.01)
+
+
+def test_files_dated_before_the_start(tmp_path):
+    with watcher(tmp_path) as w:
+        # a 2 s resolution file system rounds the times down
+        dated = int(w.start_time) - int(w.start_time) % 2
+        write(str(tmp_path / 'NOISE.OUT'), 'results', dated)
+        write(str(tmp_path / 'STD.GRD'), 'grid', dated)
+        result = w.wait(timeout=5.0)
+    assert result['files'] == {'NOISE.OUT': 7, 'STD.GRD': 4}
+    assert result['duration_s'] == 0.0
+
+
+def test_earlier_outputs_ignored(tmp_path):
+    mtime = time.time() - 10.0
+    write(str(tmp_path / 'NOISE.OUT'), 'earlier', mtime)
+    write(str(tmp_path / 'STD.GRD'), 'earlier', mtime)
+    with watcher(tmp_path) as w:
+        with pytest.raises(WaitTimeoutError):
+            w.wait(timeout=0.1)
+        # rewritten with the same size and a time not later than before
+        write(str(tmp_path / 'NOISE.OUT'), 'results', mtime - 2.0)
+        with pytest.raises(WaitTimeoutError):
+            w.wait(timeout=0.1)
+        write(str(tmp_path / 'STD.GRD'), 'grid', mtime)
+        assert w.wait(timeout=5.0)['files']['STD.GRD'] == 4